@@ -0,0 +1,136 @@
+"""
+Instance Archiver Module
+Moves finished lab/service instances out of the hot collections into
+monthly history collections (e.g. lab_instances_history_202610).
+The hot collections only keep live state; history readers use the
+helpers below to query hot + archive transparently.
+"""
+import os
+import threading
+import logging
+from datetime import datetime, timedelta
+from pymongo.errors import BulkWriteError
+
+from app.db import db, lab_instances, service_instances
+from app.coordination import is_leader
+from app.lab_controller import FAILED_LAB_STATUS
+
+logger = logging.getLogger(__name__)
+
+# Statuses that mean the instance is finished and can leave the hot collection
+FINISHED_STATUSES = ["stopped", "auto-stopped", FAILED_LAB_STATUS, "deleted"]
+
+# Keep finished records in the hot collection for a short grace period
+ARCHIVE_GRACE_MINUTES = int(os.getenv("ARCHIVE_GRACE_MINUTES", "60"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+
+HOT_COLLECTIONS = {
+    "lab_instances": lab_instances,
+    "service_instances": service_instances,
+}
+
+
+def history_collection_name(kind: str, when: datetime) -> str:
+    """Name of the monthly history partition for a finished instance"""
+    return f"{kind}_history_{when:%Y%m}"
+
+
+def list_history_collections(kind: str) -> list:
+    """All history partitions for a hot collection, oldest first"""
+    prefix = f"{kind}_history_"
+    return sorted(name for name in db.list_collection_names() if name.startswith(prefix))
+
+
+def _finished_at(instance: dict) -> datetime:
+    return instance.get("stopped_at") or instance.get("started_at") or datetime.utcnow()
+
+
+def archive_collection(kind: str, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move finished instances of one hot collection into history partitions"""
+    hot = HOT_COLLECTIONS[kind]
+    cutoff = datetime.utcnow() - timedelta(minutes=ARCHIVE_GRACE_MINUTES)
+    query = {
+        "status": {"$in": FINISHED_STATUSES},
+        "$or": [
+            {"stopped_at": {"$lt": cutoff}},
+            {"stopped_at": {"$exists": False}},
+        ],
+    }
+
+    moved = 0
+    while True:
+        batch = list(hot.find(query).limit(batch_size))
+        if not batch:
+            break
+
+        # Group by partition so each target gets one insert_many
+        partitions = {}
+        for instance in batch:
+            name = history_collection_name(kind, _finished_at(instance))
+            partitions.setdefault(name, []).append(instance)
+
+        for name, docs in partitions.items():
+            db[name].create_index("user_email")
+            try:
+                db[name].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Duplicate _id means a previous run copied but did not delete;
+                # anything else must keep the records in the hot collection
+                errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if errors:
+                    logger.error(f"Failed to archive into {name}: {errors[0].get('errmsg')}")
+                    return moved
+
+        hot.delete_many({"_id": {"$in": [instance["_id"] for instance in batch]}})
+        moved += len(batch)
+
+        if len(batch) < batch_size:
+            break
+
+    if moved:
+        logger.info(f"Archived {moved} finished records from {kind}")
+    return moved
+
+
+def archive_finished_instances() -> dict:
+    """Archive finished lab and service instances"""
+    return {kind: archive_collection(kind) for kind in HOT_COLLECTIONS}
+
+
+# ==================== History Readers ====================
+
+def count_history(kind: str, query: dict) -> int:
+    """Count matching records across hot and archived instances"""
+    total = HOT_COLLECTIONS[kind].count_documents(query)
+    for name in list_history_collections(kind):
+        total += db[name].count_documents(query)
+    return total
+
+
+def delete_history(kind: str, query: dict) -> int:
+    """Delete matching records from every history partition"""
+    deleted = 0
+    for name in list_history_collections(kind):
+        deleted += db[name].delete_many(query).deleted_count
+    return deleted
+
+
+# ==================== Background Job ====================
+
+def archiver_loop(stop_event: threading.Event):
+    """Periodically archive finished instances (leader only) until stop_event is set"""
+    while not stop_event.is_set():
+        try:
+            if is_leader():
+                archive_finished_instances()
+        except Exception as e:
+            logger.error(f"Archiver run failed: {e}")
+        stop_event.wait(ARCHIVE_INTERVAL_SECONDS)
+
+
+def start_archiver() -> threading.Event:
+    """Start the archiver thread, returns the event that stops it"""
+    stop_event = threading.Event()
+    threading.Thread(target=archiver_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
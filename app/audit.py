@@ -0,0 +1,78 @@
+"""
+Audit Log Module
+Buffers audit events in memory and writes them with insert_many,
+serves keyset-paginated reads and keeps retention via a TTL index.
+"""
+import os
+from datetime import datetime
+from bson import ObjectId
+from pymongo import DESCENDING
+
+from app.db import audit_logs, ensure_ttl_index
+from app.buffered_writer import BufferedWriter
+from app.pagination import encode_cursor, before_cursor
+
+AUDIT_FLUSH_SIZE = int(os.getenv("AUDIT_FLUSH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "2"))
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "180"))
+AUDIT_FALLBACK_PATH = os.getenv("AUDIT_FALLBACK_PATH", "audit_fallback.jsonl")
+
+# Retention and keyset pagination indexes
+ensure_ttl_index(audit_logs, "timestamp", "audit_ttl", AUDIT_RETENTION_DAYS * 86400)
+audit_logs.create_index([("timestamp", DESCENDING), ("_id", DESCENDING)])
+
+
+audit_writer = BufferedWriter(
+    audit_logs,
+    fallback_path=AUDIT_FALLBACK_PATH,
+    flush_size=AUDIT_FLUSH_SIZE,
+    flush_interval=AUDIT_FLUSH_INTERVAL_SECONDS
+)
+
+
+def log_audit_event(user_email: str, action: str, target: str, details: dict = None):
+    """Record an audit event (buffered)"""
+    audit_writer.write({
+        "_id": ObjectId(),
+        "user_email": user_email,
+        "action": action,
+        "target": target,
+        "details": details or {},
+        "timestamp": datetime.utcnow()
+    })
+
+
+# ==================== Queries ====================
+
+def list_audit_logs(limit: int = 100, cursor: str = None, action: str = None,
+                    user_email: str = None, target: str = None,
+                    since: datetime = None, until: datetime = None) -> dict:
+    """Page through audit logs newest first using a (timestamp, _id) cursor"""
+    query = {}
+    if action:
+        query["action"] = action
+    if user_email:
+        query["user_email"] = user_email
+    if target:
+        query["target"] = target
+    if since or until:
+        query["timestamp"] = {}
+        if since:
+            query["timestamp"]["$gte"] = since
+        if until:
+            query["timestamp"]["$lt"] = until
+
+    if cursor:
+        query = {"$and": [query, before_cursor("timestamp", cursor)]}
+
+    logs = list(
+        audit_logs.find(query)
+        .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit)
+    )
+
+    next_cursor = encode_cursor(logs[-1]["timestamp"], logs[-1]["_id"]) if len(logs) == limit else None
+    for log in logs:
+        log["_id"] = str(log["_id"])
+
+    return {"logs": logs, "next_cursor": next_cursor}
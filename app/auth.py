@@ -5,14 +5,25 @@ Supports Google and GitHub OAuth 2.0
 from datetime import datetime, timedelta
 from typing import Optional
 import os
+import time
+import threading
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from authlib.integrations.starlette_client import OAuth
 from dotenv import load_dotenv
 
-from app.db import users, audit_logs, lab_instances, service_instances
+from app.db import users, lab_instances, service_instances, system_flags
+from app.audit import log_audit_event
+from app.user_cache import user_cache, invalidate_user
 from app.volume_manager import delete_user_volume
+from app.volume_archive import discard_export
+from app.archiver import delete_history
+from app.container_runtime import get_runtime
+from app.tracing import span
+from app.http_client import SharedTransport
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +38,10 @@ GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GITHUB_CLIENT_ID = os.getenv("GITHUB_CLIENT_ID")
 GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
 OAUTH_CALLBACK_BASE_URL = os.getenv("OAUTH_CALLBACK_BASE_URL", "http://localhost:8000")
+# Authorize/token endpoints; point at a local mock provider for callback latency tests
+GITHUB_OAUTH_URL = os.getenv("GITHUB_OAUTH_URL", "https://github.com").rstrip("/")
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+GOOGLE_METADATA_URL = "https://accounts.google.com/.well-known/openid-configuration"
 
 # Initialize OAuth
 oauth = OAuth()
@@ -37,8 +52,8 @@ if GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET:
         name='google',
         client_id=GOOGLE_CLIENT_ID,
         client_secret=GOOGLE_CLIENT_SECRET,
-        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-        client_kwargs={'scope': 'openid email profile'}
+        server_metadata_url=GOOGLE_METADATA_URL,
+        client_kwargs={'scope': 'openid email profile', 'transport': SharedTransport()}
     )
 
 # Register GitHub OAuth
@@ -47,12 +62,12 @@ if GITHUB_CLIENT_ID and GITHUB_CLIENT_SECRET:
         name='github',
         client_id=GITHUB_CLIENT_ID,
         client_secret=GITHUB_CLIENT_SECRET,
-        access_token_url='https://github.com/login/oauth/access_token',
+        access_token_url=f'{GITHUB_OAUTH_URL}/login/oauth/access_token',
         access_token_params=None,
-        authorize_url='https://github.com/login/oauth/authorize',
+        authorize_url=f'{GITHUB_OAUTH_URL}/login/oauth/authorize',
         authorize_params=None,
-        api_base_url='https://api.github.com/',
-        client_kwargs={'scope': 'user:email'},
+        api_base_url=f'{GITHUB_API_URL}/',
+        client_kwargs={'scope': 'user:email', 'transport': SharedTransport()},
     )
 
 security = HTTPBearer()
@@ -63,7 +78,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     """Create JWT access token"""
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 def verify_token(token: str) -> dict:
@@ -83,50 +98,66 @@ def get_user_by_email(email: str):
     """Get user by email"""
     return users.find_one({"email": email})
 
-def get_or_create_user(email: str, full_name: str, avatar_url: str, provider: str, oauth_id: str, is_first_user: bool = False):
-    """Get existing user or create new one from OAuth"""
-    user = get_user_by_email(email)
+# Set once this process has seen the first-admin slot taken, so later
+# signups skip the claim round trip
+_first_admin_claimed = threading.Event()
 
-    if user:
-        # Update last login and OAuth info
-        users.update_one(
-            {"email": email},
-            {"$set": {
-                "last_login": datetime.utcnow(),
-                "avatar_url": avatar_url,
-                "full_name": full_name
-            }}
+def claim_first_admin(email: str) -> bool:
+    """Atomically claim the first-admin slot; only one caller can ever win"""
+    if _first_admin_claimed.is_set():
+        return False
+    try:
+        system_flags.find_one_and_update(
+            {"_id": "first_admin", "claimed": {"$ne": True}},
+            {"$set": {"claimed": True, "email": email, "claimed_at": datetime.utcnow()}},
+            upsert=True
         )
-        return user
-
-    # Determine role (first user is admin)
-    total_users = users.count_documents({})
-    role = "admin" if (total_users == 0 or is_first_user) else "user"
+        won = True
+    except DuplicateKeyError:
+        won = False
+    _first_admin_claimed.set()
+    return won
 
-    # Create new user
-    new_user = {
-        "email": email,
-        "full_name": full_name,
+def get_or_create_user(email: str, full_name: str, avatar_url: str, provider: str, oauth_id: str, is_first_user: bool = False):
+    """Get existing user or create new one from OAuth (single upsert round trip)"""
+    now = datetime.utcnow()
+    login_fields = {
+        "last_login": now,
         "avatar_url": avatar_url,
+        "full_name": full_name
+    }
+    insert_fields = {
         "oauth_provider": provider,
         "oauth_id": oauth_id,
-        "role": role,
+        "role": "user",
         "theme_preference": "auto",
         "notifications_enabled": True,
-        "created_at": datetime.utcnow(),
-        "last_login": datetime.utcnow()
+        "created_at": now
     }
 
-    users.insert_one(new_user)
+    # Pre-image is None only for the request that inserted the user
+    existing = users.find_one_and_update(
+        {"email": email},
+        {"$set": login_fields, "$setOnInsert": insert_fields},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+    if existing:
+        # New tokens carry a new iat, so only this worker's entry needs dropping
+        user_cache.evict(email)
+        existing.update(login_fields)
+        return existing
+
+    new_user = {"email": email, **insert_fields, **login_fields}
+
+    # Determine role (first user is admin)
+    if is_first_user or claim_first_admin(email):
+        users.update_one({"email": email}, {"$set": {"role": "admin"}})
+        new_user["role"] = "admin"
 
     # Log user creation
-    audit_logs.insert_one({
-        "user_email": "system",
-        "action": "user_created",
-        "target": email,
-        "details": {"provider": provider, "role": role},
-        "timestamp": datetime.utcnow()
-    })
+    log_audit_event("system", "user_created", email, {"provider": provider, "role": new_user["role"]})
 
     return new_user
 
@@ -142,6 +173,7 @@ def update_user_profile(email: str, full_name: str = None, theme: str = None, no
 
     if update_data:
         users.update_one({"email": email}, {"$set": update_data})
+        invalidate_user(email)
         return True
     return False
 
@@ -169,8 +201,14 @@ def extract_github_user_info(user_info: dict, email: str):
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current authenticated user from JWT token"""
-    token = credentials.credentials
+    return authenticate_token(credentials.credentials)
+
+def get_current_user_from_query(token: str):
+    """Authenticate via ?token= for clients that cannot set headers (EventSource)"""
+    return authenticate_token(token)
 
+def authenticate_token(token: str, scope: Optional[str] = None):
+    """Resolve a JWT to its user document; scoped tokens (e.g. a lab session) only work where that scope is asked for"""
     try:
         payload = verify_token(token)
         email = payload.get("email")
@@ -179,13 +217,27 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token: email not found",
             )
+        if payload.get("scope") != scope:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token not valid here",
+            )
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
         )
 
-    user = get_user_by_email(email)
+    started = time.perf_counter()
+    iat = payload.get("iat")
+    user = user_cache.get(email, iat)
+    if user is None:
+        read_at = datetime.utcnow()
+        user = get_user_by_email(email)
+        if user:
+            user_cache.put(email, iat, user, read_at)
+    user_cache.record_lookup(time.perf_counter() - started)
+
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -207,10 +259,6 @@ def get_current_admin(user: dict = Depends(get_current_user)):
 
 def create_user_as_admin(email: str, full_name: str, role: str, admin_user: dict):
     """Admin creates a new user (OAuth placeholder)"""
-    existing = get_user_by_email(email)
-    if existing:
-        raise HTTPException(status_code=400, detail="User already exists")
-
     new_user = {
         "email": email,
         "full_name": full_name,
@@ -224,16 +272,13 @@ def create_user_as_admin(email: str, full_name: str, role: str, admin_user: dict
         "last_login": None
     }
 
-    users.insert_one(new_user)
+    try:
+        users.insert_one(new_user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
 
     # Log action
-    audit_logs.insert_one({
-        "user_email": admin_user["email"],
-        "action": "user_created",
-        "target": email,
-        "details": {"role": role},
-        "timestamp": datetime.utcnow()
-    })
+    log_audit_event(admin_user["email"], "user_created", email, {"role": role})
 
     return {"message": "User created", "email": email, "role": role}
 
@@ -253,21 +298,15 @@ def update_user_role(email: str, new_role: str, admin_user: dict):
         raise HTTPException(status_code=400, detail="Cannot change your own role")
 
     users.update_one({"email": email}, {"$set": {"role": new_role}})
+    invalidate_user(email)
 
     # Log action
-    audit_logs.insert_one({
-        "user_email": admin_user["email"],
-        "action": "role_updated",
-        "target": email,
-        "details": {"new_role": new_role},
-        "timestamp": datetime.utcnow()
-    })
+    log_audit_event(admin_user["email"], "role_updated", email, {"new_role": new_role})
 
     return {"message": "Role updated", "email": email, "role": new_role}
 
 def delete_user(email: str, admin_user: dict):
     """Delete user (admin only)"""
-    import subprocess
 
     # Prevent admin from deleting themselves
     if email == admin_user["email"]:
@@ -279,39 +318,40 @@ def delete_user(email: str, admin_user: dict):
         raise HTTPException(status_code=404, detail="User not found")
 
     # Stop and remove all running lab containers for this user
-    running_labs = list(lab_instances.find({"user_email": email, "status": "running"}))
-    for lab in running_labs:
-        container = lab.get("container")
-        if container:
-            try:
-                subprocess.run(["docker", "stop", container], check=False, capture_output=True)
-                subprocess.run(["docker", "rm", container], check=False, capture_output=True)
-            except Exception as e:
-                print(f"Warning: Failed to stop/remove container {container}: {e}")
+    with span("stop_lab_containers"):
+        running_labs = list(lab_instances.find({"user_email": email, "status": {"$in": ["starting", "running"]}}))
+        for lab in running_labs:
+            container = lab.get("container")
+            if container and not get_runtime().discard(container):
+                print(f"Warning: Failed to stop/remove container {container}")
 
     # Delete all lab instances for this user from database
-    lab_instances.delete_many({"user_email": email})
+    with span("delete_instances"):
+        lab_instances.delete_many({"user_email": email})
+
+        # Stop and remove all service containers for this user
+        # Note: Services are shared, so we only delete database records, not containers
+        service_instances.delete_many({"user_email": email})
 
-    # Stop and remove all service containers for this user
-    # Note: Services are shared, so we only delete database records, not containers
-    service_instances.delete_many({"user_email": email})
+    # Drop archived history for this user as well
+    with span("delete_history"):
+        delete_history("lab_instances", {"user_email": email})
+        delete_history("service_instances", {"user_email": email})
 
     # Delete user's persistent volume (CRITICAL: This deletes all user data!)
-    volume_deleted = delete_user_volume(email)
+    with span("delete_volume"):
+        volume_deleted = delete_user_volume(email)
+        discard_export(email)
 
     # Delete user from database
-    result = users.delete_one({"email": email})
+    with span("delete_user_record"):
+        users.delete_one({"email": email})
+        invalidate_user(email)
 
     # Log action
-    audit_logs.insert_one({
-        "user_email": admin_user["email"],
-        "action": "user_deleted",
-        "target": email,
-        "details": {
-            "labs_removed": len(running_labs),
-            "volume_deleted": volume_deleted
-        },
-        "timestamp": datetime.utcnow()
+    log_audit_event(admin_user["email"], "user_deleted", email, {
+        "labs_removed": len(running_labs),
+        "volume_deleted": volume_deleted
     })
 
     return {
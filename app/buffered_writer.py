@@ -0,0 +1,200 @@
+"""
+Buffered Writer Module
+Collects documents in memory and writes them with insert_many on size or
+time. On shutdown the buffer is drained; whatever Mongo still rejects is
+spilled to a JSONL file and replayed on the next start, or by the flusher
+once Mongo is reachable again. The buffer is capped: past max_buffer the
+oldest documents are spilled to the same file. Documents Mongo keeps
+rejecting are moved to a dead-letter file after max_attempts tries.
+"""
+import os
+import threading
+import logging
+from bson import json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter:
+    """In-memory write buffer for one collection, flushed on size or time"""
+
+    def __init__(self, collection, fallback_path: str, flush_size: int = 100, flush_interval: float = 2.0,
+                 max_buffer: int = 10000, max_attempts: int = 5):
+        self.collection = collection
+        self.fallback_path = fallback_path
+        root, ext = os.path.splitext(fallback_path)
+        self.dead_letter_path = f"{root}.rejected{ext}"
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_attempts = max_attempts
+        self._buffer = []
+        self._inflight = []  # taken by a flush, not yet confirmed written
+        self._attempts = {}  # id(doc) -> write errors so far, for documents being retried
+        self._replay_pending = False
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self, doc: dict):
+        """Queue a document; wakes the flusher once the buffer is full"""
+        if self._thread is None:
+            # Writer not running (scripts, migrations): write through
+            self.collection.insert_one(doc)
+            self.on_flushed([doc], set())
+            return
+        with self._lock:
+            self._buffer.append(doc)
+            full = len(self._buffer) >= self.flush_size
+            overflow = self._buffer[:len(self._buffer) - self.max_buffer]
+            del self._buffer[:len(overflow)]
+        if overflow:
+            # Mongo has been away for a while; keep memory bounded and let
+            # the flusher replay the file once writes go through again
+            self.spill_to_fallback(overflow)
+        if full:
+            self._wakeup.set()
+
+    def on_flushed(self, docs: list, duplicate_ids: set):
+        """Hook called after documents are durably written; duplicate_ids were already in the collection"""
+
+    def pending(self) -> list:
+        """Documents not yet confirmed written, including a batch being flushed right now"""
+        with self._lock:
+            return self._inflight + self._buffer
+
+    def flush(self) -> int:
+        """Write all buffered documents, requeueing the ones Mongo did not take"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._inflight = batch
+        if not batch:
+            return 0
+        try:
+            rejected, duplicate_ids = self._insert(batch)
+            retry = self._count_attempts(rejected)
+        except Exception as e:
+            # Mongo unreachable: the whole batch is retried, without counting
+            # against the documents' attempts
+            logger.error(f"Failed to flush {len(batch)} documents to {self.collection.name}: {e}")
+            rejected, retry, duplicate_ids = batch, batch, set()
+        with self._lock:
+            self._buffer[:0] = retry
+            self._inflight = []
+        return self._written(batch, rejected, duplicate_ids)
+
+    def _written(self, batch: list, rejected: list, duplicate_ids: set) -> int:
+        """Run the post-write hook for the documents of batch that were not rejected"""
+        rejected_ids = {id(doc) for doc in rejected}
+        written = [doc for doc in batch if id(doc) not in rejected_ids]
+        for doc in written:
+            self._attempts.pop(id(doc), None)
+        if written:
+            try:
+                self.on_flushed(written, duplicate_ids)
+            except Exception as e:
+                # The documents are written; only the follow-up work is lost
+                logger.error(f"Post-flush hook for {self.collection.name} failed: {e}")
+        return len(written)
+
+    def _count_attempts(self, rejected: list) -> list:
+        """Count a failed write per document; returns the ones to retry and dead-letters the rest"""
+        retry, dead = [], []
+        for doc in rejected:
+            attempts = self._attempts.get(id(doc), 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(id(doc), None)
+                dead.append(doc)
+            else:
+                self._attempts[id(doc)] = attempts
+                retry.append(doc)
+        if dead:
+            with self._file_lock:
+                self._append_jsonl(self.dead_letter_path, dead)
+            logger.error(f"Gave up on {len(dead)} documents for {self.collection.name} after {self.max_attempts} attempts, "
+                         f"moved to {self.dead_letter_path}")
+        return retry
+
+    def _insert(self, docs: list) -> tuple:
+        """insert_many that reports (rejected documents, _ids already present) instead of raising"""
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate _id means the document was already written (e.g. a
+            # retried batch or a replay), so only other errors are retried
+            write_errors = e.details.get("writeErrors", [])
+            errors = [err for err in write_errors if err.get("code") != 11000]
+            if errors:
+                logger.error(f"{len(errors)} documents rejected by {self.collection.name}: {errors[0].get('errmsg')}")
+            duplicate_ids = {docs[err["index"]]["_id"] for err in write_errors if err.get("code") == 11000}
+            return [docs[err["index"]] for err in errors], duplicate_ids
+        return [], set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._replay_pending:
+                self.replay_fallback()
+            self.flush()
+
+    def start(self):
+        """Replay any spilled documents and start the background flusher"""
+        self.replay_fallback()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and drain the buffer, spilling to disk if Mongo is down"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+        with self._lock:
+            leftover, self._buffer = self._buffer, []
+        if leftover:
+            self.spill_to_fallback(leftover)
+
+    def spill_to_fallback(self, docs: list):
+        """Append documents to the local fallback file"""
+        with self._file_lock:
+            self._append_jsonl(self.fallback_path, docs)
+            self._replay_pending = True
+        logger.warning(f"Spilled {len(docs)} documents to {self.fallback_path}")
+
+    @staticmethod
+    def _append_jsonl(path: str, docs: list):
+        with open(path, "a", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json_util.dumps(doc) + "\n")
+
+    def replay_fallback(self) -> int:
+        """Insert spilled documents and remove the file; keeps it for a later retry while Mongo is down"""
+        with self._file_lock:
+            if not os.path.exists(self.fallback_path):
+                self._replay_pending = False
+                return 0
+            with open(self.fallback_path, encoding="utf-8") as f:
+                docs = [json_util.loads(line) for line in f if line.strip()]
+            try:
+                rejected, duplicate_ids = self._insert(docs) if docs else ([], set())
+            except PyMongoError as e:
+                # Already-inserted documents come back as duplicates on the
+                # next try, so a partial replay is safe to repeat
+                logger.warning(f"Could not replay {self.fallback_path}, retrying later: {e}")
+                self._replay_pending = True
+                return 0
+            os.remove(self.fallback_path)
+            self._replay_pending = False
+        retry = self._count_attempts(rejected)
+        with self._lock:
+            self._buffer.extend(retry)
+        self._written(docs, rejected, duplicate_ids)
+        logger.info(f"Replayed {len(docs)} documents from {self.fallback_path}")
+        return len(docs)
@@ -0,0 +1,805 @@
+"""
+Container Runtime Module
+One interface for everything the platform asks of a container engine
+(containers, exec, volumes, networks, images, stats, events) with
+interchangeable backends, picked per host with CONTAINER_RUNTIME:
+
+  docker-cli / podman-cli   the CLI binary, argument lists, no shell
+  docker / podman           the Engine API over the daemon's unix socket
+                            (Podman serves the same API rootless)
+  memory                    in-process fake for tests and benchmarks
+"""
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import threading
+import subprocess
+import logging
+from typing import Callable, Iterator, Optional
+
+import httpx
+
+from app.metrics import run_docker, DOCKER_OPERATION_SECONDS, DOCKER_OPERATION_FAILURES
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_RUNTIME = os.getenv("CONTAINER_RUNTIME", "docker-cli")
+DOCKER_SOCKET = os.getenv("DOCKER_SOCKET", "/var/run/docker.sock")
+# Empty = the rootless default, $XDG_RUNTIME_DIR/podman/podman.sock
+PODMAN_SOCKET = os.getenv("PODMAN_SOCKET", "")
+ENGINE_API_VERSION = os.getenv("ENGINE_API_VERSION", "v1.41")
+
+SIZE_UNITS = {
+    "b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+    "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4,
+    "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3,
+}
+
+
+class ContainerRuntimeError(Exception):
+    """A runtime call failed; output holds whatever stdout it produced"""
+
+    def __init__(self, message: str, output: str = ""):
+        super().__init__(message)
+        self.output = output
+
+
+class EventStream:
+    """
+    Engine events, already subscribed to when the stream is returned.
+    Iterating yields {type, action, name}; close() may be called from any
+    thread and ends the iteration. A broken connection (daemon restart,
+    socket error) raises ContainerRuntimeError.
+    """
+
+    def __init__(self, events: Iterator[dict], on_close: Callable[[], None]):
+        self._events = events
+        self._on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        try:
+            return next(self._events)
+        except StopIteration:
+            raise
+        except Exception as e:
+            if self.closed:
+                raise StopIteration
+            if isinstance(e, ContainerRuntimeError):
+                raise
+            raise ContainerRuntimeError(f"Event stream failed: {e}") from e
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._on_close()
+        except Exception as e:
+            logger.debug(f"Closing event stream: {e}")
+
+
+def parse_size(text: str) -> int:
+    """'4g' / '12.5MiB' / '1.2GB' -> bytes"""
+    text = text.strip().lower()
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz")
+    return int(float(number) * SIZE_UNITS.get(text[len(number):], 1))
+
+
+class ContainerRuntime:
+    """Operations the platform needs from a container engine"""
+
+    name = "base"
+
+    def run(self, image: str, name: Optional[str] = None, command: Optional[list] = None, *,
+            network: Optional[str] = None, volumes: Optional[list] = None, env: Optional[dict] = None,
+            ports: Optional[dict] = None, cpus: Optional[str] = None, memory: Optional[str] = None,
+            user: Optional[str] = None, entrypoint: Optional[str] = None,
+            remove: bool = False, detach: bool = True) -> str:
+        """
+        Create and start a container.
+        volumes are "source:target[:mode]" strings, ports map host -> container.
+        Detached runs return the container ID; attached runs wait for the
+        command and return its stdout (raising if it exits non-zero).
+        """
+        raise NotImplementedError
+
+    def start(self, name: str):
+        raise NotImplementedError
+
+    def stop(self, name: str):
+        raise NotImplementedError
+
+    def remove(self, name: str, force: bool = False):
+        raise NotImplementedError
+
+    def exec(self, name: str, command: list) -> str:
+        """Run a command in a running container; returns stdout"""
+        raise NotImplementedError
+
+    def container_state(self, name: str) -> Optional[str]:
+        """'running', 'exited', ... or None if there is no such container"""
+        raise NotImplementedError
+
+    def container_address(self, name: str, network: str) -> str:
+        """The container's IP address on a network"""
+        raise NotImplementedError
+
+    def create_volume(self, name: str):
+        raise NotImplementedError
+
+    def remove_volume(self, name: str):
+        raise NotImplementedError
+
+    def list_volumes(self, prefix: str = "") -> list:
+        """Volume names, optionally only those starting with prefix"""
+        raise NotImplementedError
+
+    def inspect_volume(self, name: str) -> Optional[dict]:
+        """{name, driver, mountpoint, created} or None if there is no such volume"""
+        raise NotImplementedError
+
+    def ensure_network(self, name: str):
+        raise NotImplementedError
+
+    def image_id(self, image: str) -> Optional[str]:
+        """Content ID of a local image, None if it is not present"""
+        raise NotImplementedError
+
+    def image_info(self, image: str) -> Optional[dict]:
+        """{id, size_bytes, labels} of a local image, None if it is not present"""
+        raise NotImplementedError
+
+    def stats(self, name: str) -> dict:
+        """{cpu_percent, memory_bytes} snapshot for a running container"""
+        raise NotImplementedError
+
+    def events(self, event_type: str) -> EventStream:
+        """Subscribe to engine events of a type ('volume', 'container')"""
+        raise NotImplementedError
+
+    def discard(self, name: str) -> bool:
+        """Stop a container gracefully, then remove it; False if either step failed"""
+        ok = True
+        for step in (self.stop, self.remove):
+            try:
+                step(name)
+            except ContainerRuntimeError as e:
+                logger.warning(f"{step.__name__} {name} failed: {e}")
+                ok = False
+        return ok
+
+
+# ==================== CLI backend ====================
+
+class CliRuntime(ContainerRuntime):
+    """Docker-compatible CLI (docker or podman), one process per call and no shell"""
+
+    def __init__(self, binary: str = "docker"):
+        self.binary = binary
+        self.name = f"{binary}-cli"
+
+    def _run(self, *args, check: bool = True) -> subprocess.CompletedProcess:
+        result = run_docker([self.binary, *args], capture_output=True, text=True)
+        if check and result.returncode != 0:
+            raise ContainerRuntimeError(result.stderr.strip() or f"{self.binary} {args[0]} failed", result.stdout)
+        return result
+
+    def run(self, image, name=None, command=None, *, network=None, volumes=None, env=None, ports=None,
+            cpus=None, memory=None, user=None, entrypoint=None, remove=False, detach=True) -> str:
+        args = ["run"]
+        if detach:
+            args.append("-d")
+        if remove:
+            args.append("--rm")
+        if name:
+            args.extend(["--name", name])
+        if user:
+            args.extend(["--user", user])
+        if network:
+            args.extend(["--network", network])
+        if entrypoint:
+            args.extend(["--entrypoint", entrypoint])
+        for volume in volumes or []:
+            args.extend(["-v", volume])
+        for key, value in (env or {}).items():
+            args.extend(["-e", f"{key}={value}"])
+        for host_port, container_port in (ports or {}).items():
+            args.extend(["-p", f"{host_port}:{container_port}"])
+        if cpus:
+            args.extend(["--cpus", cpus])
+        if memory:
+            args.extend(["--memory", memory])
+        args.append(image)
+        args.extend(command or [])
+        output = self._run(*args).stdout
+        return output.strip() if detach else output
+
+    def start(self, name):
+        self._run("start", name)
+
+    def stop(self, name):
+        self._run("stop", name)
+
+    def remove(self, name, force=False):
+        self._run("rm", *(["-f"] if force else []), name)
+
+    def exec(self, name, command):
+        return self._run("exec", name, *command).stdout
+
+    def container_state(self, name):
+        result = self._run("inspect", "-f", "{{.State.Status}}", name, check=False)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def container_address(self, name, network):
+        return self._run(
+            "inspect", "-f", f'{{{{(index .NetworkSettings.Networks "{network}").IPAddress}}}}', name
+        ).stdout.strip()
+
+    def create_volume(self, name):
+        self._run("volume", "create", name)
+
+    def remove_volume(self, name):
+        self._run("volume", "rm", name)
+
+    def list_volumes(self, prefix=""):
+        args = ["volume", "ls", "-q"]
+        if prefix:
+            args.extend(["-f", f"name=^{prefix}"])
+        return [name for name in self._run(*args).stdout.split() if name.startswith(prefix)]
+
+    def inspect_volume(self, name):
+        result = self._run("volume", "inspect", name, check=False)
+        if result.returncode != 0:
+            return None
+        try:
+            volume = json.loads(result.stdout)[0]
+        except (json.JSONDecodeError, IndexError):
+            return None
+        return _volume_info(volume)
+
+    def ensure_network(self, name):
+        if self._run("network", "inspect", name, check=False).returncode != 0:
+            self._run("network", "create", name)
+
+    def image_id(self, image):
+        result = self._run("image", "inspect", "-f", "{{.Id}}", image, check=False)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def image_info(self, image):
+        result = self._run("image", "inspect", image, check=False)
+        if result.returncode != 0:
+            return None
+        try:
+            return _image_info(json.loads(result.stdout)[0])
+        except (json.JSONDecodeError, IndexError):
+            return None
+
+    def stats(self, name):
+        line = self._run("stats", "--no-stream", "--format", "{{json .}}", name).stdout
+        data = json.loads(line)
+        return {
+            "cpu_percent": float(data.get("CPUPerc", "0%").rstrip("%") or 0),
+            "memory_bytes": parse_size(data.get("MemUsage", "0B").split("/")[0]),
+        }
+
+    def events(self, event_type):
+        try:
+            proc = subprocess.Popen(
+                [self.binary, "events", "--filter", f"type={event_type}", "--format", "{{json .}}"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+            )
+        except OSError as e:
+            raise ContainerRuntimeError(f"{self.binary} events: {e}")
+
+        def read():
+            try:
+                for line in proc.stdout:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    yield _event_info(event)
+                raise ContainerRuntimeError(f"{self.binary} events exited with {proc.wait()}")
+            finally:
+                if proc.poll() is None:
+                    proc.terminate()
+
+        return EventStream(read(), on_close=proc.terminate)
+
+
+# ==================== Engine API backend ====================
+
+def _demux(data: bytes) -> tuple:
+    """Split a multiplexed attach/exec/logs stream into (stdout, stderr)"""
+    out, err, i = [], [], 0
+    while i + 8 <= len(data):
+        stream, size = data[i], struct.unpack(">I", data[i + 4:i + 8])[0]
+        (err if stream == 2 else out).append(data[i + 8:i + 8 + size])
+        i += 8 + size
+    return b"".join(out).decode(errors="replace"), b"".join(err).decode(errors="replace")
+
+
+class SocketRuntime(ContainerRuntime):
+    """Docker Engine API over a unix socket (dockerd, or Podman's compatible service)"""
+
+    def __init__(self, socket_path: str, name: str = "docker"):
+        self.name = name
+        self.socket_path = socket_path
+        self._client = httpx.Client(
+            transport=httpx.HTTPTransport(uds=socket_path),
+            base_url=f"http://localhost/{ENGINE_API_VERSION}",
+            timeout=httpx.Timeout(60, connect=5)
+        )
+
+    def _request(self, operation: str, method: str, path: str, ok=(200, 201, 204, 304), **kwargs):
+        """One timed API call; 404 is returned to the caller, other errors raise"""
+        started = time.perf_counter()
+        try:
+            resp = self._client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            DOCKER_OPERATION_FAILURES.labels(operation).inc()
+            raise ContainerRuntimeError(f"{self.name} {operation}: {e}")
+        finally:
+            DOCKER_OPERATION_SECONDS.labels(operation).observe(time.perf_counter() - started)
+        if resp.status_code not in ok and resp.status_code != 404:
+            DOCKER_OPERATION_FAILURES.labels(operation).inc()
+            raise ContainerRuntimeError(self._message(resp))
+        return resp
+
+    @staticmethod
+    def _message(resp) -> str:
+        try:
+            return resp.json().get("message", resp.text)
+        except ValueError:
+            return resp.text
+
+    def _expect(self, resp):
+        if resp.status_code == 404:
+            raise ContainerRuntimeError(self._message(resp))
+        return resp
+
+    def _create(self, image: str, name: Optional[str], body: dict) -> str:
+        params = {"name": name} if name else {}
+        resp = self._request("create", "POST", "/containers/create", params=params, json=body)
+        if resp.status_code == 404:
+            # Unlike the CLI, the API does not pull missing images on create
+            self._pull(image)
+            resp = self._expect(self._request("create", "POST", "/containers/create", params=params, json=body))
+        return resp.json()["Id"]
+
+    @staticmethod
+    def _split_reference(image: str) -> tuple:
+        """(repository, tag or digest) of an image reference; the tag defaults to latest like the CLI"""
+        if "@" in image:
+            return tuple(image.split("@", 1))
+        repository, _, tag = image.rpartition(":")
+        # A colon before the last slash belongs to a registry port (host:5000/app)
+        if not repository or "/" in tag:
+            return image, "latest"
+        return repository, tag
+
+    def _pull(self, image: str):
+        repository, tag = self._split_reference(image)
+        # Without a tag the API pulls every tag of the repository
+        resp = self._expect(self._request(
+            "pull", "POST", "/images/create", params={"fromImage": repository, "tag": tag}, timeout=None
+        ))
+        # The status is 200 once the pull starts; failures (unknown tag, auth,
+        # disk full) only show up in the JSON progress stream
+        for line in resp.text.splitlines():
+            try:
+                progress = json.loads(line)
+            except ValueError:
+                continue
+            if progress.get("error") or progress.get("errorDetail"):
+                DOCKER_OPERATION_FAILURES.labels("pull").inc()
+                message = progress.get("error") or progress["errorDetail"].get("message", "pull failed")
+                raise ContainerRuntimeError(f"{self.name} pull {image}: {message}")
+
+    def run(self, image, name=None, command=None, *, network=None, volumes=None, env=None, ports=None,
+            cpus=None, memory=None, user=None, entrypoint=None, remove=False, detach=True) -> str:
+        host_config = {"Binds": list(volumes or []), "AutoRemove": remove and detach}
+        if network:
+            host_config["NetworkMode"] = network
+        if ports:
+            host_config["PortBindings"] = {f"{c}/tcp": [{"HostPort": str(h)}] for h, c in ports.items()}
+        if cpus:
+            host_config["NanoCpus"] = int(float(cpus) * 1e9)
+        if memory:
+            host_config["Memory"] = parse_size(memory)
+        body = {
+            "Image": image,
+            "Env": [f"{key}={value}" for key, value in (env or {}).items()],
+            "ExposedPorts": {f"{c}/tcp": {} for c in (ports or {}).values()},
+            "HostConfig": host_config,
+        }
+        if command:
+            body["Cmd"] = list(command)
+        if entrypoint:
+            body["Entrypoint"] = [entrypoint]
+        if user:
+            body["User"] = user
+
+        container_id = self._create(image, name, body)
+        self._expect(self._request("run", "POST", f"/containers/{container_id}/start"))
+        if detach:
+            return container_id
+
+        try:
+            status = self._expect(self._request("wait", "POST", f"/containers/{container_id}/wait", timeout=None))
+            logs = self._request("logs", "GET", f"/containers/{container_id}/logs", params={"stdout": 1, "stderr": 1})
+            stdout, stderr = _demux(logs.content)
+        finally:
+            if remove:
+                self._request("rm", "DELETE", f"/containers/{container_id}", params={"force": "true"})
+        if status.json().get("StatusCode", 0) != 0:
+            raise ContainerRuntimeError(stderr.strip() or f"{image} exited with {status.json()['StatusCode']}", stdout)
+        return stdout
+
+    def start(self, name):
+        self._expect(self._request("start", "POST", f"/containers/{name}/start"))
+
+    def stop(self, name):
+        self._expect(self._request("stop", "POST", f"/containers/{name}/stop"))
+
+    def remove(self, name, force=False):
+        self._expect(self._request("rm", "DELETE", f"/containers/{name}", params={"force": str(force).lower()}))
+
+    def exec(self, name, command):
+        created = self._expect(self._request(
+            "exec", "POST", f"/containers/{name}/exec",
+            json={"Cmd": list(command), "AttachStdout": True, "AttachStderr": True}
+        )).json()["Id"]
+        output = self._request("exec", "POST", f"/exec/{created}/start", json={"Detach": False, "Tty": False}, timeout=None)
+        stdout, stderr = _demux(output.content)
+        exit_code = self._request("exec", "GET", f"/exec/{created}/json").json().get("ExitCode", 0)
+        if exit_code:
+            raise ContainerRuntimeError(stderr.strip() or f"exec exited with {exit_code}", stdout)
+        return stdout
+
+    def container_state(self, name):
+        resp = self._request("inspect", "GET", f"/containers/{name}/json")
+        return None if resp.status_code == 404 else resp.json()["State"]["Status"]
+
+    def container_address(self, name, network):
+        resp = self._expect(self._request("inspect", "GET", f"/containers/{name}/json"))
+        return resp.json()["NetworkSettings"]["Networks"][network]["IPAddress"]
+
+    def create_volume(self, name):
+        self._request("volume_create", "POST", "/volumes/create", json={"Name": name})
+
+    def remove_volume(self, name):
+        self._expect(self._request("volume_rm", "DELETE", f"/volumes/{name}"))
+
+    def list_volumes(self, prefix=""):
+        params = {"filters": json.dumps({"name": [prefix]})} if prefix else {}
+        volumes = self._request("volume_ls", "GET", "/volumes", params=params).json().get("Volumes") or []
+        return [v["Name"] for v in volumes if v["Name"].startswith(prefix)]
+
+    def inspect_volume(self, name):
+        resp = self._request("volume_inspect", "GET", f"/volumes/{name}")
+        return None if resp.status_code == 404 else _volume_info(resp.json())
+
+    def ensure_network(self, name):
+        if self._request("network_inspect", "GET", f"/networks/{name}").status_code == 404:
+            self._request("network_create", "POST", "/networks/create", json={"Name": name})
+
+    def image_id(self, image):
+        resp = self._request("image_inspect", "GET", f"/images/{image}/json")
+        return None if resp.status_code == 404 else resp.json()["Id"]
+
+    def image_info(self, image):
+        resp = self._request("image_inspect", "GET", f"/images/{image}/json")
+        return None if resp.status_code == 404 else _image_info(resp.json())
+
+    def stats(self, name):
+        data = self._expect(self._request("stats", "GET", f"/containers/{name}/stats", params={"stream": "false"})).json()
+        cpu, precpu = data.get("cpu_stats", {}), data.get("precpu_stats", {})
+        cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+        system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+        memory = data.get("memory_stats", {})
+        return {
+            "cpu_percent": round(cpu_delta / system_delta * cpu.get("online_cpus", 1) * 100, 2) if system_delta > 0 else 0.0,
+            "memory_bytes": memory.get("usage", 0) - memory.get("stats", {}).get("inactive_file", 0),
+        }
+
+    def events(self, event_type):
+        params = {"filters": json.dumps({"type": [event_type]})}
+        try:
+            request = self._client.build_request("GET", "/events", params=params, timeout=httpx.Timeout(None, connect=5))
+            resp = self._client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise ContainerRuntimeError(f"{self.name} events: {e}")
+        if resp.status_code != 200:
+            resp.read()
+            resp.close()
+            raise ContainerRuntimeError(self._message(resp))
+
+        def read():
+            try:
+                for line in resp.iter_lines():
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    yield _event_info(event)
+                raise ContainerRuntimeError(f"{self.name} closed the event stream")
+            finally:
+                resp.close()
+
+        def close():
+            # Shutting the socket down wakes the thread blocked reading it
+            stream = resp.extensions.get("network_stream")
+            sock = stream.get_extra_info("socket") if stream else None
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+
+        return EventStream(read(), on_close=close)
+
+
+def _volume_info(volume: dict) -> dict:
+    return {
+        "name": volume.get("Name"),
+        "driver": volume.get("Driver"),
+        "mountpoint": volume.get("Mountpoint"),
+        "created": volume.get("CreatedAt")
+    }
+
+
+def _image_info(image: dict) -> dict:
+    return {
+        "id": image.get("Id"),
+        "size_bytes": image.get("Size", 0),
+        "labels": (image.get("Config") or {}).get("Labels") or {}
+    }
+
+
+def _event_info(event: dict) -> dict:
+    actor = event.get("Actor", {})
+    return {
+        "type": event.get("Type"),
+        "action": event.get("Action"),
+        "name": actor.get("Attributes", {}).get("name") or actor.get("ID"),
+    }
+
+
+# ==================== In-memory backend ====================
+
+class MemoryRuntime(ContainerRuntime):
+    """
+    Containers, volumes and networks as plain dicts. Commands never run:
+    exec and attached runs return "". Subclasses can override _operation
+    to add latency or failures (see bench/fake_docker.py).
+    """
+
+    name = "memory"
+
+    def __init__(self, images: Optional[dict] = None):
+        self.containers = {}  # name -> {id, image, state, networks, volumes, env}
+        self.volumes = {}     # name -> created_at
+        self.networks = {"bridge", "none"}
+        self.images = dict(images or {})  # image -> id; missing images are "pulled" on run
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def _operation(self, operation: str):
+        """Called before every operation"""
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _emit(self, event_type: str, action: str, name: str):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener.put({"type": event_type, "action": action, "name": name})
+
+    def _container(self, name: str) -> dict:
+        container = self.containers.get(name)
+        if container is None:
+            raise ContainerRuntimeError(f"No such container: {name}")
+        return container
+
+    def run(self, image, name=None, command=None, *, network=None, volumes=None, env=None, ports=None,
+            cpus=None, memory=None, user=None, entrypoint=None, remove=False, detach=True) -> str:
+        self._operation("run")
+        container_id = os.urandom(32).hex()
+        with self._lock:
+            name = name or container_id[:12]
+            if name in self.containers:
+                raise ContainerRuntimeError(f'Conflict. The container name "/{name}" is already in use')
+            self.images.setdefault(image, "sha256:" + os.urandom(32).hex())
+            # Named volumes are created on first mount, like the engine does
+            new_volumes = [
+                volume.split(":", 1)[0] for volume in volumes or []
+                if not volume.startswith("/") and volume.split(":", 1)[0] not in self.volumes
+            ]
+            for volume in new_volumes:
+                self.volumes[volume] = time.time()
+            if detach:
+                index = len(self.containers)
+                self.containers[name] = {
+                    "id": container_id,
+                    "image": image,
+                    "state": "running",
+                    "networks": {network or "bridge": f"172.30.{index // 250 % 250}.{index % 250 + 2}"},
+                    "volumes": list(volumes or []),
+                    "env": dict(env or {}),
+                }
+        for volume in new_volumes:
+            self._emit("volume", "create", volume)
+        if not detach:
+            return ""
+        self._emit("container", "start", name)
+        return container_id
+
+    def start(self, name):
+        self._operation("start")
+        with self._lock:
+            self._container(name)["state"] = "running"
+
+    def stop(self, name):
+        self._operation("stop")
+        with self._lock:
+            self._container(name)["state"] = "exited"
+
+    def remove(self, name, force=False):
+        self._operation("rm")
+        with self._lock:
+            if self._container(name)["state"] == "running" and not force:
+                raise ContainerRuntimeError(f"cannot remove running container {name}")
+            del self.containers[name]
+        self._emit("container", "destroy", name)
+
+    def exec(self, name, command):
+        self._operation("exec")
+        with self._lock:
+            if self._container(name)["state"] != "running":
+                raise ContainerRuntimeError(f"container {name} is not running")
+        return ""
+
+    def container_state(self, name):
+        self._operation("inspect")
+        with self._lock:
+            container = self.containers.get(name)
+            return container["state"] if container else None
+
+    def container_address(self, name, network):
+        self._operation("inspect")
+        with self._lock:
+            address = self._container(name)["networks"].get(network)
+        if address is None:
+            raise ContainerRuntimeError(f"container {name} is not on network {network}")
+        return address
+
+    def create_volume(self, name):
+        self._operation("volume_create")
+        with self._lock:
+            created = name not in self.volumes
+            self.volumes.setdefault(name, time.time())
+        if created:
+            self._emit("volume", "create", name)
+
+    def remove_volume(self, name):
+        self._operation("volume_rm")
+        with self._lock:
+            if name not in self.volumes:
+                raise ContainerRuntimeError(f"no such volume: {name}")
+            del self.volumes[name]
+        self._emit("volume", "destroy", name)
+
+    def list_volumes(self, prefix=""):
+        self._operation("volume_ls")
+        with self._lock:
+            return sorted(name for name in self.volumes if name.startswith(prefix))
+
+    def inspect_volume(self, name):
+        self._operation("volume_inspect")
+        with self._lock:
+            if name not in self.volumes:
+                return None
+            return {
+                "name": name,
+                "driver": "local",
+                "mountpoint": f"/var/lib/docker/volumes/{name}/_data",
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.volumes[name]))
+            }
+
+    def ensure_network(self, name):
+        self._operation("network_inspect")
+        with self._lock:
+            self.networks.add(name)
+
+    def image_id(self, image):
+        self._operation("image_inspect")
+        with self._lock:
+            return self.images.get(image)
+
+    def image_info(self, image):
+        self._operation("image_inspect")
+        with self._lock:
+            image_id = self.images.get(image)
+        return {"id": image_id, "size_bytes": 0, "labels": {}} if image_id else None
+
+    def stats(self, name):
+        self._operation("stats")
+        with self._lock:
+            self._container(name)
+        return {"cpu_percent": 0.0, "memory_bytes": 0}
+
+    def events(self, event_type):
+        listener = queue.Queue()
+        with self._lock:
+            self._listeners.append(listener)
+
+        def unsubscribe():
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+
+        def read():
+            try:
+                while True:
+                    event = listener.get()
+                    if event is None:
+                        return
+                    if event["type"] == event_type:
+                        yield event
+            finally:
+                unsubscribe()
+
+        def close():
+            unsubscribe()
+            listener.put(None)
+
+        return EventStream(read(), on_close=close)
+
+
+# ==================== Selection ====================
+
+_runtime: Optional[ContainerRuntime] = None
+_runtime_lock = threading.Lock()
+
+
+def cli_binary() -> str:
+    """CLI for the streaming helpers that still shell out (home volume archives)"""
+    return "podman" if CONTAINER_RUNTIME.startswith("podman") else "docker"
+
+
+def create_runtime(kind: str) -> ContainerRuntime:
+    if kind == "docker-cli":
+        return CliRuntime("docker")
+    if kind == "podman-cli":
+        return CliRuntime("podman")
+    if kind == "docker":
+        return SocketRuntime(DOCKER_SOCKET, "docker")
+    if kind == "podman":
+        runtime_dir = os.getenv("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}"
+        return SocketRuntime(PODMAN_SOCKET or os.path.join(runtime_dir, "podman", "podman.sock"), "podman")
+    if kind == "memory":
+        return MemoryRuntime()
+    raise ValueError(f"Unknown CONTAINER_RUNTIME {kind!r}")
+
+
+def get_runtime() -> ContainerRuntime:
+    """The process-wide runtime (created from CONTAINER_RUNTIME on first use)"""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = create_runtime(CONTAINER_RUNTIME)
+                logger.info(f"Using container runtime {_runtime.name}")
+    return _runtime
+
+
+def set_runtime(runtime: ContainerRuntime):
+    """Swap the runtime (tests, benchmarks)"""
+    global _runtime
+    _runtime = runtime
@@ -0,0 +1,86 @@
+"""
+Coordination Module
+Mongo-backed leases shared by every API worker and node. A single
+"leader" lease decides which process runs the singleton background jobs
+(archiver, maintenance, scanners, lab reaper); other workers keep their
+threads idle until they win the lease.
+"""
+import os
+import socket
+import uuid
+import threading
+import logging
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from app.db import leases
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", "15"))
+LEADER_RENEW_SECONDS = int(os.getenv("LEADER_RENEW_SECONDS", "5"))
+
+# Identifies this process as a lease owner
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+LEADER_LEASE = "leader"
+
+_leader = threading.Event()
+
+
+def acquire_lease(name: str, ttl_seconds: int, owner: str = OWNER_ID) -> bool:
+    """Take or renew a lease; False while another owner holds an unexpired one"""
+    now = datetime.utcnow()
+    try:
+        leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl_seconds), "renewed_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The upsert collided with a live lease held by someone else
+        return False
+
+
+def release_lease(name: str, owner: str = OWNER_ID):
+    leases.delete_one({"_id": name, "owner": owner})
+
+
+def get_lease(name: str):
+    return leases.find_one({"_id": name})
+
+
+def is_leader() -> bool:
+    """Whether this process currently holds the leader lease"""
+    return _leader.is_set()
+
+
+def _campaign():
+    try:
+        won = acquire_lease(LEADER_LEASE, LEADER_LEASE_SECONDS)
+    except PyMongoError as e:
+        logger.error(f"Leader lease renewal failed: {e}")
+        won = False
+    if won and not _leader.is_set():
+        logger.info(f"{OWNER_ID} became leader")
+        _leader.set()
+    elif not won and _leader.is_set():
+        logger.warning(f"{OWNER_ID} lost leadership")
+        _leader.clear()
+
+
+def election_loop(stop_event: threading.Event):
+    while not stop_event.wait(LEADER_RENEW_SECONDS):
+        _campaign()
+    if _leader.is_set():
+        _leader.clear()
+        release_lease(LEADER_LEASE)
+
+
+def start_leader_election() -> threading.Event:
+    """Campaign once now, then keep renewing in a thread; returns the event that stops it"""
+    _campaign()
+    stop_event = threading.Event()
+    threading.Thread(target=election_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
@@ -1,7 +1,11 @@
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import os
+from datetime import datetime
 from dotenv import load_dotenv
 
+from app.metrics import mongo_command_metrics, METRICS_ENABLED
+
 # Load environment variables
 load_dotenv()
 
@@ -9,7 +13,7 @@ load_dotenv()
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "selfmade_labs")
 
-client = MongoClient(MONGODB_URL)
+client = MongoClient(MONGODB_URL, event_listeners=[mongo_command_metrics] if METRICS_ENABLED else [])
 db = client[DATABASE_NAME]
 
 # Collections
@@ -20,6 +24,111 @@ notifications = db["notifications"]
 audit_logs = db["audit_logs"]
 lab_catalog = db["lab_catalog"]
 service_catalog = db["service_catalog"]
+user_cache_versions = db["user_cache_versions"]
+system_flags = db["system_flags"]
+oidc_cache = db["oidc_cache"]
+events = db["events"]
+notification_counters = db["notification_counters"]
+broadcasts = db["broadcasts"]
+volume_usage = db["volume_usage"]
+home_templates = db["home_templates"]
+volume_templates = db["volume_templates"]
+lab_readiness = db["lab_readiness"]
+leases = db["leases"]
+idempotency_keys = db["idempotency_keys"]
+image_builds = db["image_builds"]
+
+
+def ensure_ttl_index(collection, keys, name: str, expire_after_seconds: int, **kwargs):
+    """Create a TTL index, or update its expiry in place (collMod) when the retention setting changed"""
+    existing = collection.index_information().get(name)
+    if existing and existing.get("expireAfterSeconds") != expire_after_seconds:
+        db.command("collMod", collection.name, index={"name": name, "expireAfterSeconds": expire_after_seconds})
+        return
+    collection.create_index(keys, name=name, expireAfterSeconds=expire_after_seconds, **kwargs)
+
+
+def merge_duplicate_users() -> int:
+    """Fold accounts sharing an email (from before the unique index) into the oldest one"""
+    duplicates = users.aggregate([
+        {"$match": {"email": {"$type": "string"}}},
+        {"$group": {"_id": "$email", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    merged = 0
+    for group in duplicates:
+        accounts = sorted(users.find({"_id": {"$in": group["ids"]}}), key=lambda u: (u.get("created_at") or datetime.max, u["_id"]))
+        keep, extras = accounts[0], accounts[1:]
+
+        # Fields only a newer duplicate has are carried over; admin wins over user
+        update = {}
+        for extra in extras:
+            for field, value in extra.items():
+                if field != "_id" and field not in keep and field not in update:
+                    update[field] = value
+        if any(account.get("role") == "admin" for account in accounts):
+            update["role"] = "admin"
+        logins = [account["last_login"] for account in accounts if account.get("last_login")]
+        if logins:
+            update["last_login"] = max(logins)
+
+        if update:
+            users.update_one({"_id": keep["_id"]}, {"$set": update})
+        users.delete_many({"_id": {"$in": [extra["_id"] for extra in extras]}})
+        merged += len(extras)
+        print(f"[OK] Merged {len(extras)} duplicate account(s) into {group['_id']}")
+    return merged
+
+
+# One account per email; login upserts rely on this. Deployments from before
+# the index can hold duplicates, which would make the index build fail.
+if "email_1" not in users.index_information():
+    merge_duplicate_users()
+users.create_index("email", unique=True)
+
+# Existing deployments already had their first user (and admin)
+if users.count_documents({}, limit=1):
+    system_flags.update_one({"_id": "first_admin"}, {"$set": {"claimed": True}}, upsert=True)
+
+# Indexes for live-state lookups on the hot collections
+lab_instances.create_index([("user_email", 1), ("status", 1)])
+service_instances.create_index([("user_email", 1), ("status", 1)])
+
+# Atomic claims: at most one active instance per user and lab/service, and one
+# tenant per Redis DB number. "active" is set while an instance is starting or
+# running and unset when it finishes, so concurrent workers cannot double-start.
+lab_instances.update_many(
+    {"status": {"$in": ["starting", "running"]}, "active": {"$exists": False}},
+    {"$set": {"active": True}}
+)
+service_instances.update_many(
+    {"status": "running", "active": {"$exists": False}},
+    {"$set": {"active": True}}
+)
+# Redis tenants from before the claims only recorded their DB number in the credentials
+service_instances.update_many(
+    {"service": "redis", "redis_db": {"$exists": False}, "credentials.database": {"$type": "int"}},
+    [{"$set": {"redis_db": "$credentials.database"}}]
+)
+try:
+    lab_instances.create_index(
+        [("user_email", 1), ("lab", 1)],
+        unique=True, partialFilterExpression={"active": True}, name="one_active_lab"
+    )
+    service_instances.create_index(
+        [("user_email", 1), ("service", 1)],
+        unique=True, partialFilterExpression={"active": True}, name="one_active_service"
+    )
+    service_instances.create_index(
+        [("service", 1), ("redis_db", 1)],
+        unique=True, partialFilterExpression={"active": True, "redis_db": {"$exists": True}}, name="one_tenant_per_redis_db"
+    )
+except OperationFailure as e:
+    # Without these indexes concurrent starts would double-book labs and Redis DBs
+    print(f"[ERROR] Could not create active-instance claim indexes: {e}")
+    raise RuntimeError(
+        "Duplicate active instances from before the claims existed; stop them and restart"
+    ) from e
 
 # Seed Lab Catalog if empty
 if lab_catalog.count_documents({}) == 0:
@@ -0,0 +1,127 @@
+"""
+Event Bus Module
+In-process pub/sub of per-user lab, service and notification events,
+consumed by the /events/stream SSE endpoint. With EVENT_BRIDGE_ENABLED
+every event is also written to the events collection and a change-stream
+bridge delivers events published by other workers.
+"""
+import os
+import uuid
+import asyncio
+import threading
+import logging
+from datetime import datetime
+from pymongo.errors import PyMongoError
+
+from app.db import events
+
+logger = logging.getLogger(__name__)
+
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+EVENT_BRIDGE_ENABLED = os.getenv("EVENT_BRIDGE_ENABLED", "false").lower() == "true"
+
+# Identifies events published by this process on the bridge
+WORKER_ID = uuid.uuid4().hex
+
+# Recipient that fans an event out to every connected user
+ALL_USERS = "*"
+
+if EVENT_BRIDGE_ENABLED:
+    events.create_index("created_at", expireAfterSeconds=3600)
+
+
+class EventBus:
+    """Fan-out of events to the asyncio queues of connected clients"""
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}  # user_email -> {queue: loop}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_email: str) -> asyncio.Queue:
+        """Register a queue for a user (call from the event loop)"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_email, {})[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, user_email: str, queue: asyncio.Queue):
+        with self._lock:
+            queues = self._subscribers.get(user_email, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(user_email, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+    def deliver(self, user_email: str, event: dict):
+        """Hand an event to every subscriber of a user (or ALL_USERS); safe from any thread"""
+        with self._lock:
+            if user_email == ALL_USERS:
+                targets = [item for queues in self._subscribers.values() for item in queues.items()]
+            else:
+                targets = list(self._subscribers.get(user_email, {}).items())
+        for queue, loop in targets:
+            loop.call_soon_threadsafe(_put_latest, queue, event)
+
+
+def _put_latest(queue: asyncio.Queue, event: dict):
+    # Events are change signals; a slow client only needs the newest ones
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+event_bus = EventBus()
+
+
+def publish_event(user_email: str, event_type: str, data: dict = None):
+    """Publish a state change for a user to live subscribers"""
+    event = {
+        "type": event_type,
+        "data": data or {},
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    event_bus.deliver(user_email, event)
+
+    if EVENT_BRIDGE_ENABLED:
+        try:
+            events.insert_one({
+                "user_email": user_email,
+                "event": event,
+                "origin": WORKER_ID,
+                "created_at": datetime.utcnow()
+            })
+        except PyMongoError as e:
+            logger.error(f"Failed to bridge event {event_type}: {e}")
+
+
+# ==================== Change-Stream Bridge ====================
+
+def bridge_loop(stop_event: threading.Event):
+    """Deliver events inserted by other workers (requires a replica set)"""
+    pipeline = [{"$match": {
+        "operationType": "insert",
+        "fullDocument.origin": {"$ne": WORKER_ID}
+    }}]
+    while not stop_event.is_set():
+        try:
+            with events.watch(pipeline, max_await_time_ms=1000) as stream:
+                while not stop_event.is_set():
+                    change = stream.try_next()
+                    if change:
+                        doc = change["fullDocument"]
+                        event_bus.deliver(doc["user_email"], doc["event"])
+        except PyMongoError as e:
+            logger.error(f"Event bridge change stream failed: {e}")
+            stop_event.wait(5)
+
+
+def start_event_bridge():
+    """Start the change-stream bridge if enabled, returns its stop event"""
+    stop_event = threading.Event()
+    if EVENT_BRIDGE_ENABLED:
+        threading.Thread(target=bridge_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
@@ -0,0 +1,185 @@
+"""
+Home Templates Module
+Prebuilt, versioned copies of each lab image's /home/labuser kept in
+template volumes (home_template_{lab_id}_{version}). New user volumes are
+seeded from them in one bulk copy; existing volumes pick up newer
+template versions with a no-clobber copy that leaves user files alone.
+The current template is mirrored into its lab_catalog entry, so a lab
+start gets it with the catalog lookup. A superseded template volume is
+only removed after a grace period, once no copy can still be reading it.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from app.db import lab_catalog, home_templates, volume_templates
+from app.container_runtime import get_runtime, ContainerRuntimeError
+
+logger = logging.getLogger(__name__)
+
+HOME_TEMPLATE_PATH = os.getenv("HOME_TEMPLATE_PATH", "/home/labuser")
+HOME_TEMPLATE_COPY_IMAGE = os.getenv("HOME_TEMPLATE_COPY_IMAGE", "alpine:3.19")
+# How long a superseded template volume is kept for copies that started from it
+HOME_TEMPLATE_RETIRE_SECONDS = int(os.getenv("HOME_TEMPLATE_RETIRE_SECONDS", "600"))
+
+# volume name -> {lab_id: template version applied}; only ever behind Mongo,
+# which costs a redundant no-clobber copy, never a missed one
+_applied_versions = {}
+
+
+def get_image_version(image: str) -> Optional[str]:
+    """Short content ID of a local image, None if it is not present"""
+    image_id = get_runtime().image_id(image)
+    if not image_id:
+        return None
+    return image_id.split(":")[-1][:12]
+
+
+def _remove_volume(volume: str):
+    try:
+        get_runtime().remove_volume(volume)
+    except ContainerRuntimeError as e:
+        logger.warning(f"Failed to remove template volume {volume}: {e}")
+
+
+def build_home_template(lab_id: str, force: bool = False) -> Optional[dict]:
+    """Copy the lab image's home directory into a template volume for its current version"""
+    lab_config = lab_catalog.find_one({"id": lab_id})
+    if not lab_config:
+        return None
+
+    version = get_image_version(lab_config["image"])
+    if not version:
+        logger.warning(f"Image {lab_config['image']} not present, skipping home template for {lab_id}")
+        return None
+
+    current = home_templates.find_one({"_id": lab_id}, {"retired": 0})
+    if current and current["version"] == version and not force:
+        if (lab_config.get("home_template") or {}).get("volume") != current["volume"]:
+            # Built before templates were mirrored into the catalog
+            lab_catalog.update_one({"id": lab_id}, {"$set": {"home_template": current}})
+        return current
+
+    volume = f"home_template_{lab_id.replace('-', '_')}_{version}"
+    try:
+        get_runtime().run(
+            lab_config["image"], command=["-a", f"{HOME_TEMPLATE_PATH}/.", "/template/"],
+            entrypoint="cp", user="root", network="none",
+            volumes=[f"{volume}:/template"], remove=True, detach=False
+        )
+    except ContainerRuntimeError as e:
+        logger.warning(f"No home template for {lab_id}: {e}")
+        if not current or current["volume"] != volume:
+            _remove_volume(volume)
+        return None
+
+    template = {
+        "_id": lab_id,
+        "version": version,
+        "volume": volume,
+        "image": lab_config["image"],
+        "built_at": datetime.utcnow()
+    }
+    if not _swap_template(current, template):
+        winner = home_templates.find_one({"_id": lab_id})
+        logger.info(f"Home template for {lab_id} was replaced concurrently, keeping {winner['volume']}")
+        if winner["volume"] != volume:
+            _remove_volume(volume)
+        return winner
+
+    lab_catalog.update_one({"id": lab_id}, {"$set": {"home_template": template}})
+    remove_retired_templates(lab_id)
+    logger.info(f"Built home template {volume} for {lab_id}")
+    return template
+
+
+def _swap_template(current: Optional[dict], template: dict) -> bool:
+    """Replace the template current was read from; False if another build got there first"""
+    if current is None:
+        try:
+            home_templates.insert_one(template)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    update = {"$set": {key: value for key, value in template.items() if key != "_id"}}
+    if current["volume"] != template["volume"]:
+        # Copies that looked the old template up may still be reading it
+        update["$push"] = {"retired": {"volume": current["volume"], "retired_at": template["built_at"]}}
+    result = home_templates.update_one({"_id": current["_id"], "volume": current["volume"]}, update)
+    return result.matched_count == 1
+
+
+def remove_retired_templates(lab_id: str):
+    """Remove superseded template volumes of a lab once their grace period is over"""
+    template = home_templates.find_one({"_id": lab_id}, {"retired": 1}) or {}
+    cutoff = datetime.utcnow() - timedelta(seconds=HOME_TEMPLATE_RETIRE_SECONDS)
+    runtime = get_runtime()
+    for retired in template.get("retired", []):
+        if retired["retired_at"] > cutoff:
+            continue
+        if runtime.inspect_volume(retired["volume"]) is not None:
+            try:
+                runtime.remove_volume(retired["volume"])
+            except ContainerRuntimeError as e:
+                # Still mounted by a copy; tried again on the next build
+                logger.warning(f"Keeping retired template volume {retired['volume']}: {e}")
+                continue
+        home_templates.update_one({"_id": lab_id}, {"$pull": {"retired": {"volume": retired["volume"]}}})
+
+
+def build_all_home_templates(force: bool = False) -> dict:
+    """Build templates for every catalog lab whose image is available"""
+    templates = {}
+    for lab in lab_catalog.find({}, {"id": 1}):
+        templates[lab["id"]] = build_home_template(lab["id"], force=force)
+        # Unchanged templates return early, so sweep their retired volumes here
+        remove_retired_templates(lab["id"])
+    return templates
+
+
+def _copy_template(template: dict, volume_name: str, overwrite: bool) -> bool:
+    flags = "-a" if overwrite else "-an"
+    try:
+        get_runtime().run(
+            HOME_TEMPLATE_COPY_IMAGE, command=["cp", flags, "/from/.", "/to/"], network="none",
+            volumes=[f"{template['volume']}:/from:ro", f"{volume_name}:/to"], remove=True, detach=False
+        )
+    except ContainerRuntimeError as e:
+        logger.error(f"Failed to copy template {template['volume']} into {volume_name}: {e}")
+        return False
+    volume_templates.update_one(
+        {"_id": volume_name},
+        {"$set": {f"applied.{template['_id']}": template["version"]}},
+        upsert=True
+    )
+    _applied_versions.setdefault(volume_name, {})[template["_id"]] = template["version"]
+    return True
+
+
+def seed_volume(volume_name: str, template: dict) -> bool:
+    """Populate a freshly created volume from a lab's template (its catalog home_template) in one copy"""
+    _applied_versions.pop(volume_name, None)
+    return _copy_template(template, volume_name, overwrite=True)
+
+
+def update_volume_from_template(volume_name: str, template: dict) -> bool:
+    """Copy files added by a newer template version without touching existing files"""
+    applied = _applied_versions.get(volume_name)
+    if applied is None:
+        # First start of this volume on this worker
+        applied = (volume_templates.find_one({"_id": volume_name}) or {}).get("applied", {})
+        _applied_versions[volume_name] = applied
+    if applied.get(template["_id"]) == template["version"]:
+        return False
+    return _copy_template(template, volume_name, overwrite=False)
+
+
+def forget_volume(volume_name: str):
+    """Drop a deleted volume's applied template versions"""
+    _applied_versions.pop(volume_name, None)
+    volume_templates.delete_one({"_id": volume_name})
@@ -0,0 +1,107 @@
+"""
+Shared HTTP Client Module
+One keep-alive httpx.AsyncClient per process, opened in the app lifespan,
+a transport that lets Authlib's own OAuth clients send through its
+connection pool, plus a Mongo-backed cache for OIDC discovery/JWKS documents so every
+worker does not refetch them from the provider.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+from app.db import oidc_cache
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "10"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+OIDC_CACHE_HOURS = int(os.getenv("OIDC_CACHE_HOURS", "24"))
+
+_client: Optional[httpx.AsyncClient] = None
+_transport: Optional[httpx.AsyncHTTPTransport] = None
+
+
+def start_http_client() -> httpx.AsyncClient:
+    """Create the shared client (called from the lifespan)"""
+    global _client, _transport
+    _transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE
+        )
+    )
+    _client = httpx.AsyncClient(timeout=HTTP_TIMEOUT_SECONDS, transport=_transport)
+    return _client
+
+
+async def close_http_client():
+    global _client, _transport
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        _transport = None
+
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """
+    Sends through the shared client's connection pool. Authlib builds and
+    closes its own AsyncOAuth2Client for every token exchange; given this
+    transport (client_kwargs={"transport": ...}) that client reuses our
+    keep-alive connections, and closing it leaves the pool open.
+    """
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if _transport is None:
+            start_http_client()
+        return await _transport.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared client; lazily created when running outside the lifespan"""
+    if _client is None:
+        return start_http_client()
+    return _client
+
+
+async def fetch_cached_json(url: str) -> dict:
+    """Fetch a JSON document, sharing the result across workers through Mongo"""
+    cached = await run_in_threadpool(oidc_cache.find_one, {"_id": url})
+    if cached and cached["fetched_at"] > datetime.utcnow() - timedelta(hours=OIDC_CACHE_HOURS):
+        return cached["document"]
+
+    resp = await get_http_client().get(url)
+    resp.raise_for_status()
+    document = resp.json()
+    await run_in_threadpool(
+        oidc_cache.update_one,
+        {"_id": url},
+        {"$set": {"document": document, "fetched_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return document
+
+
+async def load_oidc_metadata(client_app, metadata_url: str):
+    """Seed an Authlib client with cached discovery and JWKS documents, again once they are OIDC_CACHE_HOURS old"""
+    loaded_at = client_app.server_metadata.get("_loaded_at")
+    if loaded_at and time.time() - loaded_at < OIDC_CACHE_HOURS * 3600:
+        return
+    try:
+        metadata = await fetch_cached_json(metadata_url)
+        if metadata.get("jwks_uri"):
+            metadata["jwks"] = await fetch_cached_json(metadata["jwks_uri"])
+    except (httpx.HTTPError, ValueError) as e:
+        # Keep what the client has; Authlib fetches on first use if it has nothing
+        logger.warning(f"Failed to load OIDC metadata from {metadata_url}: {e}")
+        return
+
+    client_app.server_metadata.update(metadata)
+    client_app.server_metadata["_loaded_at"] = time.time()
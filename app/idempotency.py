@@ -0,0 +1,123 @@
+"""
+Idempotency Module
+Deduplicates start/stop requests. Requests for the same (operation, user,
+resource) share one in-flight execution: duplicates in this process await
+the same future, duplicates on other workers wait on a Mongo lease and
+pick up the stored result. With an Idempotency-Key header the result is
+also kept for IDEMPOTENCY_TTL_SECONDS so client retries replay it.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from app.db import idempotency_keys
+from app.coordination import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# Longest a start may run before another worker is allowed to take over
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "180"))
+# How long a finished result stays joinable by requests that were waiting on it
+JOIN_WINDOW_SECONDS = 30
+POLL_SECONDS = 0.2
+
+idempotency_keys.create_index("expires_at", expireAfterSeconds=0)
+
+_inflight = {}  # lock key -> asyncio.Future
+
+
+def _store(key: str, result: dict, ttl_seconds: int):
+    now = datetime.utcnow()
+    idempotency_keys.replace_one(
+        {"_id": key},
+        {"result": result, "completed_at": now, "expires_at": now + timedelta(seconds=ttl_seconds)},
+        upsert=True
+    )
+
+
+def _stored_result(key: str, completed_after: datetime = None) -> Optional[dict]:
+    query = {"_id": key}
+    if completed_after:
+        query["completed_at"] = {"$gte": completed_after}
+    doc = idempotency_keys.find_one(query)
+    return doc["result"] if doc else None
+
+
+async def _finished_result(lock_key: str, record_key: Optional[str], waiting_since: datetime) -> Optional[dict]:
+    result = await run_in_threadpool(_stored_result, lock_key, waiting_since)
+    if result is None and record_key:
+        result = await run_in_threadpool(_stored_result, record_key)
+    return result
+
+
+async def _wait_for_other_worker(lock_key: str, record_key: Optional[str]) -> Optional[dict]:
+    """Take the cross-worker lease, or return the result another worker produced meanwhile"""
+    lease = f"inflight:{lock_key}"
+    waiting_since = datetime.utcnow()
+    waited = False
+    while not await run_in_threadpool(acquire_lease, lease, IDEMPOTENCY_LOCK_SECONDS):
+        waited = True
+        await asyncio.sleep(POLL_SECONDS)
+        result = await _finished_result(lock_key, record_key, waiting_since)
+        if result is not None:
+            return result
+    if waited:
+        # The holder may have stored its result and released between two polls
+        result = await _finished_result(lock_key, record_key, waiting_since)
+        if result is not None:
+            await run_in_threadpool(release_lease, lease)
+            return result
+    return None
+
+
+async def run_once(
+    operation: str,
+    user_email: str,
+    resource: str,
+    work: Callable[[], Awaitable[dict]],
+    idempotency_key: Optional[str] = None
+) -> dict:
+    """Run work() once per concurrent (operation, user, resource) and per idempotency key"""
+    lock_key = f"{operation}:{user_email}:{resource}"
+    # A key reused for another operation or resource must not replay this one's result
+    record_key = f"{lock_key}:{idempotency_key}" if idempotency_key else None
+
+    if record_key:
+        replay = await run_in_threadpool(_stored_result, record_key)
+        if replay is not None:
+            return replay
+
+    pending = _inflight.get(lock_key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[lock_key] = future
+    lease_held = False
+    try:
+        result = await _wait_for_other_worker(lock_key, record_key)
+        if result is None:
+            lease_held = True
+            result = await work()
+            await run_in_threadpool(_store, lock_key, result, JOIN_WINDOW_SECONDS)
+            if record_key:
+                await run_in_threadpool(_store, record_key, result, IDEMPOTENCY_TTL_SECONDS)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Nobody may be awaiting the future; mark the exception as retrieved
+        future.exception()
+        raise
+    finally:
+        _inflight.pop(lock_key, None)
+        if lease_held:
+            await run_in_threadpool(release_lease, f"inflight:{lock_key}")
@@ -0,0 +1,275 @@
+"""
+Image Builder Module
+Builds the lab images from labs/*/Dockerfile in parallel. Each image is
+labelled with a hash of its build context (plus the hashes of the shared
+images it builds on), so a context that has not changed since the local
+image was built is skipped. Directories starting with "_" hold shared
+stages (e.g. the ttyd binary) that are built first and copied into the
+lab images. Build duration and image size are recorded per lab, and the
+home templates of rebuilt labs are refreshed so start_lab seeds volumes
+from the new image. The command line also works before MongoDB is up
+(e.g. on a fresh checkout): images are then built without recording.
+
+    python -m app.image_builder [--force] [lab ...]
+"""
+import os
+import re
+import sys
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+import subprocess
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# app.db connects (and migrates) on import, so the Mongo-backed modules are
+# imported where they are used; .env is loaded here for the runtime settings
+load_dotenv()
+
+from app.container_runtime import get_runtime, cli_binary
+from app.metrics import run_docker, IMAGE_BUILD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LABS_DIR = os.getenv("LABS_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "labs"))
+LAB_IMAGE_PREFIX = os.getenv("LAB_IMAGE_PREFIX", "selfmade")
+IMAGE_BUILD_CONCURRENCY = int(os.getenv("IMAGE_BUILD_CONCURRENCY", "4"))
+IMAGE_BUILD_TIMEOUT_SECONDS = int(os.getenv("IMAGE_BUILD_TIMEOUT_SECONDS", "3600"))
+
+CONTEXT_HASH_LABEL = "selfmade.context-hash"
+IMAGE_BUILD_LEASE = "image-build"
+LOG_TAIL_LINES = 40
+
+
+def image_name(context_name: str) -> str:
+    return f"{LAB_IMAGE_PREFIX}/{context_name.lstrip('_')}:latest"
+
+
+def discover_contexts(labs_dir: str = LABS_DIR) -> dict:
+    """Build contexts by name, each with its image and the contexts it builds on"""
+    contexts = {}
+    for name in sorted(os.listdir(labs_dir)):
+        dockerfile = os.path.join(labs_dir, name, "Dockerfile")
+        if os.path.isfile(dockerfile):
+            with open(dockerfile) as f:
+                contexts[name] = {"path": os.path.dirname(dockerfile), "image": image_name(name), "text": f.read()}
+
+    for name, context in contexts.items():
+        # FROM / COPY --from= references to images built from another context
+        context["deps"] = sorted(
+            other for other, dep in contexts.items()
+            if other != name and re.search(rf"{re.escape(dep['image'].rsplit(':', 1)[0])}(:latest)?\b", context["text"])
+        )
+    return contexts
+
+
+def build_order(contexts: dict) -> list:
+    """Waves of context names; every context comes after the ones it builds on"""
+    remaining = {name: set(context["deps"]) for name, context in contexts.items()}
+    waves = []
+    while remaining:
+        wave = sorted(name for name, deps in remaining.items() if not deps)
+        if not wave:
+            raise ValueError(f"Circular image dependencies between {sorted(remaining)}")
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
+
+def context_hash(path: str, dep_hashes: list) -> str:
+    """SHA-256 over every file (relative path and content) in a build context"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != ".git")
+        for filename in sorted(files):
+            full_path = os.path.join(root, filename)
+            digest.update(os.path.relpath(full_path, path).replace(os.sep, "/").encode() + b"\0")
+            with open(full_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+    for dep_hash in dep_hashes:
+        digest.update(dep_hash.encode())
+    return digest.hexdigest()
+
+
+def _record(name: str, fields: dict):
+    from app.db import image_builds
+    image_builds.update_one({"_id": name}, {"$set": fields}, upsert=True)
+
+
+def _build_one(name: str, context: dict, content_hash: str, force: bool, record: bool = True) -> dict:
+    image = context["image"]
+    current = get_runtime().image_info(image)
+    if not force and current and current["labels"].get(CONTEXT_HASH_LABEL) == content_hash:
+        if record:
+            _record(name, {"image": image, "status": "skipped", "checked_at": datetime.utcnow()})
+        return {"status": "skipped", "image": image, "context_hash": content_hash}
+
+    cmd = [cli_binary(), "build", "-t", image, "--label", f"{CONTEXT_HASH_LABEL}={content_hash}", context["path"]]
+    # BuildKit is needed for the apt cache mounts in the Dockerfiles (Podman supports them natively)
+    env = {**os.environ, "DOCKER_BUILDKIT": "1"}
+    logger.info(f"Building {image}")
+    started = time.perf_counter()
+    try:
+        result = run_docker(cmd, capture_output=True, text=True, env=env, timeout=IMAGE_BUILD_TIMEOUT_SECONDS)
+        error = None if result.returncode == 0 else "\n".join((result.stdout + result.stderr).splitlines()[-LOG_TAIL_LINES:])
+    except subprocess.TimeoutExpired:
+        error = f"Build timed out after {IMAGE_BUILD_TIMEOUT_SECONDS}s"
+    duration = round(time.perf_counter() - started, 2)
+
+    if error:
+        logger.error(f"Failed to build {image}: {error}")
+        if record:
+            _record(name, {"image": image, "status": "failed", "error": error, "checked_at": datetime.utcnow()})
+        return {"status": "failed", "image": image, "error": error, "duration_seconds": duration}
+
+    IMAGE_BUILD_SECONDS.labels(image).observe(duration)
+    built = get_runtime().image_info(image) or {}
+    result = {
+        "image": image,
+        "status": "built",
+        "context_hash": content_hash,
+        "image_id": built.get("id"),
+        "size_bytes": built.get("size_bytes"),
+        "duration_seconds": duration,
+        "built_at": datetime.utcnow(),
+        "checked_at": datetime.utcnow(),
+        "error": None
+    }
+    if record:
+        _record(name, result)
+    logger.info(f"Built {image} in {duration}s ({result['size_bytes']} bytes)")
+    return {k: v for k, v in result.items() if k not in ("built_at", "checked_at", "error")}
+
+
+def build_lab_images(force: bool = False, only: Optional[list] = None, record: bool = True) -> dict:
+    """Build changed lab images (and the shared images they use) in parallel waves; record=False keeps Mongo out"""
+    contexts = discover_contexts()
+    if only:
+        unknown = set(only) - set(contexts)
+        if unknown:
+            raise ValueError(f"Unknown labs: {', '.join(sorted(unknown))}")
+        # Requested labs plus everything they build on
+        wanted, pending = set(), list(only)
+        while pending:
+            name = pending.pop()
+            if name not in wanted:
+                wanted.add(name)
+                pending.extend(contexts[name]["deps"])
+        contexts = {name: context for name, context in contexts.items() if name in wanted}
+
+    hashes, results = {}, {}
+    with ThreadPoolExecutor(max_workers=IMAGE_BUILD_CONCURRENCY) as pool:
+        for wave in build_order(contexts):
+            futures = {}
+            for name in wave:
+                context = contexts[name]
+                hashes[name] = context_hash(context["path"], [hashes[dep] for dep in context["deps"]])
+                failed_deps = [dep for dep in context["deps"] if results[dep]["status"] == "failed"]
+                if failed_deps:
+                    results[name] = {"status": "failed", "image": context["image"], "error": f"Dependency {', '.join(failed_deps)} failed"}
+                    continue
+                futures[name] = pool.submit(_build_one, name, context, hashes[name], force, record)
+            for name, future in futures.items():
+                results[name] = future.result()
+
+    if record:
+        refresh_home_templates([result["image"] for result in results.values() if result["status"] == "built"])
+    return results
+
+
+def refresh_home_templates(images: list):
+    """Rebuild the home templates of catalog labs whose image was just rebuilt"""
+    from app.db import lab_catalog
+    from app.home_templates import build_home_template
+
+    for lab in lab_catalog.find({"image": {"$in": images}}, {"id": 1}):
+        build_home_template(lab["id"])
+
+
+def start_image_build(force: bool = False, only: Optional[list] = None) -> dict:
+    """Run build_lab_images in the background; one build at a time across all workers"""
+    from app.coordination import acquire_lease, release_lease
+
+    contexts = discover_contexts()
+    unknown = set(only or []) - set(contexts)
+    if unknown:
+        raise ValueError(f"Unknown labs: {', '.join(sorted(unknown))}")
+    # Leases are re-entrant per owner, so each build is its own owner: a second
+    # request to the same worker must not join the running build's lease
+    owner = uuid.uuid4().hex
+    # Waves run one after another, each bounded by the per-build timeout
+    if not acquire_lease(IMAGE_BUILD_LEASE, IMAGE_BUILD_TIMEOUT_SECONDS * len(build_order(contexts)), owner=owner):
+        return {"error": "An image build is already running"}
+
+    def run():
+        try:
+            build_lab_images(force=force, only=only)
+        except Exception as e:
+            logger.error(f"Image build failed: {e}")
+        finally:
+            release_lease(IMAGE_BUILD_LEASE, owner=owner)
+
+    threading.Thread(target=run, daemon=True).start()
+    return {"status": "started", "force": force, "labs": only or "all"}
+
+
+def get_image_builds() -> dict:
+    """Last build record per lab image and whether a build is running now"""
+    from app.db import image_builds
+    from app.coordination import get_lease
+
+    lease = get_lease(IMAGE_BUILD_LEASE)
+    return {
+        "running": bool(lease and lease["expires_at"] > datetime.utcnow()),
+        "images": list(image_builds.find().sort("_id", 1))
+    }
+
+
+def mongo_available() -> bool:
+    """Whether MONGODB_URL answers, checked without importing app.db"""
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+
+    client = MongoClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017/"), serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the lab images (unchanged contexts are skipped)")
+    parser.add_argument("labs", nargs="*", help="lab directories to build (default: all)")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the context is unchanged")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    record = mongo_available()
+    if not record:
+        logger.warning("MongoDB is not reachable: building without recording results or refreshing home templates")
+    results = build_lab_images(force=args.force, only=args.labs or None, record=record)
+    for name, result in results.items():
+        detail = result.get("error") or (
+            f"{result['duration_seconds']}s, {(result['size_bytes'] or 0) / 1e6:.0f} MB" if result["status"] == "built" else ""
+        )
+        print(f"{name:<16}{result['status']:<9}{detail}")
+    if any(result["status"] == "failed" for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,40 @@
-import subprocess
+import os
 import random
 import threading
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
 from app.db import lab_instances as instances, lab_catalog, service_instances as services
 from app.volume_manager import create_user_volume_if_not_exists, get_user_volume_name, get_username_from_email
+from app.events import publish_event
+from app.volume_usage import get_volume_usage
+from app.readiness import wait_until_ready, record_time_to_ready
+from app.coordination import is_leader
+from app.container_runtime import get_runtime, ContainerRuntimeError
+from app.tracing import span
+from app.service_controller import reap_stale_service_claims
 
 logger = logging.getLogger(__name__)
 
 LAB_TIME_LIMIT = 30 * 60  # 30 minutes
+LAB_REAPER_INTERVAL_SECONDS = int(os.getenv("LAB_REAPER_INTERVAL_SECONDS", "30"))
+
+# A lab is "starting" until its readiness probe passes, then "running"
+ACTIVE_LAB_STATUSES = ["starting", "running"]
+# A lab whose probe timed out; finished like a stopped one, so the archiver moves it too
+FAILED_LAB_STATUS = "failed"
+
+# Labs are reached through the /lab/{instance_id}/ proxy over this network
+LAB_NETWORK = os.getenv("LAB_NETWORK", "selfmade_labs")
+# Use container names instead of IPs when the API itself runs on LAB_NETWORK
+LAB_UPSTREAM_BY_NAME = os.getenv("LAB_UPSTREAM_BY_NAME", "false").lower() == "true"
+# Prefix for access URLs when the API sits behind a load balancer on another origin
+LAB_PUBLIC_BASE_URL = os.getenv("LAB_PUBLIC_BASE_URL", "").rstrip("/")
+# Per-lab origin, e.g. https://{instance_id}.labs.example.com (wildcard DNS + TLS
+# pointing at this API). Keeps student-controlled pages off the dashboard's origin.
+LAB_ORIGIN_TEMPLATE = os.getenv("LAB_ORIGIN_TEMPLATE", "").rstrip("/")
 
 # Resource limits per lab container
 RESOURCE_LIMITS = {
@@ -16,137 +42,245 @@ RESOURCE_LIMITS = {
     "memory": "4g"    # 4GB RAM max
 }
 
-def auto_stop_timer(container_name, instance_id):
-    import time
-    time.sleep(LAB_TIME_LIMIT)
-    # Re-check status before stopping
-    current = instances.find_one({"_id": instance_id})
-    if current and current["status"] == "running":
+def lab_origin(instance_id) -> str:
+    """Origin a lab is served from: its own one, or the shared public base URL"""
+    if LAB_ORIGIN_TEMPLATE:
+        return LAB_ORIGIN_TEMPLATE.format(instance_id=instance_id)
+    return LAB_PUBLIC_BASE_URL
+
+def ensure_lab_network():
+    """Create the private lab network if it does not exist yet"""
+    try:
+        get_runtime().ensure_network(LAB_NETWORK)
+    except ContainerRuntimeError as e:
+        logger.error(f"Failed to create lab network {LAB_NETWORK}: {e}")
+
+def get_container_address(container: str) -> str:
+    """Host the proxy uses to reach a container on LAB_NETWORK"""
+    if LAB_UPSTREAM_BY_NAME:
+        return container
+    return get_runtime().container_address(container, LAB_NETWORK)
+
+def _force_remove(container: str):
+    """Remove a container that failed to start; errors only logged"""
+    try:
+        get_runtime().remove(container, force=True)
+    except ContainerRuntimeError as e:
+        logger.warning(f"Failed to remove container {container}: {e}")
+
+def finish_instance(instance_id, status: str, only_if: dict = None):
+    """Move an instance to a finished status and release its active claim"""
+    query = {"_id": instance_id, **(only_if or {})}
+    return instances.update_one(
+        query,
+        {"$set": {"status": status, "stopped_at": datetime.utcnow()}, "$unset": {"active": ""}}
+    )
+
+def reap_expired_labs() -> int:
+    """Auto-stop labs that outlived LAB_TIME_LIMIT (run by the leader for every worker)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=LAB_TIME_LIMIT)
+    reaped = 0
+    for current in instances.find({"status": {"$in": ACTIVE_LAB_STATUSES}, "started_at": {"$lt": cutoff}}):
+        # Claim the stop first so a user stop racing with us is not doubled
+        if not finish_instance(current["_id"], "auto-stopped", {"status": {"$in": ACTIVE_LAB_STATUSES}}).modified_count:
+            continue
+        container_name = current.get("container")
         print(f"Auto-stopping {container_name}")
-        subprocess.run(["docker", "stop", container_name])
-        subprocess.run(["docker", "rm", container_name])
-        instances.update_one(
-            {"_id": instance_id},
-            {"$set": {"status": "auto-stopped", "stopped_at": datetime.utcnow()}}
-        )
+        get_runtime().discard(container_name)
+        publish_event(current["user_email"], "lab", {"action": "auto-stopped", "lab_id": current["lab"]})
+        reaped += 1
+    return reaped
 
-def start_lab(user_email: str, lab_id: str):
-    # Check if user already has THIS SPECIFIC lab running
-    existing = instances.find_one({
-        "user_email": user_email,
-        "lab": lab_id,
-        "status": "running"
-    })
-
-    if existing:
-        return {
-            "error": f"You already have {lab_id} lab running. Stop it first.",
-            "running_lab": existing["lab"],
-            "port": existing["port"],
-            "access_url": existing.get("access_url")
-        }
+def reaper_loop(stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            if is_leader():
+                reap_expired_labs()
+                reap_stale_service_claims()
+        except Exception as e:
+            logger.error(f"Lab reaper failed: {e}")
+        stop_event.wait(LAB_REAPER_INTERVAL_SECONDS)
+
+def start_lab_reaper() -> threading.Event:
+    """Start the auto-stop reaper thread, returns the event that stops it"""
+    stop_event = threading.Event()
+    threading.Thread(target=reaper_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
 
+def start_lab(user_email: str, lab_id: str):
     # Get Lab Config
-    lab_config = lab_catalog.find_one({"id": lab_id})
+    with span("catalog_lookup"):
+        lab_config = lab_catalog.find_one({"id": lab_id})
     if not lab_config:
         return {"error": "Invalid Lab ID"}
 
-    # Create or get user's persistent volume
-    try:
-        volume_name = create_user_volume_if_not_exists(user_email)
-    except RuntimeError as e:
-        return {"error": f"Failed to create user volume: {str(e)}"}
+    # Enforce home volume quota (sizes come from the background scanner)
+    with span("quota_check"):
+        usage = get_volume_usage(user_email)
+    if usage["over_hard_quota"]:
+        return {
+            "error": f"Your home volume uses {usage['size']}, above the {usage['hard_quota_mb']} MB limit. Free up space before starting a lab.",
+            "volume_usage": usage
+        }
 
     # Extract username for dynamic mount path and environment variable
     username = get_username_from_email(user_email)
+    volume_name = get_user_volume_name(user_email)
 
-    # Allocate port based on lab type
-    port = random.randint(8000, 9000)  # Expanded port range for web terminals
+    # The id is chosen up front so the proxy path is known before the container starts
+    instance_id = ObjectId()
     container = f"lab_{username}_{lab_id}_{random.randint(1000,9999)}"
+    access_url = f"{lab_origin(instance_id)}/lab/{instance_id}/"
 
-    # Build Docker command with shared volume and resource limits
-    cmd = [
-        "docker", "run", "-d",
-        "--name", container,
+    # Claim the (user, lab) slot before any Docker work; the unique partial
+    # index on active instances makes this atomic across workers and nodes
+    with span("claim_instance"):
+        try:
+            instances.insert_one({
+                "_id": instance_id,
+                "user_email": user_email,
+                "lab": lab_id,
+                "lab_name": lab_config["name"],
+                "container": container,
+                "volume": volume_name,           # NEW: Track volume
+                "access_url": access_url,        # Proxied access URL
+                "status": "starting",
+                "active": True,
+                "started_at": datetime.utcnow(),
 
-        # CRITICAL: Mount user's persistent volume to /home/labuser
-        "-v", f"{volume_name}:/home/labuser",
+                # Resource limits tracking
+                "resources": {
+                    "cpus": RESOURCE_LIMITS["cpus"],
+                    "memory": RESOURCE_LIMITS["memory"]
+                }
+            })
+        except DuplicateKeyError:
+            existing = instances.find_one({"user_email": user_email, "lab": lab_id, "active": True}) or {}
+            return {
+                "error": f"You already have {lab_id} lab running. Stop it first.",
+                "running_lab": lab_id,
+                "access_url": existing.get("access_url")
+            }
 
-        # Pass username as environment variable for future dynamic user creation
-        "-e", f"USERNAME={username}",
-        "-e", f"USER_EMAIL={user_email}",
+    # Create or get user's persistent volume
+    with span("volume_prepare", volume=volume_name):
+        try:
+            create_user_volume_if_not_exists(user_email, lab_config.get("home_template"))
+        except RuntimeError as e:
+            instances.delete_one({"_id": instance_id})
+            return {"error": f"Failed to create user volume: {str(e)}"}
 
-        # Resource limits (CPU and memory)
-        "--cpus", RESOURCE_LIMITS["cpus"],
-        "--memory", RESOURCE_LIMITS["memory"],
-    ]
+    # Pass username as environment variable for future dynamic user creation
+    env = {"USERNAME": username, "USER_EMAIL": user_email}
 
-    # Port Mapping Logic (updated for web terminals)
+    # Internal port the proxy forwards to, per lab type
     if lab_id == "n8n":
-        cmd.extend(["-p", f"{port}:5678"])  # n8n web UI
+        # n8n builds its asset URLs from N8N_PATH
+        env["N8N_PATH"] = f"/lab/{instance_id}/"
         access_type = "web"
         internal_port = 5678
     elif lab_id in ["ubuntu-ssh", "kali-linux"]:
-        cmd.extend(["-p", f"{port}:7681"])  # ttyd web terminal
-        access_type = "web_terminal"
+        access_type = "web_terminal"  # ttyd web terminal
         internal_port = 7681
     else:
         # Default: assume web terminal on port 7681
-        cmd.extend(["-p", f"{port}:7681"])
         access_type = "web_terminal"
         internal_port = 7681
 
-    cmd.append(lab_config["image"])
+    # Start container with the shared volume and resource limits
+    with span("docker_run", image=lab_config["image"], container=container):
+        try:
+            get_runtime().run(
+                lab_config["image"], container,
+                # No published host ports: the API proxies to the container on this network
+                network=LAB_NETWORK,
+                # CRITICAL: Mount user's persistent volume to /home/labuser
+                volumes=[f"{volume_name}:/home/labuser"],
+                env=env,
+                cpus=RESOURCE_LIMITS["cpus"],
+                memory=RESOURCE_LIMITS["memory"]
+            )
+            logger.info(f"Started container {container} for {user_email}")
+        except ContainerRuntimeError as e:
+            logger.error(f"Failed to start container {container}: {e}")
+            instances.delete_one({"_id": instance_id})
+            return {"error": "Failed to start container", "details": str(e)}
 
-    # Start container
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        logger.info(f"Started container {container} for {user_email}")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to start container {container}: {e.stderr}")
-        return {"error": "Failed to start container", "details": e.stderr}
-
-    # Build access URL
-    access_url = f"http://localhost:{port}"
-
-    # Insert record with volume and resource information
-    res = instances.insert_one({
-        "user_email": user_email,
-        "lab": lab_id,
-        "lab_name": lab_config["name"],
-        "container": container,
-        "volume": volume_name,           # NEW: Track volume
-        "port": port,
-        "access_url": access_url,        # NEW: Direct access URL
-        "access_type": access_type,
-        "status": "running",
-        "started_at": datetime.utcnow(),
+    with span("container_inspect"):
+        try:
+            upstream = f"{get_container_address(container)}:{internal_port}"
+        except ContainerRuntimeError as e:
+            logger.error(f"Failed to inspect container {container}: {e}")
+            _force_remove(container)
+            instances.delete_one({"_id": instance_id})
+            return {"error": "Failed to start container", "details": str(e)}
 
-        # Resource limits tracking
-        "resources": {
-            "cpus": RESOURCE_LIMITS["cpus"],
-            "memory": RESOURCE_LIMITS["memory"]
-        }
-    })
+    # Record where the proxy reaches the container (auto-stop is handled by the reaper)
+    with span("record_upstream"):
+        recorded = instances.update_one(
+            {"_id": instance_id, "status": "starting"},
+            {"$set": {"upstream": upstream, "access_type": access_type}}
+        )
+    if not recorded.modified_count:
+        # Stopped while the container was being created
+        _force_remove(container)
+        return {"error": "Lab was stopped before it became ready"}
 
-    # Start Auto-stop Timer
-    threading.Thread(target=auto_stop_timer, args=(container, res.inserted_id), daemon=True).start()
+    with span("publish_event"):
+        publish_event(user_email, "lab", {"action": "starting", "lab_id": lab_id})
 
-    return {
-        "status": "started",
+    response = {
+        "status": "starting",
+        "instance_id": str(instance_id),
         "lab_name": lab_config["name"],
         "container": container,
         "volume": volume_name,
-        "port": port,
         "access_url": access_url,
         "access_type": access_type,
         "resources": RESOURCE_LIMITS
     }
+    if usage["over_soft_quota"]:
+        response["warning"] = f"Your home volume uses {usage['size']}, above the {usage['soft_quota_mb']} MB soft limit."
+    return response
+
+
+async def wait_for_lab_ready(user_email: str, result: dict) -> dict:
+    """
+    Probe a lab returned by start_lab until its terminal answers, then mark it running.
+    A lab that never becomes ready is removed and reported as an error.
+    """
+    instance_id = ObjectId(result["instance_id"])
+    instance = await run_in_threadpool(instances.find_one, {"_id": instance_id})
+    if not instance:
+        return {"error": "Lab disappeared while starting"}
+
+    with span("readiness_probe", upstream=instance["upstream"]):
+        seconds = await wait_until_ready(instance["upstream"], instance["access_type"])
+    await run_in_threadpool(record_time_to_ready, instance["lab"], seconds)
+
+    if seconds is None:
+        await run_in_threadpool(_force_remove, instance["container"])
+        await run_in_threadpool(finish_instance, instance_id, FAILED_LAB_STATUS, {"status": "starting"})
+        publish_event(user_email, "lab", {"action": "failed", "lab_id": instance["lab"]})
+        return {"error": f"{instance['lab_name']} did not become ready in time"}
+
+    # Only promote labs that were not stopped while we were probing
+    with span("mark_running"):
+        updated = await run_in_threadpool(
+            instances.update_one,
+            {"_id": instance_id, "status": "starting"},
+            {"$set": {"status": "running", "ready_at": datetime.utcnow(), "time_to_ready": round(seconds, 3)}}
+        )
+    if not updated.modified_count:
+        return {"error": "Lab was stopped before it became ready"}
+
+    publish_event(user_email, "lab", {"action": "started", "lab_id": instance["lab"]})
+    return {**result, "status": "started", "time_to_ready": round(seconds, 3)}
 
 
 def stop_lab(user_email: str, lab_id: str = None):
     # Stop specific or all running labs for user
-    query = {"user_email": user_email, "status": "running"}
+    query = {"user_email": user_email, "status": {"$in": ACTIVE_LAB_STATUSES}}
     if lab_id:
         query["lab"] = lab_id
         
@@ -154,35 +288,25 @@ def stop_lab(user_email: str, lab_id: str = None):
     
     stopped = []
     for instance in running_labs:
-        container = instance["container"]
-        try:
-            subprocess.run(["docker", "stop", container], check=False)
-            subprocess.run(["docker", "rm", container], check=False)
-        except Exception:
-            pass
-            
-        instances.update_one(
-            {"_id": instance["_id"]},
-            {"$set": {
-                "status": "stopped",
-                "stopped_at": datetime.utcnow()
-            }}
-        )
+        get_runtime().discard(instance["container"])
+
+        finish_instance(instance["_id"], "stopped")
         stopped.append(instance["lab"])
+        publish_event(user_email, "lab", {"action": "stopped", "lab_id": instance["lab"]})
 
     return {"message": "Labs stopped", "stopped": stopped}
 
 
 def get_lab_status(user_email: str):
-    # Get all running labs
+    # Get all starting and running labs
     cursor = instances.find(
-        {"user_email": user_email, "status": "running"},
-        {"_id": 0}
+        {"user_email": user_email, "status": {"$in": ACTIVE_LAB_STATUSES}},
+        {"_id": 0, "upstream": 0}
     )
     return list(cursor)
 
 def list_catalog():
-    return list(lab_catalog.find({}, {"_id": 0}))
+    return list(lab_catalog.find({}, {"_id": 0, "home_template": 0}))
 
 def list_services():
     return list(services.find({}, {"_id": 0}))
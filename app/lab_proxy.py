@@ -0,0 +1,281 @@
+"""
+Lab Proxy Module
+Serves /lab/{instance_id}/ as an authenticated HTTP + WebSocket reverse
+proxy to the lab container over the private lab network, so labs no longer
+publish host ports. HTTP goes through one pooled httpx client; WebSocket
+frames are relayed as they arrive, without buffering or re-framing.
+
+Lab pages are controlled by the student, so they must not run on the
+dashboard's origin (where the JWT lives in localStorage). With
+LAB_ORIGIN_TEMPLATE each lab is only served on its own origin. Without it,
+pages shown to anyone but the lab's owner are sandboxed by CSP. The
+dashboard's token is only ever exchanged for a short-lived session token
+scoped to one lab, which is what the lab's cookie holds.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+from urllib.parse import urlencode, urlparse
+
+import httpx
+import websockets
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+
+from app.auth import authenticate_token, create_access_token
+from app.db import lab_instances
+from app.lab_controller import lab_origin, LAB_ORIGIN_TEMPLATE
+
+logger = logging.getLogger(__name__)
+
+LAB_PROXY_TIMEOUT_SECONDS = float(os.getenv("LAB_PROXY_TIMEOUT_SECONDS", "30"))
+LAB_PROXY_MAX_CONNECTIONS = int(os.getenv("LAB_PROXY_MAX_CONNECTIONS", "1000"))
+LAB_PROXY_MAX_KEEPALIVE = int(os.getenv("LAB_PROXY_MAX_KEEPALIVE", "200"))
+LAB_PROXY_ROUTE_CACHE_SECONDS = float(os.getenv("LAB_PROXY_ROUTE_CACHE_SECONDS", "5"))
+LAB_PROXY_ROUTE_CACHE_SIZE = int(os.getenv("LAB_PROXY_ROUTE_CACHE_SIZE", "10000"))
+LAB_SESSION_MINUTES = int(os.getenv("LAB_SESSION_MINUTES", "60"))
+
+# Opaque origin: scripts run but cannot reach the dashboard's storage or cookies
+SANDBOX_POLICY = "sandbox allow-scripts allow-forms allow-popups allow-modals allow-downloads"
+
+# Cookie set on the first (token-carrying) request, scoped to the lab's path
+LAB_SESSION_COOKIE = "lab_session"
+
+# Methods whose requests are relayed without a body
+BODYLESS_METHODS = {"GET", "HEAD", "OPTIONS", "TRACE"}
+
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host"
+}
+
+_client: Optional[httpx.AsyncClient] = None
+_routes = OrderedDict()  # instance_id -> (expires_at, instance), least recently used first
+_routes_lock = threading.Lock()
+
+
+def start_lab_proxy() -> httpx.AsyncClient:
+    """Create the pooled upstream client (called from the lifespan)"""
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=httpx.Timeout(LAB_PROXY_TIMEOUT_SECONDS, connect=5),
+        limits=httpx.Limits(
+            max_connections=LAB_PROXY_MAX_CONNECTIONS,
+            max_keepalive_connections=LAB_PROXY_MAX_KEEPALIVE
+        ),
+        follow_redirects=False
+    )
+    return _client
+
+
+async def close_lab_proxy():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        return start_lab_proxy()
+    return _client
+
+
+def _lookup_instance(instance_id: str) -> Optional[dict]:
+    with _routes_lock:
+        cached = _routes.get(instance_id)
+        if cached and cached[0] > time.monotonic():
+            _routes.move_to_end(instance_id)
+            return cached[1]
+    try:
+        object_id = ObjectId(instance_id)
+    except InvalidId:
+        return None
+    instance = lab_instances.find_one(
+        {"_id": object_id, "status": "running", "upstream": {"$exists": True}},
+        {"user_email": 1, "upstream": 1}
+    )
+    if not instance:
+        # Not cached: a lab that is still starting must be reachable as soon as it is running
+        return None
+    with _routes_lock:
+        _routes[instance_id] = (time.monotonic() + LAB_PROXY_ROUTE_CACHE_SECONDS, instance)
+        _routes.move_to_end(instance_id)
+        while len(_routes) > LAB_PROXY_ROUTE_CACHE_SIZE:
+            _routes.popitem(last=False)
+    return instance
+
+
+def on_lab_origin(host: Optional[str], instance_id: str) -> bool:
+    """Whether a request reached the origin this lab is served from"""
+    if not LAB_ORIGIN_TEMPLATE:
+        return True
+    return (host or "").lower() == urlparse(lab_origin(instance_id)).netloc.lower()
+
+
+def lab_token_scope(instance_id: str) -> str:
+    return f"lab:{instance_id}"
+
+
+async def resolve_lab(instance_id: str, token: Optional[str], session_token: Optional[str] = None) -> tuple:
+    """
+    Authenticate the caller with the dashboard token or, failing that, this
+    lab's session token; returns (running instance they may reach, user)
+    """
+    if token:
+        user = await run_in_threadpool(authenticate_token, token)
+    elif session_token:
+        user = await run_in_threadpool(authenticate_token, session_token, lab_token_scope(instance_id))
+    else:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    instance = await run_in_threadpool(_lookup_instance, instance_id)
+    if not instance:
+        raise HTTPException(status_code=404, detail="Lab not running")
+    if instance["user_email"] != user["email"] and user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Not your lab")
+    return instance, user
+
+
+def _forward_headers(headers, instance_id: str, client_host: Optional[str]) -> dict:
+    forwarded = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "cookie"}
+    # Pass the user's cookies through, minus our own session cookie
+    cookies = [
+        part for part in headers.get("cookie", "").split(";")
+        if part.strip() and not part.strip().startswith(f"{LAB_SESSION_COOKIE}=")
+    ]
+    if cookies:
+        forwarded["cookie"] = ";".join(cookies).strip()
+    forwarded["x-forwarded-prefix"] = f"/lab/{instance_id}"
+    if client_host:
+        forwarded["x-forwarded-for"] = client_host
+    return forwarded
+
+
+async def proxy_http(request: Request, instance_id: str, path: str):
+    """Relay one HTTP request to the lab container, streaming both directions"""
+    if not on_lab_origin(request.headers.get("host"), instance_id):
+        raise HTTPException(status_code=404, detail="Labs are served from their own origin")
+    query_token = request.query_params.get("token")
+    instance, user = await resolve_lab(instance_id, query_token, request.cookies.get(LAB_SESSION_COOKIE))
+    is_owner = instance["user_email"] == user["email"]
+
+    if query_token:
+        # Swap the URL token for a path-scoped cookie holding a session token
+        # for this lab only, so the dashboard token stays out of history,
+        # upstream logs and the lab's cookie jar
+        params = [(k, v) for k, v in request.query_params.multi_items() if k != "token"]
+        location = request.url.path + (f"?{urlencode(params)}" if params else "")
+        response = RedirectResponse(location, status_code=303)
+        response.set_cookie(
+            LAB_SESSION_COOKIE,
+            create_access_token(
+                {"email": user["email"], "scope": lab_token_scope(instance_id)},
+                timedelta(minutes=LAB_SESSION_MINUTES)
+            ),
+            max_age=LAB_SESSION_MINUTES * 60,
+            path=f"/lab/{instance_id}/",
+            httponly=True,
+            samesite="strict",
+            secure=request.url.scheme == "https"
+        )
+        return response
+
+    client = _get_client()
+    upstream_request = client.build_request(
+        request.method,
+        f"http://{instance['upstream']}/{path}",
+        params=request.query_params.multi_items(),
+        headers=_forward_headers(request.headers, instance_id, request.client.host if request.client else None),
+        content=None if request.method in BODYLESS_METHODS else request.stream()
+    )
+    try:
+        upstream = await client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        logger.warning(f"Lab proxy upstream {instance['upstream']} failed: {e}")
+        raise HTTPException(status_code=502, detail="Lab is not reachable")
+
+    headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    if not LAB_ORIGIN_TEMPLATE and not is_owner:
+        # Someone else's lab (an admin looking in) on the dashboard's origin
+        headers["content-security-policy"] = SANDBOX_POLICY
+    # Raw bytes: content-encoding and content-length stay valid as sent by the lab
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        status_code=upstream.status_code,
+        headers=headers,
+        background=BackgroundTask(upstream.aclose)
+    )
+
+
+async def proxy_websocket(websocket: WebSocket, instance_id: str, path: str):
+    """Relay a WebSocket session (e.g. the ttyd terminal) frame by frame"""
+    if not on_lab_origin(websocket.headers.get("host"), instance_id):
+        await websocket.close(code=4404)
+        return
+    try:
+        instance, _ = await resolve_lab(
+            instance_id,
+            websocket.query_params.get("token"),
+            websocket.cookies.get(LAB_SESSION_COOKIE)
+        )
+    except HTTPException as e:
+        await websocket.close(code=4401 if e.status_code == 401 else 4403)
+        return
+
+    query = websocket.url.query
+    target = f"ws://{instance['upstream']}/{path}" + (f"?{query}" if query else "")
+    subprotocols = websocket.scope.get("subprotocols") or None
+
+    try:
+        upstream = await websockets.connect(
+            target,
+            subprotocols=subprotocols,
+            max_size=None,
+            compression=None,
+            open_timeout=5
+        )
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        logger.warning(f"Lab proxy websocket to {target} failed: {e}")
+        await websocket.close(code=1011)
+        return
+
+    await websocket.accept(subprotocol=upstream.subprotocol)
+
+    async def client_to_upstream():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                await upstream.send(message["bytes"])
+            elif message.get("text") is not None:
+                await upstream.send(message["text"])
+
+    async def upstream_to_client():
+        async for message in upstream:
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_text(message)
+
+    tasks = [asyncio.create_task(client_to_upstream()), asyncio.create_task(upstream_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await upstream.close()
+        try:
+            await websocket.close()
+        except (RuntimeError, WebSocketDisconnect):
+            pass
@@ -2,16 +2,36 @@
 Selfmade Labs - Main API Application
 Complete platform with OAuth, Labs, Services, Notifications
 """
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel, EmailStr
 from typing import Optional
-import httpx
-
-from app.lab_controller import start_lab, stop_lab, get_lab_status, list_catalog
+from datetime import datetime
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import threading
+import uuid
+import json
+import os
+
+from app.lab_controller import (
+    start_lab, stop_lab, get_lab_status, list_catalog, ensure_lab_network,
+    wait_for_lab_ready, start_lab_reaper, ACTIVE_LAB_STATUSES
+)
+from app.coordination import start_leader_election, is_leader, get_lease, OWNER_ID, LEADER_LEASE
+from app.readiness import get_readiness_histograms
+from app.idempotency import run_once
+from app.rate_limit import RateLimitMiddleware, docker_slots_in_use, release_concurrency_slot
+from app.metrics import MetricsMiddleware, take_state_snapshot, threadpool_usage, render_metrics
+from app.tracing import start_trace, span, mark_error, slowest_traces
+from prometheus_client import CONTENT_TYPE_LATEST
+from app.lab_proxy import start_lab_proxy, close_lab_proxy, proxy_http, proxy_websocket
 from app.service_controller import (
     start_service, stop_service, get_service_status,
     get_service_credentials, list_service_catalog
@@ -19,22 +39,79 @@ from app.service_controller import (
 from app.notifications import (
     create_notification, get_user_notifications,
     get_unread_count, mark_as_read, mark_all_as_read,
-    delete_notification
+    delete_notification, start_notification_maintenance, notification_outbox,
+    create_broadcast, compact_notifications, repair_unread_counters
 )
 from app.auth import (
-    oauth, create_access_token, get_current_user, get_current_admin,
-    get_or_create_user, extract_google_user_info, extract_github_user_info,
+    oauth, create_access_token, get_current_user, get_current_admin, get_current_user_from_query,
+    get_or_create_user, get_user_by_email, extract_google_user_info, extract_github_user_info,
     update_user_profile, create_user_as_admin, list_all_users,
-    update_user_role, delete_user, OAUTH_CALLBACK_BASE_URL, SECRET_KEY
+    update_user_role, delete_user, OAUTH_CALLBACK_BASE_URL, SECRET_KEY, GOOGLE_METADATA_URL, GITHUB_API_URL
 )
-from app.db import audit_logs, lab_instances, service_instances
+from app.archiver import start_archiver, count_history
+from app.audit import audit_writer, list_audit_logs, log_audit_event
+from app.user_cache import user_cache, start_version_poller
+from app.http_client import start_http_client, close_http_client, get_http_client, load_oidc_metadata
+from app.events import event_bus, start_event_bridge
+from app.volume_manager import start_volume_registry, volume_registry, get_user_volume_name, create_user_volume_if_not_exists
+from app.volume_archive import (
+    cached_export, stream_export, stream_file, parse_range, import_archive, ArchiveError
+)
+from app.home_templates import build_all_home_templates
+from app.image_builder import start_image_build, get_image_builds
+from app.volume_usage import start_volume_scanner, get_volume_usage, list_volume_usage, set_volume_quota
+
+from app.db import lab_instances, service_instances
+from app.container_runtime import get_runtime
+
+# Bearer token Prometheus must send to /metrics (empty = open)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+EVENT_HEARTBEAT_SECONDS = 15
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start and stop shared clients and background jobs"""
+    start_http_client()
+    start_lab_proxy()
+    await run_in_threadpool(ensure_lab_network)
+    if oauth.create_client("google"):
+        await google_client()
+    audit_writer.start()
+    notification_outbox.start()
+    leader_election_stop = await run_in_threadpool(start_leader_election)
+    archiver_stop = start_archiver()
+    cache_poller_stop = start_version_poller()
+    event_bridge_stop = start_event_bridge()
+    notification_maintenance_stop = start_notification_maintenance()
+    volume_registry_stop = start_volume_registry()
+    volume_scanner_stop = start_volume_scanner()
+    lab_reaper_stop = start_lab_reaper()
+    if is_leader():
+        threading.Thread(target=build_all_home_templates, daemon=True).start()
+    yield
+    lab_reaper_stop.set()
+    volume_scanner_stop.set()
+    volume_registry.stop(volume_registry_stop)
+    notification_maintenance_stop.set()
+    event_bridge_stop.set()
+    cache_poller_stop.set()
+    archiver_stop.set()
+    leader_election_stop.set()
+    notification_outbox.stop()
+    audit_writer.stop()
+    await close_lab_proxy()
+    await close_http_client()
 
 app = FastAPI(
     title="Selfmade Labs API",
     description="Self-hosted lab orchestration platform",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
+# Rate limiting (innermost, so 429 responses still carry CORS headers)
+app.add_middleware(RateLimitMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -51,6 +128,13 @@ app.add_middleware(
     max_age=3600  # 1 hour session lifetime
 )
 
+# Request latency metrics (outermost, so rate-limited and failed requests are counted too)
+app.add_middleware(MetricsMiddleware)
+
+def request_id(request: Request) -> str:
+    """Caller-supplied X-Request-ID, or a fresh one"""
+    return request.headers.get("x-request-id") or uuid.uuid4().hex
+
 # ==================== Pydantic Models ====================
 
 class LabRequest(BaseModel):
@@ -67,6 +151,15 @@ class UserCreateRequest(BaseModel):
 class UserRoleUpdate(BaseModel):
     role: str
 
+class BroadcastRequest(BaseModel):
+    title: str
+    message: str
+    expires_in_days: Optional[int] = None
+
+class VolumeQuotaUpdate(BaseModel):
+    soft_quota_mb: Optional[int] = None
+    hard_quota_mb: Optional[int] = None
+
 class ProfileUpdate(BaseModel):
     full_name: Optional[str] = None
     theme: Optional[str] = None
@@ -74,6 +167,15 @@ class ProfileUpdate(BaseModel):
 
 # ==================== Root ====================
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus exposition"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    extra = {**threadpool_usage(), "docker_slots_in_use": docker_slots_in_use()}
+    snapshot = await run_in_threadpool(take_state_snapshot, extra)
+    return Response(render_metrics(snapshot), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/")
 def home():
     return {
@@ -84,17 +186,27 @@ def home():
 
 # ==================== OAuth Routes ====================
 
+async def google_client():
+    """The Google OAuth client, its discovery metadata refreshed once it is OIDC_CACHE_HOURS old"""
+    client = oauth.create_client("google")
+    if client is None:
+        raise HTTPException(status_code=404, detail="Google login is not configured")
+    await load_oidc_metadata(client, GOOGLE_METADATA_URL)
+    return client
+
 @app.get("/auth/google")
 async def google_login(request: Request):
     """Initiate Google OAuth flow"""
     redirect_uri = f"{OAUTH_CALLBACK_BASE_URL}/auth/google/callback"
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    client = await google_client()
+    return await client.authorize_redirect(request, redirect_uri)
 
 @app.get("/auth/google/callback")
 async def google_callback(request: Request):
     """Handle Google OAuth callback"""
     try:
-        token = await oauth.google.authorize_access_token(request)
+        client = await google_client()
+        token = await client.authorize_access_token(request)
         user_info = token.get('userinfo')
 
         if not user_info:
@@ -141,21 +253,21 @@ async def github_callback(request: Request):
     try:
         token = await oauth.github.authorize_access_token(request)
 
-        # Get user info from GitHub API
-        async with httpx.AsyncClient() as client:
-            headers = {"Authorization": f"Bearer {token['access_token']}"}
-
-            # Get user profile
-            user_resp = await client.get("https://api.github.com/user", headers=headers)
-            user_info = user_resp.json()
+        # Get user profile and emails from GitHub API concurrently
+        client = get_http_client()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        user_resp, email_resp = await asyncio.gather(
+            client.get(f"{GITHUB_API_URL}/user", headers=headers),
+            client.get(f"{GITHUB_API_URL}/user/emails", headers=headers)
+        )
+        user_info = user_resp.json()
 
-            # Get primary email
-            email_resp = await client.get("https://api.github.com/user/emails", headers=headers)
-            emails = email_resp.json()
-            primary_email = next((e["email"] for e in emails if e["primary"]), emails[0]["email"] if emails else None)
+        # Get primary email
+        emails = email_resp.json()
+        primary_email = next((e["email"] for e in emails if e["primary"]), emails[0]["email"] if emails else None)
 
-            if not primary_email:
-                raise HTTPException(status_code=400, detail="No email found in GitHub account")
+        if not primary_email:
+            raise HTTPException(status_code=400, detail="No email found in GitHub account")
 
         # Extract user data
         user_data = extract_github_user_info(user_info, primary_email)
@@ -205,7 +317,8 @@ def get_profile(current_user: dict = Depends(get_current_user)):
         "theme_preference": current_user.get("theme_preference", "auto"),
         "notifications_enabled": current_user.get("notifications_enabled", True),
         "created_at": current_user.get("created_at"),
-        "last_login": current_user.get("last_login")
+        "last_login": current_user.get("last_login"),
+        "volume_usage": get_volume_usage(current_user["email"], current_user)
     }
 
 @app.put("/profile")
@@ -222,10 +335,10 @@ def update_profile(data: ProfileUpdate, current_user: dict = Depends(get_current
 @app.get("/profile/stats")
 def get_user_stats(current_user: dict = Depends(get_current_user)):
     """Get user usage statistics"""
-    labs_started = lab_instances.count_documents({"user_email": current_user["email"]})
-    services_started = service_instances.count_documents({"user_email": current_user["email"]})
-    active_labs = lab_instances.count_documents({"user_email": current_user["email"], "status": "running"})
-    active_services = service_instances.count_documents({"user_email": current_user["email"], "status": "running"})
+    labs_started = count_history("lab_instances", {"user_email": current_user["email"]})
+    services_started = count_history("service_instances", {"user_email": current_user["email"]})
+    active_labs = lab_instances.count_documents({"user_email": current_user["email"], "active": True})
+    active_services = service_instances.count_documents({"user_email": current_user["email"], "active": True})
 
     return {
         "labs_started_total": labs_started,
@@ -234,6 +347,118 @@ def get_user_stats(current_user: dict = Depends(get_current_user)):
         "active_services": active_services
     }
 
+# ==================== Home Volume Export/Import ====================
+
+def home_export_response(request: Request, user_email: str, fresh: bool = False):
+    """Stream a home volume archive, serving ranges from the spooled copy when available (unless fresh)"""
+    filename = f"{get_user_volume_name(user_email)}.tar.gz"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    cached = None if fresh else cached_export(user_email)
+    if not cached:
+        # docker run -v would create the volume, so check it exists first
+        if get_runtime().inspect_volume(get_user_volume_name(user_email)) is None:
+            raise HTTPException(status_code=404, detail="Home volume not found")
+        # Nothing to resume from yet: stream a fresh archive (Range is ignored)
+        return StreamingResponse(stream_export(user_email), media_type="application/gzip", headers=headers)
+
+    size = cached["size"]
+    headers.update({
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{cached["sha256"]}"',
+        "X-Checksum-SHA256": cached["sha256"]
+    })
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != headers["ETag"]:
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            stream_file(cached["path"], start, end),
+            status_code=206,
+            media_type="application/gzip",
+            headers=headers
+        )
+
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(stream_file(cached["path"]), media_type="application/gzip", headers=headers)
+
+@app.get("/me/home/export")
+def api_export_home(request: Request, current_user: dict = Depends(get_current_user)):
+    """Download /home/labuser as .tar.gz (supports Range once spooled)"""
+    return home_export_response(request, current_user["email"])
+
+@app.get("/me/home/export/checksum")
+def api_export_checksum(current_user: dict = Depends(get_current_user)):
+    """SHA-256 and size of the last completed export"""
+    cached = cached_export(current_user["email"])
+    if not cached:
+        raise HTTPException(status_code=404, detail="No completed export")
+    return {"sha256": cached["sha256"], "size": cached["size"]}
+
+@app.post("/me/home/import")
+async def api_import_home(request: Request, current_user: dict = Depends(get_current_user)):
+    """Restore a .tar.gz into /home/labuser (send X-Checksum-SHA256 to verify)"""
+    email = current_user["email"]
+    if await run_in_threadpool(lab_instances.count_documents, {"user_email": email, "status": {"$in": ACTIVE_LAB_STATUSES}}, limit=1):
+        raise HTTPException(status_code=409, detail="Stop your running labs before importing")
+
+    await run_in_threadpool(create_user_volume_if_not_exists, email)
+    try:
+        result = await import_archive(email, request.stream(), request.headers.get("x-checksum-sha256"))
+    except ArchiveError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    log_audit_event(email, "home_imported", email, {"bytes": result["bytes"], "sha256": result["sha256"]})
+    return result
+
+# ==================== Dashboard ====================
+
+@app.get("/dashboard/snapshot")
+async def api_dashboard_snapshot(request: Request, current_user: dict = Depends(get_current_user)):
+    """Everything the dashboard shows in one response, with ETag/304 support"""
+    email = current_user["email"]
+    profile, stats, labs, services, lab_status, service_status, notifs, unread = await asyncio.gather(
+        run_in_threadpool(get_profile, current_user),
+        run_in_threadpool(get_user_stats, current_user),
+        run_in_threadpool(list_catalog),
+        run_in_threadpool(list_service_catalog),
+        run_in_threadpool(get_lab_status, email),
+        run_in_threadpool(get_service_status, email),
+        run_in_threadpool(get_user_notifications, email),
+        run_in_threadpool(get_unread_count, email)
+    )
+
+    snapshot = jsonable_encoder({
+        "profile": profile,
+        "stats": stats,
+        "labs": labs,
+        "services": services,
+        "lab_status": lab_status,
+        "service_status": service_status,
+        "notifications": notifs,
+        "unread_count": unread
+    })
+    version = hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    snapshot["version"] = version
+    return JSONResponse(snapshot, headers=headers)
+
 # ==================== Lab Routes ====================
 
 @app.get("/labs")
@@ -242,42 +467,79 @@ def api_list_labs(current_user: dict = Depends(get_current_user)):
     return list_catalog()
 
 @app.post("/labs/start")
-def api_start_lab(payload: LabRequest, current_user: dict = Depends(get_current_user)):
-    """Start a lab"""
-    result = start_lab(current_user["email"], payload.lab_id)
-
-    if "error" not in result:
-        create_notification(
-            current_user["email"],
-            "lab_started",
-            "Lab Started",
-            f"Your {result.get('lab', 'lab')} is now running on port {result.get('port')}",
-            {"lab_id": payload.lab_id, "port": result.get('port')}
-        )
-
-    return result
+async def api_start_lab(
+    payload: LabRequest,
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Start a lab and wait until its terminal is reachable (duplicates join the first request)"""
+    email = current_user["email"]
+
+    async def work():
+        with start_trace("start_lab", request_id=request_id(request), user=email, lab=payload.lab_id):
+            result = await run_in_threadpool(start_lab, email, payload.lab_id)
+            # Docker is done; the readiness wait should not hold up other starts
+            await release_concurrency_slot(request)
+            if "error" not in result:
+                result = await wait_for_lab_ready(email, result)
+
+            if "error" in result:
+                mark_error(result["error"])
+            else:
+                with span("notification"):
+                    create_notification(
+                        email,
+                        "lab_started",
+                        "Lab Started",
+                        f"Your {result.get('lab_name', 'lab')} is now running",
+                        {"lab_id": payload.lab_id, "access_url": result.get('access_url')}
+                    )
+            return result
+
+    return await run_once("labs.start", email, payload.lab_id, work, idempotency_key)
 
 @app.post("/labs/stop")
-def api_stop_lab(payload: LabRequest, current_user: dict = Depends(get_current_user)):
+async def api_stop_lab(
+    payload: LabRequest,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Stop a lab"""
-    result = stop_lab(current_user["email"], payload.lab_id)
+    email = current_user["email"]
 
-    if "message" in result:
-        create_notification(
-            current_user["email"],
-            "lab_stopped",
-            "Lab Stopped",
-            f"Your lab has been stopped",
-            {"lab_id": payload.lab_id}
-        )
+    async def work():
+        result = await run_in_threadpool(stop_lab, email, payload.lab_id)
 
-    return result
+        if "message" in result:
+            create_notification(
+                email,
+                "lab_stopped",
+                "Lab Stopped",
+                "Your lab has been stopped",
+                {"lab_id": payload.lab_id}
+            )
+        return result
+
+    return await run_once("labs.stop", email, payload.lab_id, work, idempotency_key)
 
 @app.get("/labs/status")
 def api_lab_status(current_user: dict = Depends(get_current_user)):
     """Get user's running labs"""
     return get_lab_status(current_user["email"])
 
+# ==================== Lab Proxy ====================
+
+@app.api_route("/lab/{instance_id}/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"])
+async def api_lab_proxy(instance_id: str, path: str, request: Request):
+    """Authenticated reverse proxy to the lab's web terminal or UI"""
+    return await proxy_http(request, instance_id, path)
+
+@app.websocket("/lab/{instance_id}/{path:path}")
+async def api_lab_proxy_websocket(websocket: WebSocket, instance_id: str, path: str):
+    """WebSocket side of the lab proxy (ttyd terminal traffic)"""
+    await proxy_websocket(websocket, instance_id, path)
+
 # ==================== Service Routes ====================
 
 @app.get("/services/catalog")
@@ -286,14 +548,37 @@ def api_list_services(current_user: dict = Depends(get_current_user)):
     return list_service_catalog()
 
 @app.post("/services/start")
-def api_start_service(payload: ServiceRequest, current_user: dict = Depends(get_current_user)):
-    """Start a service"""
-    return start_service(current_user["email"], payload.service_id)
+async def api_start_service(
+    payload: ServiceRequest,
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Start a service (duplicates join the first request)"""
+    email = current_user["email"]
+
+    async def work():
+        with start_trace("start_service", request_id=request_id(request), user=email, service=payload.service_id):
+            result = await run_in_threadpool(start_service, email, payload.service_id)
+            if "error" in result:
+                mark_error(result["error"])
+            return result
+
+    return await run_once("services.start", email, payload.service_id, work, idempotency_key)
 
 @app.post("/services/stop")
-def api_stop_service(payload: ServiceRequest, current_user: dict = Depends(get_current_user)):
+async def api_stop_service(
+    payload: ServiceRequest,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Stop a service"""
-    return stop_service(current_user["email"], payload.service_id)
+    email = current_user["email"]
+
+    async def work():
+        return await run_in_threadpool(stop_service, email, payload.service_id)
+
+    return await run_once("services.stop", email, payload.service_id, work, idempotency_key)
 
 @app.get("/services/status")
 def api_service_status(current_user: dict = Depends(get_current_user)):
@@ -308,9 +593,22 @@ def api_get_credentials(service_id: str, current_user: dict = Depends(get_curren
 # ==================== Notification Routes ====================
 
 @app.get("/notifications")
-def api_notifications(unread_only: bool = False, current_user: dict = Depends(get_current_user)):
-    """Get user notifications"""
-    return get_user_notifications(current_user["email"], unread_only=unread_only)
+def api_notifications(
+    unread_only: bool = False,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get user notifications (newest first, pass next_cursor to page deeper)"""
+    try:
+        return get_user_notifications(
+            current_user["email"],
+            unread_only=unread_only,
+            limit=min(max(limit, 1), 200),
+            cursor=cursor
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @app.get("/notifications/unread-count")
 def api_unread_count(current_user: dict = Depends(get_current_user)):
@@ -340,6 +638,32 @@ def api_delete_notification(notification_id: str, current_user: dict = Depends(g
         return {"message": "Notification deleted"}
     raise HTTPException(status_code=404, detail="Notification not found")
 
+# ==================== Live Events ====================
+
+@app.get("/events/stream")
+async def api_event_stream(request: Request, current_user: dict = Depends(get_current_user_from_query)):
+    """Server-sent events for lab, service and notification changes"""
+    user_email = current_user["email"]
+    queue = event_bus.subscribe(user_email)
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+                    yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            event_bus.unsubscribe(user_email, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ==================== Admin Routes ====================
 
 @app.post("/admin/users")
@@ -349,8 +673,47 @@ def admin_create_user(payload: UserCreateRequest, admin: dict = Depends(get_curr
 
 @app.get("/admin/users")
 def admin_list_users(admin: dict = Depends(get_current_admin)):
-    """List all users"""
-    return list_all_users()
+    """List all users with their cached home volume size"""
+    usage = list_volume_usage()
+    all_users = list_all_users()
+    for user in all_users:
+        volume = usage.get(get_user_volume_name(user["email"]))
+        user["volume_bytes"] = volume["bytes"] if volume else None
+    return all_users
+
+@app.get("/admin/volumes")
+def admin_list_volumes(admin: dict = Depends(get_current_admin)):
+    """Cached sizes of all user volumes"""
+    return [
+        {"volume": name, "bytes": doc["bytes"], "scanned_at": doc["scanned_at"]}
+        for name, doc in sorted(list_volume_usage().items())
+    ]
+
+@app.get("/admin/users/{email}/volume")
+def admin_user_volume(email: str, admin: dict = Depends(get_current_admin)):
+    """Home volume size and quota state for a user"""
+    return get_volume_usage(email)
+
+@app.get("/admin/users/{email}/home/export")
+def admin_export_home(email: str, request: Request, admin: dict = Depends(get_current_admin)):
+    """Download a user's home volume (e.g. before deleting the user); always archived fresh"""
+    if not get_user_by_email(email):
+        raise HTTPException(status_code=404, detail="User not found")
+    response = home_export_response(request, email, fresh=True)
+    log_audit_event(admin["email"], "home_exported", email)
+    return response
+
+@app.put("/admin/users/{email}/quota")
+def admin_update_quota(email: str, payload: VolumeQuotaUpdate, admin: dict = Depends(get_current_admin)):
+    """Override a user's home volume quota (omit a field to use the default)"""
+    try:
+        updated = set_volume_quota(email, payload.soft_quota_mb, payload.hard_quota_mb)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not updated:
+        raise HTTPException(status_code=404, detail="User not found")
+    log_audit_event(admin["email"], "quota_updated", email, payload.model_dump())
+    return get_volume_usage(email)
 
 @app.put("/admin/users/{email}/role")
 def admin_update_role(email: str, payload: UserRoleUpdate, admin: dict = Depends(get_current_admin)):
@@ -358,15 +721,81 @@ def admin_update_role(email: str, payload: UserRoleUpdate, admin: dict = Depends
     return update_user_role(email, payload.role, admin)
 
 @app.delete("/admin/users/{email}")
-def admin_delete_user(email: str, admin: dict = Depends(get_current_admin)):
+def admin_delete_user(email: str, request: Request, admin: dict = Depends(get_current_admin)):
     """Delete a user"""
-    return delete_user(email, admin)
+    with start_trace("delete_user", request_id=request_id(request), user=email, admin=admin["email"]):
+        return delete_user(email, admin)
+
+@app.post("/admin/broadcasts")
+def admin_create_broadcast(payload: BroadcastRequest, admin: dict = Depends(get_current_admin)):
+    """Send a notification to all users (stored once)"""
+    broadcast_id = create_broadcast(
+        payload.title,
+        payload.message,
+        created_by=admin["email"],
+        expires_in_days=payload.expires_in_days
+    )
+    log_audit_event(admin["email"], "broadcast_created", broadcast_id, {"title": payload.title})
+    return {"message": "Broadcast published", "id": broadcast_id}
+
+@app.post("/admin/notifications/compact")
+def admin_compact_notifications(admin: dict = Depends(get_current_admin)):
+    """Run notification compaction and counter repair now and report what changed"""
+    report = compact_notifications()
+    report["repaired_counters"] = repair_unread_counters()
+    return report
+
+@app.post("/admin/home-templates/build")
+def admin_build_home_templates(force: bool = False, admin: dict = Depends(get_current_admin)):
+    """(Re)build home templates for all catalog labs from their current images"""
+    templates = build_all_home_templates(force=force)
+    log_audit_event(admin["email"], "home_templates_built", "lab_catalog", {
+        lab_id: template["version"] for lab_id, template in templates.items() if template
+    })
+    return templates
+
+@app.post("/admin/images/build", status_code=202)
+def admin_build_images(force: bool = False, labs: Optional[str] = None, admin: dict = Depends(get_current_admin)):
+    """Build lab images in the background (comma-separated labs, default all; unchanged ones are skipped)"""
+    only = [lab.strip() for lab in labs.split(",") if lab.strip()] if labs else None
+    try:
+        result = start_image_build(force=force, only=only)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if "error" in result:
+        raise HTTPException(status_code=409, detail=result["error"])
+    log_audit_event(admin["email"], "lab_images_build_started", "lab_images", {"force": force, "labs": only or "all"})
+    return result
+
+@app.get("/admin/images")
+def admin_image_builds(admin: dict = Depends(get_current_admin)):
+    """Last build of each lab image (duration, size, context hash) and whether a build is running"""
+    return get_image_builds()
 
 @app.get("/admin/audit-logs")
-def admin_get_logs(limit: int = 100, admin: dict = Depends(get_current_admin)):
-    """Get audit logs"""
-    logs = list(audit_logs.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit))
-    return logs
+def admin_get_logs(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    action: Optional[str] = None,
+    user_email: Optional[str] = None,
+    target: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    admin: dict = Depends(get_current_admin)
+):
+    """Get audit logs (newest first, pass next_cursor to page deeper)"""
+    try:
+        return list_audit_logs(
+            limit=min(max(limit, 1), 500),
+            cursor=cursor,
+            action=action,
+            user_email=user_email,
+            target=target,
+            since=since,
+            until=until
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @app.get("/admin/stats")
 def admin_stats(admin: dict = Depends(get_current_admin)):
@@ -375,10 +804,10 @@ def admin_stats(admin: dict = Depends(get_current_admin)):
 
     total_users = users.count_documents({})
     total_admins = users.count_documents({"role": "admin"})
-    active_labs = lab_instances.count_documents({"status": "running"})
-    active_services = service_instances.count_documents({"status": "running"})
-    total_labs_started = lab_instances.count_documents({})
-    total_services_started = service_instances.count_documents({})
+    active_labs = lab_instances.count_documents({"active": True})
+    active_services = service_instances.count_documents({"active": True})
+    total_labs_started = count_history("lab_instances", {})
+    total_services_started = count_history("service_instances", {})
 
     return {
         "users": {
@@ -396,6 +825,26 @@ def admin_stats(admin: dict = Depends(get_current_admin)):
         }
     }
 
+@app.get("/admin/cluster")
+def admin_cluster(admin: dict = Depends(get_current_admin)):
+    """Which worker answered and which one holds the leader lease"""
+    return {"worker": OWNER_ID, "is_leader": is_leader(), "leader": get_lease(LEADER_LEASE)}
+
+@app.get("/admin/traces")
+def admin_traces(limit: int = Query(50, ge=1, le=200), name: Optional[str] = None, admin: dict = Depends(get_current_admin)):
+    """Slowest recent traces handled by this worker, broken down by phase"""
+    return slowest_traces(limit, name)
+
+@app.get("/admin/metrics/lab-readiness")
+def admin_lab_readiness_metrics(admin: dict = Depends(get_current_admin)):
+    """Time-to-ready histograms per catalog lab"""
+    return get_readiness_histograms()
+
+@app.get("/admin/metrics/user-cache")
+def admin_user_cache_metrics(admin: dict = Depends(get_current_admin)):
+    """Authenticated-user cache hit ratio and lookup latency"""
+    return user_cache.stats()
+
 # ==================== Static Files (MUST BE LAST) ====================
 
 app.mount("/ui", StaticFiles(directory="static", html=True), name="static")
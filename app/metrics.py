@@ -0,0 +1,241 @@
+"""
+Metrics Module
+Prometheus instrumentation: HTTP route latency (ASGI middleware), Docker
+CLI calls by operation, Mongo commands by collection (pymongo command
+listener), lab time-to-ready, service provisioning time and the
+authenticated user cache. Gauges that
+describe shared state (running labs, tenants per shared container, pool
+occupancy) are computed at scrape time so every worker reports the same.
+"""
+import os
+import time
+import subprocess
+import threading
+
+import anyio.to_thread
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+# Set when running several workers (see prometheus_client multiprocess mode)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+# false skips the per-request and per-command instrumentation (e.g. to measure its cost)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "selfmade_http_request_seconds", "HTTP request latency by route",
+    ["method", "route", "status"], buckets=FAST_BUCKETS + (10, 30, 60)
+)
+DOCKER_OPERATION_SECONDS = Histogram(
+    "selfmade_docker_operation_seconds", "Docker CLI call latency by operation",
+    ["operation"], buckets=SLOW_BUCKETS
+)
+DOCKER_OPERATION_FAILURES = Counter(
+    "selfmade_docker_operation_failures_total", "Docker CLI calls that exited non-zero",
+    ["operation"]
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "selfmade_mongo_command_seconds", "MongoDB command latency by command and collection",
+    ["command", "collection"], buckets=FAST_BUCKETS
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "selfmade_mongo_command_failures_total", "MongoDB commands that failed",
+    ["command", "collection"]
+)
+LAB_TIME_TO_READY_SECONDS = Histogram(
+    "selfmade_lab_time_to_ready_seconds", "Time from docker run until the lab answers HTTP",
+    ["lab"], buckets=SLOW_BUCKETS
+)
+SERVICE_PROVISION_SECONDS = Histogram(
+    "selfmade_service_provision_seconds", "Time to provision a tenant in a shared service container",
+    ["service"], buckets=SLOW_BUCKETS
+)
+IMAGE_BUILD_SECONDS = Histogram(
+    "selfmade_image_build_seconds", "Lab image build time (skipped builds are not observed)",
+    ["image"], buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+)
+USER_CACHE_LOOKUPS = Counter(
+    "selfmade_user_cache_lookups_total", "Authenticated user cache lookups by result",
+    ["result"]
+)
+USER_CACHE_INVALIDATIONS = Counter(
+    "selfmade_user_cache_invalidations_total", "User cache entries evicted by writes or version stamps"
+)
+USER_CACHE_STALE_WRITES = Counter(
+    "selfmade_user_cache_stale_writes_total", "User cache writes dropped because a newer version stamp was seen"
+)
+USER_CACHE_ENTRIES = Gauge(
+    "selfmade_user_cache_entries", "Users held in the cache", multiprocess_mode="livesum"
+)
+
+# ==================== Docker ====================
+
+def docker_operation(cmd) -> str:
+    """Operation label for a docker command (list or shell string)"""
+    parts = cmd.split() if isinstance(cmd, str) else list(cmd)
+    if len(parts) < 2:
+        return "unknown"
+    if parts[1] in ("volume", "network", "image") and len(parts) > 2:
+        return f"{parts[1]}_{parts[2]}"
+    return parts[1]
+
+
+def run_docker(cmd, **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run for docker commands, timed per operation"""
+    operation = docker_operation(cmd)
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(cmd, **kwargs)
+    except subprocess.CalledProcessError:
+        DOCKER_OPERATION_FAILURES.labels(operation).inc()
+        raise
+    finally:
+        DOCKER_OPERATION_SECONDS.labels(operation).observe(time.perf_counter() - started)
+    if result.returncode != 0:
+        DOCKER_OPERATION_FAILURES.labels(operation).inc()
+    return result
+
+
+# ==================== MongoDB ====================
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command pymongo sends, labelled by collection"""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = "-"
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _collection(self, event) -> str:
+        with self._lock:
+            return self._pending.pop((event.connection_id, event.request_id), "-")
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name, self._collection(event)).observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        collection = self._collection(event)
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name, collection).inc()
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+# ==================== HTTP ====================
+
+class MetricsMiddleware:
+    """Records request latency labelled by the matched route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners cannot explode cardinality
+            route_path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route_path, str(status["code"])).observe(
+                time.perf_counter() - started
+            )
+
+
+# ==================== Exposition ====================
+
+class StateCollector:
+    """Gauges for shared state, from a snapshot taken just before each scrape"""
+
+    def __init__(self):
+        self.snapshot = {}
+
+    def collect(self):
+        snap = self.snapshot
+        labs = GaugeMetricFamily("selfmade_labs_active", "Labs starting or running", labels=["status"])
+        for status, count in snap.get("labs", {}).items():
+            labs.add_metric([status], count)
+        yield labs
+
+        tenants = GaugeMetricFamily("selfmade_service_tenants", "Active tenants per shared service container", labels=["service"])
+        for service, count in snap.get("tenants", {}).items():
+            tenants.add_metric([service], count)
+        yield tenants
+
+        for name, help_text in (
+            ("threadpool_borrowed", "Worker threads in use by sync endpoints"),
+            ("threadpool_total", "Worker thread limit for sync endpoints"),
+            ("redis_db_pool_used", "Redis DB numbers (of 16) assigned to tenants"),
+            ("docker_slots_in_use", "Docker-bound requests holding a concurrency slot"),
+        ):
+            if name in snap:
+                yield GaugeMetricFamily(f"selfmade_{name}", help_text, value=snap[name])
+
+
+state_collector = StateCollector()
+REGISTRY.register(state_collector)
+
+
+def take_state_snapshot(extra: dict = None) -> dict:
+    """Query Mongo for the shared-state gauges (run in a worker thread)"""
+    from app.db import lab_instances, service_instances
+
+    snapshot = {
+        "labs": {
+            row["_id"]: row["count"] for row in lab_instances.aggregate([
+                {"$match": {"active": True}},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ])
+        },
+        "tenants": {
+            row["_id"]: row["count"] for row in service_instances.aggregate([
+                {"$match": {"active": True}},
+                {"$group": {"_id": "$service", "count": {"$sum": 1}}}
+            ])
+        },
+        "redis_db_pool_used": service_instances.count_documents({"active": True, "redis_db": {"$exists": True}}),
+    }
+    snapshot.update(extra or {})
+    return snapshot
+
+
+def threadpool_usage() -> dict:
+    """Thread limiter usage (call from the event loop)"""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {"threadpool_borrowed": limiter.borrowed_tokens, "threadpool_total": limiter.total_tokens}
+
+
+def render_metrics(snapshot: dict) -> bytes:
+    """Exposition text for this worker, or for all workers in multiprocess mode"""
+    state_collector.snapshot = snapshot
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(state_collector)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
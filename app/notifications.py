@@ -2,13 +2,164 @@
 Notifications Module
 Manages user notifications for lab/service events
 """
-from datetime import datetime
-from app.db import notifications
+import os
+import time
+import threading
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from app.db import users, notifications, notification_counters, broadcasts, ensure_ttl_index
+from app.events import publish_event, ALL_USERS
+from app.buffered_writer import BufferedWriter
+from app.pagination import encode_cursor, decode_cursor, before_cursor
+from app.coordination import is_leader
 from bson import ObjectId
+from bson.errors import InvalidId
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("NOTIFICATION_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+NOTIFICATION_READ_RETENTION_DAYS = int(os.getenv("NOTIFICATION_READ_RETENTION_DAYS", "30"))
+NOTIFICATION_MAX_AGE_DAYS = int(os.getenv("NOTIFICATION_MAX_AGE_DAYS", "90"))
+NOTIFICATION_FLUSH_SIZE = int(os.getenv("NOTIFICATION_FLUSH_SIZE", "200"))
+NOTIFICATION_FLUSH_INTERVAL_SECONDS = float(os.getenv("NOTIFICATION_FLUSH_INTERVAL_SECONDS", "0.5"))
+NOTIFICATION_COALESCE_SECONDS = float(os.getenv("NOTIFICATION_COALESCE_SECONDS", "5"))
+NOTIFICATION_FALLBACK_PATH = os.getenv("NOTIFICATION_FALLBACK_PATH", "notification_fallback.jsonl")
+BROADCAST_DEFAULT_DAYS = int(os.getenv("BROADCAST_DEFAULT_DAYS", "14"))
+BROADCAST_CACHE_SECONDS = float(os.getenv("BROADCAST_CACHE_SECONDS", "5"))
+NOTIFICATION_REPAIR_SETTLE_SECONDS = int(os.getenv("NOTIFICATION_REPAIR_SETTLE_SECONDS", "60"))
+
+notifications.create_index([("user_email", 1), ("created_at", -1), ("_id", -1)])
+notifications.create_index([("user_email", 1), ("read", 1)])
+# Superseded by the keyset index above
+if "user_email_1_created_at_-1" in notifications.index_information():
+    notifications.drop_index("user_email_1_created_at_-1")
+
+# Read notifications expire NOTIFICATION_READ_RETENTION_DAYS after being
+# read; unread ones are left to compaction
+if "read_notifications_ttl" in notifications.index_information():
+    # Superseded: counted the retention from created_at, so old notifications
+    # vanished as soon as they were read
+    notifications.drop_index("read_notifications_ttl")
+    notifications.update_many(
+        {"read": True, "read_at": {"$exists": False}},
+        [{"$set": {"read_at": "$created_at"}}]
+    )
+ensure_ttl_index(
+    notifications,
+    "read_at",
+    "read_at_ttl",
+    NOTIFICATION_READ_RETENTION_DAYS * 86400,
+    partialFilterExpression={"read": True}
+)
+broadcasts.create_index("expires_at", expireAfterSeconds=0)
+
+def _adjust_unread(user_email: str, delta: int):
+    """Apply a change to the user's denormalized unread counter"""
+    if delta:
+        notification_counters.update_one(
+            {"_id": user_email},
+            {"$inc": {"unread": delta}},
+            upsert=True
+        )
+
+class NotificationOutbox(BufferedWriter):
+    """Buffered notification inserts with coalescing of near-duplicates"""
+
+    def __init__(self):
+        super().__init__(
+            notifications,
+            fallback_path=NOTIFICATION_FALLBACK_PATH,
+            flush_size=NOTIFICATION_FLUSH_SIZE,
+            flush_interval=NOTIFICATION_FLUSH_INTERVAL_SECONDS
+        )
+        self._recent = {}  # (user, type, title, message) -> (_id, queued_at)
+        self._after_flush = {}  # _id -> "read" / "delete" for notifications changed mid-flush
+        self._recent_lock = threading.Lock()
+
+    def coalesce(self, notification: dict):
+        """Return the _id of an identical notification queued moments ago, if any"""
+        key = (notification["user_email"], notification["type"], notification["title"], notification["message"])
+        now = time.monotonic()
+        with self._recent_lock:
+            previous = self._recent.get(key)
+            if previous and now - previous[1] < NOTIFICATION_COALESCE_SECONDS:
+                return previous[0]
+            self._recent[key] = (notification["_id"], now)
+            if len(self._recent) > 10000:
+                self._recent = {k: v for k, v in self._recent.items() if now - v[1] < NOTIFICATION_COALESCE_SECONDS}
+        return None
+
+    def pending_for(self, user_email: str) -> list:
+        """This worker's notifications for a user that are not in Mongo yet"""
+        docs = []
+        for doc in self.pending():
+            action = self._after_flush.get(doc["_id"])
+            if doc["user_email"] != user_email or action == "delete":
+                continue
+            docs.append({**doc, "read": True, "read_at": datetime.utcnow()} if action == "read" else doc)
+        return docs
+
+    def update_pending(self, user_email: str, action: str, notification_id: ObjectId = None) -> list:
+        """
+        Mark read ("read") or drop ("delete") pending notifications of a user,
+        one or all of them. Queued ones are changed in place; ones being flushed
+        right now get the change applied once the flush lands. Returns the
+        matched notifications' unread flags from before the change.
+        """
+        def matches(doc):
+            return doc["user_email"] == user_email and notification_id in (None, doc["_id"])
+
+        was_unread = []
+        with self._lock:
+            inflight = {id(doc) for doc in self._inflight}
+            for doc in [doc for doc in self._inflight + self._buffer if matches(doc)]:
+                previous = self._after_flush.get(doc["_id"])
+                if previous == "delete":
+                    continue
+                was_unread.append(not doc["read"] and previous is None)
+                if id(doc) in inflight:
+                    self._after_flush[doc["_id"]] = action
+                elif action == "delete":
+                    self._buffer.remove(doc)
+                    self._after_flush.pop(doc["_id"], None)
+                else:
+                    doc["read"] = True
+                    doc["read_at"] = datetime.utcnow()
+        return was_unread
+
+    def on_flushed(self, docs: list, duplicate_ids: set):
+        with self._lock:
+            actions = {doc["_id"]: self._after_flush.pop(doc["_id"]) for doc in docs if doc["_id"] in self._after_flush}
+        read = [_id for _id, action in actions.items() if action == "read"]
+        deleted = [_id for _id, action in actions.items() if action == "delete"]
+        if read:
+            notifications.update_many({"_id": {"$in": read}}, {"$set": {"read": True, "read_at": datetime.utcnow()}})
+        if deleted:
+            notifications.delete_many({"_id": {"$in": deleted}})
+
+        # One counter update per user per batch, only for notifications this
+        # flush inserted (a replay skips ones already written) and that were
+        # not read or deleted while it ran
+        unread = Counter(
+            doc["user_email"] for doc in docs
+            if not doc.get("read") and doc["_id"] not in duplicate_ids and doc["_id"] not in actions
+        )
+        if unread:
+            notification_counters.bulk_write([
+                UpdateOne({"_id": email}, {"$inc": {"unread": count}}, upsert=True)
+                for email, count in unread.items()
+            ], ordered=False)
+
+
+notification_outbox = NotificationOutbox()
 
 def create_notification(user_email: str, notif_type: str, title: str, message: str, metadata: dict = None):
-    """Create a new notification"""
+    """Create a new notification (queued in the outbox, pushed to live subscribers now)"""
     notification = {
+        "_id": ObjectId(),
         "user_email": user_email,
         "type": notif_type,
         "title": title,
@@ -18,75 +169,311 @@ def create_notification(user_email: str, notif_type: str, title: str, message: s
         "metadata": metadata or {}
     }
 
-    result = notifications.insert_one(notification)
-    return str(result.inserted_id)
+    duplicate_id = notification_outbox.coalesce(notification)
+    if duplicate_id:
+        return str(duplicate_id)
+
+    notification_outbox.write(notification)
+    publish_event(user_email, "notification", {
+        "id": str(notification["_id"]),
+        "type": notif_type,
+        "title": title
+    })
+    return str(notification["_id"])
+
+# ==================== Broadcasts ====================
+
+_broadcast_cache = {"loaded_at": 0.0, "items": []}
+
+def create_broadcast(title: str, message: str, created_by: str, expires_in_days: int = None, metadata: dict = None):
+    """Publish one notification to every user (a single insert regardless of user count)"""
+    now = datetime.utcnow()
+    broadcast = {
+        "_id": ObjectId(),
+        "type": "broadcast",
+        "title": title,
+        "message": message,
+        "created_by": created_by,
+        "created_at": now,
+        "expires_at": now + timedelta(days=expires_in_days or BROADCAST_DEFAULT_DAYS),
+        "metadata": metadata or {}
+    }
+    broadcasts.insert_one(broadcast)
+    _broadcast_cache["loaded_at"] = 0.0
+
+    publish_event(ALL_USERS, "notification", {
+        "id": str(broadcast["_id"]),
+        "type": "broadcast",
+        "title": title
+    })
+    return str(broadcast["_id"])
+
+def get_active_broadcasts() -> list:
+    """Unexpired broadcasts, newest first (cached briefly per worker)"""
+    if time.monotonic() - _broadcast_cache["loaded_at"] > BROADCAST_CACHE_SECONDS:
+        _broadcast_cache["items"] = list(
+            broadcasts.find({"expires_at": {"$gt": datetime.utcnow()}}).sort("created_at", -1)
+        )
+        _broadcast_cache["loaded_at"] = time.monotonic()
+    return _broadcast_cache["items"]
+
+def _find_broadcast(notification_id: str):
+    return next((b for b in get_active_broadcasts() if str(b["_id"]) == notification_id), None)
+
+def _broadcast_watermark(counter: dict):
+    return (counter or {}).get("broadcast_read_at") or datetime.min
+
+def _advance_watermark(user_email: str, read_at: datetime) -> bool:
+    """Mark broadcasts up to read_at as read for a user"""
+    result = notification_counters.update_one(
+        {"_id": user_email},
+        {"$max": {"broadcast_read_at": read_at}},
+        upsert=True
+    )
+    return result.modified_count > 0 or result.upserted_id is not None
 
-def get_user_notifications(user_email: str, unread_only: bool = False, limit: int = 50):
-    """Get notifications for a user"""
+def _dismiss_broadcast(user_email: str, broadcast_id: ObjectId) -> bool:
+    """Hide a broadcast from one user"""
+    result = notification_counters.update_one(
+        {"_id": user_email},
+        {"$addToSet": {"dismissed_broadcasts": broadcast_id}},
+        upsert=True
+    )
+    return result.modified_count > 0 or result.upserted_id is not None
+
+def _user_broadcasts(counter: dict, unread_only: bool = False) -> list:
+    watermark = _broadcast_watermark(counter)
+    dismissed = set((counter or {}).get("dismissed_broadcasts", []))
+    items = []
+    for broadcast in get_active_broadcasts():
+        if broadcast["_id"] in dismissed:
+            continue
+        read = broadcast["created_at"] <= watermark
+        if unread_only and read:
+            continue
+        items.append({**broadcast, "read": read})
+    return items
+
+# ==================== Queries ====================
+
+def get_user_notifications(user_email: str, unread_only: bool = False, limit: int = 50, cursor: str = None):
+    """Page through personal and broadcast notifications, newest first"""
     query = {"user_email": user_email}
     if unread_only:
         query["read"] = False
+    if cursor:
+        query = {"$and": [query, before_cursor("created_at", cursor)]}
 
-    cursor = notifications.find(query).sort("created_at", -1).limit(limit)
+    # One extra row tells us whether another page exists
+    personal = list(
+        notifications.find(query)
+        .sort([("created_at", -1), ("_id", -1)])
+        .limit(limit + 1)
+    )
+
+    counter = notification_counters.find_one({"_id": user_email})
+    candidates = personal + _user_broadcasts(counter, unread_only)
+
+    if cursor:
+        after = decode_cursor(cursor)
+        candidates = [n for n in candidates if (n["created_at"], n["_id"]) < after]
+    else:
+        # Include notifications still waiting in this worker's outbox
+        candidates += [dict(notif) for notif in notification_outbox.pending_for(user_email)]
+
+    merged = sorted(candidates, key=lambda notif: (notif["created_at"], notif["_id"]), reverse=True)
+    page = merged[:limit]
+    next_cursor = encode_cursor(page[-1]["created_at"], page[-1]["_id"]) if len(merged) > limit else None
 
     # Convert ObjectId to string for JSON serialization
-    notifs = []
-    for notif in cursor:
+    for notif in page:
         notif["_id"] = str(notif["_id"])
-        notifs.append(notif)
 
-    return notifs
+    return {"notifications": page, "next_cursor": next_cursor}
 
 def get_unread_count(user_email: str):
-    """Get count of unread notifications"""
-    return notifications.count_documents({
-        "user_email": user_email,
-        "read": False
-    })
+    """Get count of unread notifications (single point read of the counter)"""
+    counter = notification_counters.find_one({"_id": user_email})
+    pending = sum(1 for notif in notification_outbox.pending_for(user_email) if not notif["read"])
+    personal = max(counter.get("unread", 0), 0) if counter else 0
+    return personal + pending + len(_user_broadcasts(counter, unread_only=True))
 
 def mark_as_read(notification_id: str, user_email: str):
     """Mark a notification as read"""
+    broadcast = _find_broadcast(notification_id)
+    if broadcast:
+        return _advance_watermark(user_email, broadcast["created_at"])
+
     try:
-        result = notifications.update_one(
-            {"_id": ObjectId(notification_id), "user_email": user_email},
-            {"$set": {"read": True}}
-        )
-        return result.modified_count > 0
-    except Exception:
+        _id = ObjectId(notification_id)
+    except InvalidId:
         return False
 
+    # Still in this worker's outbox
+    pending = notification_outbox.update_pending(user_email, "read", _id)
+    if pending:
+        return pending[0]
+
+    result = notifications.update_one(
+        {"_id": _id, "user_email": user_email, "read": False},
+        {"$set": {"read": True, "read_at": datetime.utcnow()}}
+    )
+    _adjust_unread(user_email, -result.modified_count)
+    return result.modified_count > 0
+
 def mark_all_as_read(user_email: str):
     """Mark all notifications as read for a user"""
+    pending = sum(notification_outbox.update_pending(user_email, "read"))
     result = notifications.update_many(
         {"user_email": user_email, "read": False},
-        {"$set": {"read": True}}
+        {"$set": {"read": True, "read_at": datetime.utcnow()}}
     )
-    return result.modified_count
+    _adjust_unread(user_email, -result.modified_count)
+
+    unread_broadcasts = len(_user_broadcasts(notification_counters.find_one({"_id": user_email}), unread_only=True))
+    if unread_broadcasts:
+        _advance_watermark(user_email, datetime.utcnow())
+    return pending + result.modified_count + unread_broadcasts
 
 def delete_notification(notification_id: str, user_email: str):
-    """Delete a notification"""
+    """Delete a notification (broadcasts are dismissed for this user only)"""
+    broadcast = _find_broadcast(notification_id)
+    if broadcast:
+        return _dismiss_broadcast(user_email, broadcast["_id"])
+
     try:
-        result = notifications.delete_one({
-            "_id": ObjectId(notification_id),
-            "user_email": user_email
-        })
-        return result.deleted_count > 0
-    except Exception:
+        _id = ObjectId(notification_id)
+    except InvalidId:
         return False
 
+    if notification_outbox.update_pending(user_email, "delete", _id):
+        return True
+
+    deleted = notifications.find_one_and_delete(
+        {"_id": _id, "user_email": user_email},
+        projection={"read": 1}
+    )
+    if deleted and not deleted.get("read"):
+        _adjust_unread(user_email, -1)
+    return deleted is not None
+
 def delete_all_notifications(user_email: str):
     """Delete all notifications for a user"""
+    pending = len(notification_outbox.update_pending(user_email, "delete"))
+    unread = notifications.delete_many({"user_email": user_email, "read": False})
+    _adjust_unread(user_email, -unread.deleted_count)
     result = notifications.delete_many({"user_email": user_email})
-    return result.deleted_count
 
-def cleanup_old_notifications(days_old: int = 30):
-    """Delete notifications older than specified days"""
-    from datetime import timedelta
-    cutoff_date = datetime.utcnow() - timedelta(days=days_old)
+    visible_broadcasts = [b["_id"] for b in _user_broadcasts(notification_counters.find_one({"_id": user_email}))]
+    if visible_broadcasts:
+        notification_counters.update_one(
+            {"_id": user_email},
+            {"$addToSet": {"dismissed_broadcasts": {"$each": visible_broadcasts}}},
+            upsert=True
+        )
+    return pending + unread.deleted_count + result.deleted_count + len(visible_broadcasts)
 
-    result = notifications.delete_many({
-        "created_at": {"$lt": cutoff_date},
-        "read": True  # Only delete read notifications
-    })
+# ==================== Maintenance ====================
+
+def compact_notifications(max_age_days: int = NOTIFICATION_MAX_AGE_DAYS) -> dict:
+    """Remove what the read-notification TTL does not cover and report the counts"""
+    cutoff_date = datetime.utcnow() - timedelta(days=max_age_days)
+
+    # Unread notifications nobody looked at for max_age_days, deleted per user
+    # so each unread counter drops by exactly what was removed
+    stale = {"created_at": {"$lt": cutoff_date}, "read": False}
+    expired_unread = 0
+    for email in notifications.distinct("user_email", stale):
+        deleted = notifications.delete_many({**stale, "user_email": email}).deleted_count
+        _adjust_unread(email, -deleted)
+        expired_unread += deleted
+
+    # Notifications and counters left behind by deleted users
+    known_users = set(users.distinct("email"))
+    orphans = [email for email in notifications.distinct("user_email") if email not in known_users]
+    orphaned = notifications.delete_many({"user_email": {"$in": orphans}}).deleted_count if orphans else 0
+    stale_counters = [email for email in notification_counters.distinct("_id") if email not in known_users]
+    if stale_counters:
+        notification_counters.delete_many({"_id": {"$in": stale_counters}})
+
+    # Dismissals of broadcasts that have since expired
+    notification_counters.update_many(
+        {"dismissed_broadcasts.0": {"$exists": True}},
+        {"$pull": {"dismissed_broadcasts": {"$nin": broadcasts.distinct("_id")}}}
+    )
+
+    report = {
+        "expired_unread": expired_unread,
+        "orphaned": orphaned,
+        "removed": expired_unread + orphaned,
+        "ran_at": datetime.utcnow()
+    }
+    logger.info(f"Notification compaction removed {report['removed']} documents "
+                f"({expired_unread} expired unread, {orphaned} orphaned)")
+    return report
+
+
+def repair_unread_counters() -> int:
+    """
+    Correct unread counters that drifted from the notifications collection.
+    Counters are read before counting, and each fix is an $inc applied only if
+    the counter still holds the value read, so increments that land meanwhile
+    are never overwritten. Users with notifications newer than the settle
+    window may have inserts whose $inc is still on its way and are left for
+    the next run.
+    """
+    started = datetime.utcnow()
+    counters = {
+        counter["_id"]: counter.get("unread")
+        for counter in notification_counters.find({}, {"unread": 1})
+    }
+    actual = {
+        row["_id"]: row["unread"]
+        for row in notifications.aggregate([
+            {"$match": {"read": False}},
+            {"$group": {"_id": "$user_email", "unread": {"$sum": 1}}}
+        ])
+    }
+    in_flux = set(notifications.distinct(
+        "user_email",
+        {"created_at": {"$gte": started - timedelta(seconds=NOTIFICATION_REPAIR_SETTLE_SECONDS)}}
+    ))
+
+    ops = []
+    for email in set(counters) | set(actual):
+        observed = counters.get(email)
+        delta = actual.get(email, 0) - (observed or 0)
+        if not delta or email in in_flux:
+            continue
+        # A missing counter only matches while still missing; the upsert then creates it
+        expected = observed if observed is not None else {"$exists": False}
+        ops.append(UpdateOne({"_id": email, "unread": expected}, {"$inc": {"unread": delta}}, upsert=observed is None))
+
+    repaired = 0
+    if ops:
+        try:
+            repaired = notification_counters.bulk_write(ops, ordered=False).modified_count
+        except BulkWriteError as e:
+            # A counter created after the snapshot; it is checked again next run
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+            repaired = e.details.get("nModified", 0) + e.details.get("nUpserted", 0)
+        logger.info(f"Repaired {repaired} unread notification counters")
+    return repaired
+
+def maintenance_loop(stop_event: threading.Event):
+    """Periodically compact notifications and repair unread counters (leader only)"""
+    while not stop_event.is_set():
+        try:
+            if is_leader():
+                compact_notifications()
+                repair_unread_counters()
+        except Exception as e:
+            logger.error(f"Notification maintenance failed: {e}")
+        stop_event.wait(NOTIFICATION_MAINTENANCE_INTERVAL_SECONDS)
 
-    return result.deleted_count
+def start_notification_maintenance() -> threading.Event:
+    """Start the notification maintenance thread, returns the event that stops it"""
+    stop_event = threading.Event()
+    threading.Thread(target=maintenance_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
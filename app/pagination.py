@@ -0,0 +1,36 @@
+"""
+Keyset Pagination Helpers
+Opaque (timestamp, _id) cursors for newest-first listings.
+"""
+import base64
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def encode_cursor(timestamp: datetime, object_id) -> str:
+    raw = f"{timestamp.isoformat()}|{object_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Decode a cursor, raising ValueError when it is malformed"""
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    timestamp, object_id = raw.split("|", 1)
+    try:
+        timestamp, object_id = datetime.fromisoformat(timestamp), ObjectId(object_id)
+    except InvalidId as e:
+        raise ValueError(str(e))
+    if timestamp.tzinfo is not None:
+        # Stored timestamps are naive UTC; an aware one would not compare
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp, object_id
+
+
+def before_cursor(field: str, cursor: str) -> dict:
+    """Query matching documents that sort after the cursor in (field, _id) descending order"""
+    timestamp, object_id = decode_cursor(cursor)
+    return {"$or": [
+        {field: {"$lt": timestamp}},
+        {field: timestamp, "_id": {"$lt": object_id}},
+    ]}
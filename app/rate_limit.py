@@ -0,0 +1,323 @@
+"""
+Rate Limiting Module
+ASGI middleware with token buckets per (endpoint class, user) for the
+expensive endpoints, plus caps on concurrent Docker-bound requests.
+Requests outside the limited classes cost one dict lookup. Buckets and
+caps live in memory, or in Redis (RATE_LIMIT_REDIS_URL) so all workers
+share them; if Redis is unreachable each worker falls back to its own.
+Behind a load balancer, TRUSTED_PROXY_HOPS makes anonymous requests count
+against the client address from X-Forwarded-For instead of the balancer's.
+"""
+import os
+import time
+import uuid
+import asyncio
+import threading
+import logging
+from typing import Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from jose import JWTError, jwt
+
+from app.auth import SECRET_KEY, ALGORITHM
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+DOCKER_MAX_CONCURRENCY = int(os.getenv("DOCKER_MAX_CONCURRENCY", "8"))
+# Exports/imports hold their slot for the whole transfer, so they get their own cap
+ARCHIVE_MAX_CONCURRENCY = int(os.getenv("ARCHIVE_MAX_CONCURRENCY", "2"))
+DOCKER_QUEUE_SECONDS = float(os.getenv("DOCKER_QUEUE_SECONDS", "10"))
+# A shared slot whose worker died is reclaimed after this long
+DOCKER_SLOT_TTL_SECONDS = int(os.getenv("DOCKER_SLOT_TTL_SECONDS", "600"))
+SLOT_POLL_SECONDS = 0.1
+# Proxies in front of the app that append to X-Forwarded-For (0: use the socket peer)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# Scope key of the callback that hands a request's concurrency slot back early
+SLOT_RELEASE_SCOPE_KEY = "rate_limit.release_slot"
+
+
+def parse_rate(spec: str) -> Tuple[float, float]:
+    """'10/60' -> (capacity 10, refill 10/60 tokens per second)"""
+    count, seconds = spec.split("/")
+    return float(count), float(count) / float(seconds)
+
+
+# Concurrency pools for Docker-bound classes: pool -> max requests at once
+SLOT_POOLS = {
+    "docker": DOCKER_MAX_CONCURRENCY,
+    "archive": ARCHIVE_MAX_CONCURRENCY,
+}
+
+# Endpoint classes: bucket (capacity, refill/s) and the concurrency pool they hold a slot in
+ENDPOINT_CLASSES = {
+    "docker": {"rate": parse_rate(os.getenv("RATE_LIMIT_DOCKER", "10/60")), "pool": "docker"},
+    "oauth": {"rate": parse_rate(os.getenv("RATE_LIMIT_OAUTH", "20/60")), "pool": None},
+    "archive": {"rate": parse_rate(os.getenv("RATE_LIMIT_ARCHIVE", "5/300")), "pool": "archive"},
+}
+
+LIMITED_ROUTES = {
+    ("POST", "/labs/start"): "docker",
+    ("POST", "/labs/stop"): "docker",
+    ("POST", "/services/start"): "docker",
+    ("POST", "/services/stop"): "docker",
+    ("GET", "/auth/google"): "oauth",
+    ("GET", "/auth/google/callback"): "oauth",
+    ("GET", "/auth/github"): "oauth",
+    ("GET", "/auth/github/callback"): "oauth",
+    ("GET", "/me/home/export"): "archive",
+    ("POST", "/me/home/import"): "archive",
+}
+
+# Atomically refill and take one token; returns {allowed, seconds until a token is available}
+REDIS_TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+# Holders are scored by expiry, so slots of dead workers free themselves
+REDIS_ACQUIRE_SLOT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[4])
+    return 1
+end
+return 0
+"""
+
+
+class MemoryBuckets:
+    """Token buckets for this process; the caps are the middleware's local semaphores"""
+
+    shared = False
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        """Take a token; returns 0 when allowed, else seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now: float):
+        # Drop buckets idle long enough to have refilled completely
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if now - updated > 3600:
+                del self._buckets[key]
+
+
+class RedisBuckets:
+    """Token buckets and concurrency caps shared by all workers through Redis"""
+
+    shared = True
+    WARN_INTERVAL_SECONDS = 60
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis_asyncio
+        self._redis = redis_asyncio.from_url(url)
+        self._script = self._redis.register_script(REDIS_TOKEN_BUCKET)
+        self._acquire_script = self._redis.register_script(REDIS_ACQUIRE_SLOT)
+        # Used while Redis is unreachable, so an outage does not take the endpoints down
+        self._fallback = MemoryBuckets()
+        self._warned_at = 0.0
+
+    def _warn(self, e: Exception):
+        now = time.monotonic()
+        if now - self._warned_at > self.WARN_INTERVAL_SECONDS:
+            self._warned_at = now
+            logger.warning(f"Rate limit Redis unavailable, limiting per worker: {e}")
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        try:
+            allowed, wait = await self._script(keys=[f"ratelimit:{key}"], args=[capacity, rate, time.time()])
+        except Exception as e:
+            self._warn(e)
+            return await self._fallback.take(key, capacity, rate)
+        return 0.0 if int(allowed) else float(wait)
+
+    async def acquire_slot(self, pool: str, limit: int, holder: str) -> Optional[bool]:
+        """Take one of a pool's cluster-wide slots; None when Redis cannot be reached"""
+        try:
+            acquired = await self._acquire_script(
+                keys=[f"slots:{pool}"], args=[time.time(), limit, DOCKER_SLOT_TTL_SECONDS, holder]
+            )
+        except Exception as e:
+            self._warn(e)
+            return None
+        return bool(int(acquired))
+
+    async def release_slot(self, pool: str, holder: str):
+        try:
+            await self._redis.zrem(f"slots:{pool}", holder)
+        except Exception as e:
+            # The slot expires after DOCKER_SLOT_TTL_SECONDS
+            self._warn(e)
+
+
+def create_buckets():
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            return RedisBuckets(RATE_LIMIT_REDIS_URL)
+        except ImportError:
+            logger.warning("RATE_LIMIT_REDIS_URL is set but the redis package is not installed; using in-memory buckets")
+    return MemoryBuckets()
+
+
+_slots_in_use = {pool: 0 for pool in SLOT_POOLS}
+
+
+def docker_slots_in_use() -> int:
+    """Docker-bound requests currently holding a concurrency slot in this worker"""
+    return sum(_slots_in_use.values())
+
+
+async def release_concurrency_slot(request):
+    """Hand a request's concurrency slot back before it finishes (e.g. when only a readiness wait is left)"""
+    release = request.scope.get(SLOT_RELEASE_SCOPE_KEY)
+    if release:
+        await release()
+
+
+def _client_address(scope) -> str:
+    """Client address, taken from X-Forwarded-For when trusted proxies sit in front"""
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [
+            hop.strip()
+            for name, value in scope.get("headers", []) if name == b"x-forwarded-for"
+            for hop in value.decode("latin-1").split(",") if hop.strip()
+        ]
+        # Entries left of what our own proxies appended are client-controlled
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _identity(scope) -> str:
+    """User email from the bearer token, else the client address"""
+    for name, value in scope.get("headers", []):
+        if name == b"authorization" and value.startswith(b"Bearer "):
+            try:
+                email = jwt.decode(value[7:].decode(), SECRET_KEY, algorithms=[ALGORITHM]).get("email")
+                if email:
+                    return email
+            except JWTError:
+                pass
+            break
+    return _client_address(scope)
+
+
+class RateLimitMiddleware:
+    """429 with Retry-After once a user's bucket for an endpoint class is empty"""
+
+    def __init__(self, app):
+        self.app = app
+        self.buckets = create_buckets()
+        self.slots = {}  # pool -> asyncio.Semaphore, created on the serving loop
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            return await self.app(scope, receive, send)
+        endpoint_class = LIMITED_ROUTES.get((scope["method"], scope["path"]))
+        if endpoint_class is None:
+            return await self.app(scope, receive, send)
+
+        config = ENDPOINT_CLASSES[endpoint_class]
+        capacity, rate = config["rate"]
+        wait = await self.buckets.take(f"{endpoint_class}:{_identity(scope)}", capacity, rate)
+        if wait > 0:
+            return await self._reject(scope, receive, send, wait, "Too many requests, slow down")
+
+        pool = config["pool"]
+        if pool is None:
+            return await self.app(scope, receive, send)
+
+        semaphore = self.slots.get(pool)
+        if semaphore is None:
+            semaphore = self.slots[pool] = asyncio.Semaphore(SLOT_POOLS[pool])
+        deadline = time.monotonic() + DOCKER_QUEUE_SECONDS
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=DOCKER_QUEUE_SECONDS)
+        except asyncio.TimeoutError:
+            return await self._reject(scope, receive, send, DOCKER_QUEUE_SECONDS, "Server is busy starting other labs, try again shortly")
+        holder = None
+        if self.buckets.shared:
+            try:
+                holder = await self._acquire_shared_slot(pool, deadline)
+            except BaseException:
+                semaphore.release()
+                raise
+            if holder is False:
+                semaphore.release()
+                return await self._reject(scope, receive, send, DOCKER_QUEUE_SECONDS, "Server is busy starting other labs, try again shortly")
+        _slots_in_use[pool] += 1
+        released = False
+
+        async def release_slot():
+            nonlocal released
+            if released:
+                return
+            released = True
+            _slots_in_use[pool] -= 1
+            semaphore.release()
+            if holder:
+                await self.buckets.release_slot(pool, holder)
+
+        scope[SLOT_RELEASE_SCOPE_KEY] = release_slot
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await release_slot()
+
+    async def _acquire_shared_slot(self, pool: str, deadline: float):
+        """Holder id of a cluster-wide slot, None if Redis is down (fail open), False on timeout"""
+        holder = uuid.uuid4().hex
+        while True:
+            acquired = await self.buckets.acquire_slot(pool, SLOT_POOLS[pool], holder)
+            if acquired is None:
+                return None
+            if acquired:
+                return holder
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(SLOT_POLL_SECONDS)
+
+    async def _reject(self, scope, receive, send, wait: float, detail: str):
+        response = JSONResponse(
+            {"detail": detail},
+            status_code=429,
+            headers={"Retry-After": str(max(1, int(wait + 0.999)))}
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,104 @@
+"""
+Lab Readiness Module
+Async probe that waits for a freshly started lab to accept connections
+(TCP connect, then HTTP 200 on the lab's web root) before start_lab
+reports it as running, plus a per-catalog-entry time-to-ready histogram.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+
+from app.db import lab_readiness
+from app.http_client import get_http_client
+from app.metrics import LAB_TIME_TO_READY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LAB_READY_TIMEOUT_SECONDS = float(os.getenv("LAB_READY_TIMEOUT_SECONDS", "60"))
+LAB_READY_INITIAL_BACKOFF_SECONDS = float(os.getenv("LAB_READY_INITIAL_BACKOFF_SECONDS", "0.05"))
+LAB_READY_MAX_BACKOFF_SECONDS = float(os.getenv("LAB_READY_MAX_BACKOFF_SECONDS", "1"))
+
+# Path that answers 200 once the lab's web service is up, per access type
+READY_PATHS = {
+    "web_terminal": "/",   # ttyd
+    "web": "/healthz",     # n8n
+}
+
+# Upper bounds (seconds) of the time-to-ready histogram buckets
+READY_BUCKETS = [0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60]
+
+
+async def _tcp_ready(host: str, port: int) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=1)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def _http_ready(upstream: str, path: str) -> bool:
+    try:
+        resp = await get_http_client().get(f"http://{upstream}{path}", timeout=2, follow_redirects=True)
+    except httpx.HTTPError:
+        return False
+    return resp.status_code == 200
+
+
+async def wait_until_ready(upstream: str, access_type: str, timeout: float = LAB_READY_TIMEOUT_SECONDS) -> Optional[float]:
+    """Probe host:port until it serves HTTP 200; returns seconds taken, None on timeout"""
+    host, port = upstream.rsplit(":", 1)
+    path = READY_PATHS.get(access_type, "/")
+    started = time.monotonic()
+    deadline = started + timeout
+    backoff = LAB_READY_INITIAL_BACKOFF_SECONDS
+    tcp_open = False
+
+    while time.monotonic() < deadline:
+        # The TCP check is cheap; only start issuing HTTP requests once the port is open
+        if not tcp_open:
+            tcp_open = await _tcp_ready(host, int(port))
+        if tcp_open and await _http_ready(upstream, path):
+            return time.monotonic() - started
+        await asyncio.sleep(min(backoff, max(deadline - time.monotonic(), 0)))
+        backoff = min(backoff * 2, LAB_READY_MAX_BACKOFF_SECONDS)
+    return None
+
+
+def record_time_to_ready(lab_id: str, seconds: Optional[float]):
+    """Add one observation (None = timed out) to the lab's histogram"""
+    if seconds is None:
+        inc = {"timeouts": 1}
+    else:
+        bucket = next((str(b) for b in READY_BUCKETS if seconds <= b), "inf")
+        inc = {f"buckets.{bucket.replace('.', '_')}": 1, "count": 1, "sum_seconds": seconds}
+        LAB_TIME_TO_READY_SECONDS.labels(lab_id).observe(seconds)
+    lab_readiness.update_one({"_id": lab_id}, {"$inc": inc}, upsert=True)
+
+
+def get_readiness_histograms() -> dict:
+    """Cumulative time-to-ready histograms keyed by lab id"""
+    histograms = {}
+    for doc in lab_readiness.find():
+        raw = doc.get("buckets", {})
+        cumulative, running = {}, 0
+        for bound in [str(b) for b in READY_BUCKETS] + ["inf"]:
+            running += raw.get(bound.replace(".", "_"), 0)
+            cumulative[bound] = running
+        count = doc.get("count", 0)
+        histograms[doc["_id"]] = {
+            "buckets": cumulative,
+            "count": count,
+            "sum_seconds": round(doc.get("sum_seconds", 0), 3),
+            "mean_seconds": round(doc["sum_seconds"] / count, 3) if count else None,
+            "timeouts": doc.get("timeouts", 0)
+        }
+    return histograms
@@ -2,15 +2,29 @@
 Service Controller - Shared Container Architecture
 Creates ONE shared container per service type, multiple user databases per container
 """
-import subprocess
+import os
+import time
 import secrets
 import string
 import hashlib
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+from pymongo.errors import DuplicateKeyError
 from app.db import service_instances
 from app.notifications import create_notification
+from app.events import publish_event
+from app.metrics import SERVICE_PROVISION_SECONDS
+from app.container_runtime import get_runtime, ContainerRuntimeError
+from app.coordination import acquire_lease, release_lease, OWNER_ID
+from app.tracing import span
 
 # Shared container names (one per service type)
+# A claim still provisioning after this long belongs to a worker that died mid-start
+SERVICE_CLAIM_TIMEOUT_SECONDS = int(os.getenv("SERVICE_CLAIM_TIMEOUT_SECONDS", "300"))
+# Longest a first start waits for another worker to create the shared container
+SHARED_CONTAINER_LEASE_SECONDS = 120
+
 SHARED_CONTAINERS = {
     "mysql": "selfmade-mysql-shared",
     "postgresql": "selfmade-postgresql-shared",
@@ -65,85 +79,79 @@ def hash_email(email: str) -> str:
 
 def ensure_shared_container_running(service_id: str) -> bool:
     """Ensure shared container for service type is running"""
+    if get_runtime().container_state(SHARED_CONTAINERS[service_id]) == "running":
+        return True
+
+    # Concurrent first starts (on any worker or node) would race on the
+    # container name, so one creates it while the others wait, then find it running
+    lease = f"shared-container:{service_id}"
+    owner = f"{OWNER_ID}:{uuid.uuid4().hex}"
+    deadline = time.monotonic() + SHARED_CONTAINER_LEASE_SECONDS
+    while not acquire_lease(lease, SHARED_CONTAINER_LEASE_SECONDS, owner):
+        if time.monotonic() > deadline:
+            print(f"Timed out waiting for shared container {SHARED_CONTAINERS[service_id]}")
+            return False
+        time.sleep(0.5)
+    try:
+        return _start_shared_container(service_id)
+    finally:
+        release_lease(lease, owner)
+
+def _start_shared_container(service_id: str) -> bool:
     container_name = SHARED_CONTAINERS[service_id]
     config = SERVICE_CONFIGS[service_id]
+    runtime = get_runtime()
 
     # Check if container exists and is running
-    check_cmd = f"docker ps -q -f name={container_name}"
-    result = subprocess.run(check_cmd, shell=True, capture_output=True, text=True)
+    state = runtime.container_state(container_name)
 
-    if result.stdout.strip():
+    if state == "running":
         # Container is running
         return True
 
-    # Check if container exists but is stopped
-    check_stopped = f"docker ps -aq -f name={container_name}"
-    result_stopped = subprocess.run(check_stopped, shell=True, capture_output=True, text=True)
-
-    if result_stopped.stdout.strip():
-        # Container exists, start it
+    if state is not None:
+        # Container exists but is stopped, start it
         print(f"Starting existing shared container: {container_name}")
-        start_cmd = f"docker start {container_name}"
-        subprocess.run(start_cmd, shell=True)
+        try:
+            runtime.start(container_name)
+        except ContainerRuntimeError as e:
+            print(f"Error starting shared container: {e}")
+            return False
         return True
 
     # Create new shared container
     print(f"Creating new shared container: {container_name}")
 
+    ports = {config["port"]: config["internal_port"]}
+    command = None
     if service_id == "mysql":
-        cmd = (
-            f"docker run -d "
-            f"--name {container_name} "
-            f"-p {config['port']}:{config['internal_port']} "
-            f"-e MYSQL_ROOT_PASSWORD={config['root_password']} "
-            f"{config['image']}"
-        )
+        env = {"MYSQL_ROOT_PASSWORD": config["root_password"]}
     elif service_id == "postgresql":
-        cmd = (
-            f"docker run -d "
-            f"--name {container_name} "
-            f"-p {config['port']}:{config['internal_port']} "
-            f"-e POSTGRES_PASSWORD={config['root_password']} "
-            f"{config['image']}"
-        )
+        env = {"POSTGRES_PASSWORD": config["root_password"]}
     elif service_id == "mongodb":
-        cmd = (
-            f"docker run -d "
-            f"--name {container_name} "
-            f"-p {config['port']}:{config['internal_port']} "
-            f"-e MONGO_INITDB_ROOT_USERNAME=admin "
-            f"-e MONGO_INITDB_ROOT_PASSWORD={config['root_password']} "
-            f"{config['image']}"
-        )
+        env = {
+            "MONGO_INITDB_ROOT_USERNAME": "admin",
+            "MONGO_INITDB_ROOT_PASSWORD": config["root_password"]
+        }
     elif service_id == "redis":
-        cmd = (
-            f"docker run -d "
-            f"--name {container_name} "
-            f"-p {config['port']}:{config['internal_port']} "
-            f"{config['image']} "
-            f"redis-server --requirepass {config['root_password']}"
-        )
+        env = {}
+        command = ["redis-server", "--requirepass", config["root_password"]]
     elif service_id == "rabbitmq":
-        cmd = (
-            f"docker run -d "
-            f"--name {container_name} "
-            f"-p {config['port']}:{config['internal_port']} "
-            f"-p {config['management_port']}:15672 "
-            f"-e RABBITMQ_DEFAULT_USER=admin "
-            f"-e RABBITMQ_DEFAULT_PASS={config['root_password']} "
-            f"{config['image']}"
-        )
+        env = {
+            "RABBITMQ_DEFAULT_USER": "admin",
+            "RABBITMQ_DEFAULT_PASS": config["root_password"]
+        }
+        ports[config["management_port"]] = 15672
     else:
         return False
 
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
-    if result.returncode != 0:
-        print(f"Error creating shared container: {result.stderr}")
+    try:
+        runtime.run(config["image"], container_name, command, env=env, ports=ports)
+    except ContainerRuntimeError as e:
+        print(f"Error creating shared container: {e}")
         return False
 
     # Wait for container to be ready
-    import time
     time.sleep(3)
 
     return True
@@ -161,18 +169,18 @@ def create_user_database(service_id: str, user_email: str, db_name: str, user_pa
         GRANT ALL PRIVILEGES ON {db_name}.* TO '{db_name}'@'%';
         FLUSH PRIVILEGES;
         """
-        cmd = f'docker exec {container_name} mysql -uroot -p{config["root_password"]} -e "{sql_commands}"'
+        commands = [["mysql", "-uroot", f"-p{config['root_password']}", "-e", sql_commands]]
 
     elif service_id == "postgresql":
         # Create database and user
-        cmd = (
-            f'docker exec {container_name} psql -U postgres -c '
-            f'"CREATE DATABASE {db_name};" && '
-            f'docker exec {container_name} psql -U postgres -c '
-            f'"CREATE USER {db_name} WITH PASSWORD \'{user_password}\';" && '
-            f'docker exec {container_name} psql -U postgres -c '
-            f'"GRANT ALL PRIVILEGES ON DATABASE {db_name} TO {db_name};"'
-        )
+        commands = [
+            ["psql", "-U", "postgres", "-c", sql]
+            for sql in (
+                f"CREATE DATABASE {db_name};",
+                f"CREATE USER {db_name} WITH PASSWORD '{user_password}';",
+                f"GRANT ALL PRIVILEGES ON DATABASE {db_name} TO {db_name};"
+            )
+        ]
 
     elif service_id == "mongodb":
         # Create database (will be created on first use, but we can create user)
@@ -184,39 +192,89 @@ def create_user_database(service_id: str, user_email: str, db_name: str, user_pa
             roles: [{{ role: 'readWrite', db: '{db_name}' }}]
         }});
         """
-        cmd = f'docker exec {container_name} mongosh -u admin -p {config["root_password"]} --authenticationDatabase admin --eval "{mongo_cmd}"'
+        commands = [_mongosh(config, mongo_cmd)]
 
     else:
         # Redis and RabbitMQ don't need database creation
         return True
 
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
-    if result.returncode != 0:
-        print(f"Error creating user database: {result.stderr}")
+    try:
+        for command in commands:
+            get_runtime().exec(container_name, command)
+    except ContainerRuntimeError as e:
+        print(f"Error creating user database: {e}")
         return False
 
     return True
 
+def _mongosh(config: dict, script: str) -> list:
+    return ["mongosh", "-u", "admin", "-p", config["root_password"], "--authenticationDatabase", "admin", "--eval", script]
+
+def _exec_quietly(container_name: str, commands: list):
+    """Run cleanup commands in a shared container; failures are only reported"""
+    for command in commands:
+        try:
+            get_runtime().exec(container_name, command)
+        except ContainerRuntimeError as e:
+            print(f"Warning: {command[0]} in {container_name} failed: {e}")
+
+def claim_redis_db(claim_id) -> Optional[int]:
+    """Atomically assign a free Redis DB number (0-15) to a service claim"""
+    for db_number in range(16):
+        try:
+            service_instances.update_one({"_id": claim_id}, {"$set": {"redis_db": db_number}})
+            return db_number
+        except DuplicateKeyError:
+            # Another active tenant holds this number
+            continue
+    return None
+
 def start_service(user_email: str, service_id: str):
     """Start a service for user (create user database in shared container)"""
 
-    # Check if user already has this service running
-    existing = service_instances.find_one({
-        "user_email": user_email,
-        "service": service_id,
-        "status": "running"
-    })
+    # Claim the (user, service) slot first; the unique partial index on active
+    # instances rejects a concurrent start from any worker
+    with span("claim_instance"):
+        try:
+            claim_id = service_instances.insert_one({
+                "user_email": user_email,
+                "service": service_id,
+                "status": "provisioning",
+                "active": True,
+                "started_at": datetime.utcnow()
+            }).inserted_id
+        except DuplicateKeyError:
+            existing = service_instances.find_one({"user_email": user_email, "service": service_id, "active": True})
+            if existing:
+                existing["_id"] = str(existing["_id"])
+            return {
+                "error": f"You already have {service_id} running. Stop it first before starting a new one.",
+                "existing_service": existing
+            }
+
+    started = time.perf_counter()
+    try:
+        result = provision_service(user_email, service_id, claim_id)
+    except BaseException:
+        service_instances.delete_one({"_id": claim_id})
+        raise
+    if "error" in result:
+        service_instances.delete_one({"_id": claim_id})
+    else:
+        SERVICE_PROVISION_SECONDS.labels(service_id).observe(time.perf_counter() - started)
+    return result
 
-    if existing:
-        return {
-            "error": f"You already have {service_id} running. Stop it first before starting a new one.",
-            "existing_service": existing
-        }
+def reap_stale_service_claims() -> int:
+    """Release claims left "provisioning" by a worker that died mid-start (run by the leader)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=SERVICE_CLAIM_TIMEOUT_SECONDS)
+    return service_instances.delete_many({"status": "provisioning", "started_at": {"$lt": cutoff}}).deleted_count
 
+def provision_service(user_email: str, service_id: str, claim_id):
+    """Create the user's tenant in the shared container and fill in the claimed record"""
     # Ensure shared container is running
-    if not ensure_shared_container_running(service_id):
-        return {"error": f"Failed to start shared {service_id} container"}
+    with span("ensure_shared_container", container=SHARED_CONTAINERS[service_id]):
+        if not ensure_shared_container_running(service_id):
+            return {"error": f"Failed to start shared {service_id} container"}
 
     config = SERVICE_CONFIGS[service_id]
 
@@ -226,32 +284,30 @@ def start_service(user_email: str, service_id: str):
     db_password = generate_password()
 
     # Create user database (for MySQL, PostgreSQL, MongoDB)
-    if service_id in ["mysql", "postgresql", "mongodb"]:
-        if not create_user_database(service_id, user_email, db_name, db_password):
-            return {"error": f"Failed to create user database in {service_id}"}
+    with span("create_user_database", database=db_name):
+        if service_id in ["mysql", "postgresql", "mongodb"]:
+            if not create_user_database(service_id, user_email, db_name, db_password):
+                return {"error": f"Failed to create user database in {service_id}"}
 
     # For Redis, assign a DB number (0-15)
     redis_db = None
-    if service_id == "redis":
-        # Get all Redis instances and find unused DB number
-        redis_instances = list(service_instances.find({
-            "service": "redis",
-            "status": "running"
-        }))
-        used_dbs = [inst.get("credentials", {}).get("database", 0) for inst in redis_instances]
-        redis_db = next((i for i in range(16) if i not in used_dbs), 0)
+    with span("claim_redis_db"):
+        if service_id == "redis":
+            redis_db = claim_redis_db(claim_id)
+            if redis_db is None:
+                return {"error": "All Redis databases are in use"}
 
     # For RabbitMQ, create virtual host
     rabbitmq_vhost = None
-    if service_id == "rabbitmq":
-        rabbitmq_vhost = f"/user_{email_hash}"
-        # Create virtual host
-        container_name = SHARED_CONTAINERS[service_id]
-        vhost_cmd = f'docker exec {container_name} rabbitmqctl add_vhost {rabbitmq_vhost}'
-        subprocess.run(vhost_cmd, shell=True)
-        # Set permissions
-        perm_cmd = f'docker exec {container_name} rabbitmqctl set_permissions -p {rabbitmq_vhost} admin ".*" ".*" ".*"'
-        subprocess.run(perm_cmd, shell=True)
+    with span("create_vhost"):
+        if service_id == "rabbitmq":
+            rabbitmq_vhost = f"/user_{email_hash}"
+            # Create virtual host
+            # Create virtual host, then set permissions
+            _exec_quietly(SHARED_CONTAINERS[service_id], [
+                ["rabbitmqctl", "add_vhost", rabbitmq_vhost],
+                ["rabbitmqctl", "set_permissions", "-p", rabbitmq_vhost, "admin", ".*", ".*", ".*"]
+            ])
 
     # Build credentials and connection info
     credentials = {
@@ -287,21 +343,23 @@ def start_service(user_email: str, service_id: str):
             "port": credentials["port"],
             "connection_string": connection_string
         },
-        "status": "running",
-        "started_at": datetime.utcnow()
+        "status": "running"
     }
 
-    result = service_instances.insert_one(service_data)
-    service_data["_id"] = str(result.inserted_id)
+    with span("record_instance"):
+        service_instances.update_one({"_id": claim_id}, {"$set": service_data})
+    service_data["_id"] = str(claim_id)
+    publish_event(user_email, "service", {"action": "started", "service_id": service_id})
 
     # Create notification
-    create_notification(
-        user_email=user_email,
-        notif_type="service_started",
-        title=f"{service_id.upper()} Started",
-        message=f"Your {service_id} database is ready to use",
-        metadata={"service_id": service_id, "port": config["port"]}
-    )
+    with span("notification"):
+        create_notification(
+            user_email=user_email,
+            notif_type="service_started",
+            title=f"{service_id.upper()} Started",
+            message=f"Your {service_id} database is ready to use",
+            metadata={"service_id": service_id, "port": config["port"]}
+        )
 
     return service_data
 
@@ -367,34 +425,29 @@ def stop_service(user_email: str, service_id: str):
             DROP USER IF EXISTS '{db_name}'@'%';
             FLUSH PRIVILEGES;
             """
-            cmd = f'docker exec {container_name} mysql -uroot -p{config["root_password"]} -e "{sql_commands}"'
-            subprocess.run(cmd, shell=True)
+            _exec_quietly(container_name, [["mysql", "-uroot", f"-p{config['root_password']}", "-e", sql_commands]])
 
         elif service_id == "postgresql":
-            cmd = (
-                f'docker exec {container_name} psql -U postgres -c '
-                f'"DROP DATABASE IF EXISTS {db_name};" && '
-                f'docker exec {container_name} psql -U postgres -c '
-                f'"DROP USER IF EXISTS {db_name};"'
-            )
-            subprocess.run(cmd, shell=True)
+            _exec_quietly(container_name, [
+                ["psql", "-U", "postgres", "-c", f"DROP DATABASE IF EXISTS {db_name};"],
+                ["psql", "-U", "postgres", "-c", f"DROP USER IF EXISTS {db_name};"]
+            ])
 
         elif service_id == "mongodb":
             mongo_cmd = f"db.getSiblingDB('{db_name}').dropDatabase();"
-            cmd = f'docker exec {container_name} mongosh -u admin -p {config["root_password"]} --authenticationDatabase admin --eval "{mongo_cmd}"'
-            subprocess.run(cmd, shell=True)
+            _exec_quietly(container_name, [_mongosh(config, mongo_cmd)])
 
     # For RabbitMQ, delete virtual host
     if service_id == "rabbitmq":
         vhost = instance["credentials"]["vhost"]
-        cmd = f'docker exec {container_name} rabbitmqctl delete_vhost {vhost}'
-        subprocess.run(cmd, shell=True)
+        _exec_quietly(container_name, [["rabbitmqctl", "delete_vhost", vhost]])
 
     # Update database
     service_instances.update_one(
         {"_id": instance["_id"]},
-        {"$set": {"status": "stopped"}}
+        {"$set": {"status": "stopped", "stopped_at": datetime.utcnow()}, "$unset": {"active": ""}}
     )
+    publish_event(user_email, "service", {"action": "stopped", "service_id": service_id})
 
     # Create notification
     create_notification(
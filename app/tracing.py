@@ -0,0 +1,211 @@
+"""
+Tracing Module
+Minimal phase-level tracing for the slow multi-step operations (lab and
+service start, user deletion). A root span is opened per operation with
+request and user context; phases inside it are child spans. Finished
+traces are kept in a per-worker ring buffer for the admin "slowest
+traces" view and, if TRACE_EXPORT_PATH is set, appended to it by a
+writer thread: one OTLP/JSON ExportTraceServiceRequest per line (the
+format the OpenTelemetry Collector's otlpjsonfile receiver reads).
+The current span travels in a contextvar, so it follows the request
+into run_in_threadpool calls.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import threading
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+# The export file is rotated to <path>.1 once it grows past this size
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(100 * 1024 * 1024)))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+SERVICE_NAME = "selfmade-labs"
+# Traces waiting for the writer; more than this are dropped rather than block requests
+EXPORT_QUEUE_SIZE = 1000
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_recent = deque(maxlen=TRACE_BUFFER_SIZE)
+_export_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+_writer_lock = threading.Lock()
+_writer_started = False
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "error", "children")
+
+    def __init__(self, trace_id: str, name: str, parent: "Optional[Span]", attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        # Only the root collects the spans of its trace (shared across threads)
+        self.children = [] if parent is None else parent.children
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_otlp(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """Open a sampled root span; yields None (and records nothing) when not sampled"""
+    if random.random() >= TRACE_SAMPLE_RATE:
+        token = _current_span.set(None)
+        try:
+            yield None
+        finally:
+            _current_span.reset(token)
+        return
+
+    root = Span(uuid.uuid4().hex, name, None, attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = str(e)
+        raise
+    finally:
+        root.end_ns = time.time_ns()
+        _current_span.reset(token)
+        _export(root)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Child span of the current trace; a no-op outside a sampled trace"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace_id, name, parent, attributes)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = str(e)
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        _current_span.reset(token)
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, if any"""
+    current = _current_span.get()
+    if current is not None:
+        current.set_attributes(**attributes)
+
+
+def mark_error(message: str):
+    """Flag the current span as failed (for errors returned rather than raised)"""
+    current = _current_span.get()
+    if current is not None:
+        current.error = message
+
+
+def _export(root: Span):
+    _recent.append(root)
+    if not TRACE_EXPORT_PATH:
+        return
+    _start_writer()
+    try:
+        _export_queue.put_nowait(root)
+    except queue.Full:
+        logger.warning(f"Trace export queue full, dropping trace {root.trace_id}")
+
+
+def _start_writer():
+    global _writer_started
+    if _writer_started:
+        return
+    with _writer_lock:
+        if not _writer_started:
+            threading.Thread(target=_writer_loop, daemon=True).start()
+            _writer_started = True
+
+
+def _export_request(root: Span) -> dict:
+    """One trace as an OTLP/JSON ExportTraceServiceRequest"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [item.to_otlp() for item in [root] + root.children],
+            }],
+        }]
+    }
+
+
+def _writer_loop():
+    while True:
+        root = _export_queue.get()
+        try:
+            if os.path.exists(TRACE_EXPORT_PATH) and os.path.getsize(TRACE_EXPORT_PATH) > TRACE_EXPORT_MAX_BYTES:
+                os.replace(TRACE_EXPORT_PATH, TRACE_EXPORT_PATH + ".1")
+            with open(TRACE_EXPORT_PATH, "a") as f:
+                f.write(json.dumps(_export_request(root)) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to export trace {root.trace_id}: {e}")
+
+
+def slowest_traces(limit: int = 20, name: Optional[str] = None) -> list:
+    """Slowest recent traces in this worker, each broken down by phase"""
+    roots = [root for root in list(_recent) if name is None or root.name == name]
+    roots.sort(key=lambda root: root.duration_ms, reverse=True)
+    return [
+        {
+            "trace_id": root.trace_id,
+            "name": root.name,
+            "attributes": root.attributes,
+            "started_at": root.start_ns // 1_000_000,
+            "duration_ms": round(root.duration_ms, 2),
+            "error": root.error,
+            "phases": [
+                {
+                    "name": child.name,
+                    "offset_ms": round((child.start_ns - root.start_ns) / 1e6, 2),
+                    "duration_ms": round(child.duration_ms, 2),
+                    "depth": 1 if child.parent_id == root.span_id else 2,
+                    "error": child.error,
+                    "attributes": child.attributes,
+                }
+                for child in sorted(root.children, key=lambda child: child.start_ns)
+            ],
+        }
+        for root in roots[:limit]
+    ]
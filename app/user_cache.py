@@ -0,0 +1,157 @@
+"""
+Authenticated User Cache
+Bounded LRU/TTL cache of user documents used by get_current_user.
+Entries are keyed by email and the token's iat, invalidated locally on
+writes and across workers through version stamps in user_cache_versions.
+A user read from Mongo is only cached if no stamp newer than the read has
+been seen, so an eviction racing a slow lookup cannot be undone by it.
+"""
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.db import user_cache_versions
+from app.metrics import USER_CACHE_LOOKUPS, USER_CACHE_INVALIDATIONS, USER_CACHE_STALE_WRITES, USER_CACHE_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_POLL_SECONDS = float(os.getenv("USER_CACHE_POLL_SECONDS", "1"))
+
+# Look back a little further than the last poll to tolerate clock skew between nodes
+VERSION_SKEW_SECONDS = 5
+
+# Version stamps only need to outlive the cache TTL
+user_cache_versions.create_index("email", unique=True)
+user_cache_versions.create_index("updated_at", expireAfterSeconds=3600)
+
+
+class UserCache:
+    """Thread-safe LRU cache of user documents with per-entry TTL"""
+
+    def __init__(self, max_size: int = USER_CACHE_MAX_SIZE, ttl: float = USER_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # email -> (iat, user, expires_at)
+        self._lock = threading.Lock()
+        self._seen_versions = {}  # email -> newest version stamp seen
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_writes = 0
+        self.lookup_seconds = 0.0
+        self.lookups = 0
+
+    def get(self, email: str, iat):
+        """Cached user for this email/iat, or None"""
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry and entry[0] == iat and entry[2] > time.monotonic():
+                self._entries.move_to_end(email)
+                self.hits += 1
+                USER_CACHE_LOOKUPS.labels("hit").inc()
+                return dict(entry[1])
+            self.misses += 1
+            USER_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+
+    def put(self, email: str, iat, user: dict, read_at: datetime):
+        """Cache a user read from Mongo at read_at (UTC), unless a newer version stamp was seen since"""
+        with self._lock:
+            stamp = self._seen_versions.get(email)
+            # Stamps come from other nodes' clocks, so allow for the same skew as the poller
+            if stamp is not None and stamp > read_at - timedelta(seconds=VERSION_SKEW_SECONDS):
+                self.stale_writes += 1
+                USER_CACHE_STALE_WRITES.inc()
+                return
+            self._entries[email] = (iat, dict(user), time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            USER_CACHE_ENTRIES.set(len(self._entries))
+
+    def evict(self, email: str):
+        with self._lock:
+            if self._entries.pop(email, None) is not None:
+                self.invalidations += 1
+                USER_CACHE_INVALIDATIONS.inc()
+                USER_CACHE_ENTRIES.set(len(self._entries))
+
+    def record_lookup(self, seconds: float):
+        with self._lock:
+            self.lookup_seconds += seconds
+            self.lookups += 1
+
+    def apply_versions(self, stamps):
+        """Evict entries whose version stamp changed since we last saw it"""
+        for stamp in stamps:
+            email, updated_at = stamp["email"], stamp["updated_at"]
+            with self._lock:
+                changed = self._seen_versions.get(email) != updated_at
+                if changed:
+                    self._seen_versions[email] = updated_at
+            if changed:
+                self.evict(email)
+
+    def forget_versions(self, before: datetime):
+        """Drop stamps older than before, which can no longer block a put"""
+        with self._lock:
+            self._seen_versions = {
+                email: updated_at for email, updated_at in self._seen_versions.items()
+                if updated_at > before
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+                "stale_writes": self.stale_writes,
+                "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000, 3) if self.lookups else 0.0
+            }
+
+
+user_cache = UserCache()
+
+
+def invalidate_user(email: str):
+    """Drop a user from this worker's cache and stamp a new version for the others"""
+    updated_at = datetime.utcnow()
+    user_cache.apply_versions([{"email": email, "updated_at": updated_at}])
+    user_cache.evict(email)
+    user_cache_versions.update_one(
+        {"email": email},
+        {"$set": {"updated_at": updated_at}},
+        upsert=True
+    )
+
+
+def version_poller(stop_event: threading.Event):
+    """Apply version stamps written by other workers"""
+    last_poll = datetime.utcnow()
+    while not stop_event.wait(USER_CACHE_POLL_SECONDS):
+        since = last_poll - timedelta(seconds=VERSION_SKEW_SECONDS)
+        last_poll = datetime.utcnow()
+        try:
+            user_cache.apply_versions(user_cache_versions.find({"updated_at": {"$gt": since}}))
+        except Exception as e:
+            logger.error(f"User cache version poll failed: {e}")
+
+        # Forget stamps that can no longer be returned by the window above
+        user_cache.forget_versions(since)
+
+
+def start_version_poller() -> threading.Event:
+    """Start the cross-worker invalidation poller, returns its stop event"""
+    stop_event = threading.Event()
+    threading.Thread(target=version_poller, args=(stop_event,), daemon=True).start()
+    return stop_event
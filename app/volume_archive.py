@@ -0,0 +1,218 @@
+"""
+Volume Archive Module
+Streams a user's home volume out as a .tar.gz and back in, chunk by chunk.
+The first export streams straight from a helper container while being
+spooled to disk; later requests (including ranged resumes) are served
+from that spooled copy together with its SHA-256 checksum.
+"""
+import os
+import re
+import time
+import uuid
+import hashlib
+import asyncio
+import logging
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from app.db import users, lab_instances
+from app.volume_manager import get_user_volume_name
+from app.volume_usage import effective_quotas
+from app.container_runtime import cli_binary
+
+logger = logging.getLogger(__name__)
+
+HOME_ARCHIVE_IMAGE = os.getenv("HOME_ARCHIVE_IMAGE", "alpine:3.19")
+HOME_EXPORT_DIR = os.getenv("HOME_EXPORT_DIR", "exports")
+HOME_EXPORT_TTL_SECONDS = int(os.getenv("HOME_EXPORT_TTL_SECONDS", "3600"))
+CHUNK_SIZE = 64 * 1024
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ArchiveError(Exception):
+    """Raised when an export fails or an import cannot be verified or applied"""
+
+
+def export_path(volume_name: str) -> str:
+    return os.path.join(HOME_EXPORT_DIR, f"{volume_name}.tar.gz")
+
+
+def cached_export(user_email: str) -> Optional[dict]:
+    """Spooled export for a user if one is fresh and no lab wrote to the volume since: {path, size, sha256}"""
+    volume_name = get_user_volume_name(user_email)
+    path = export_path(volume_name)
+    if not os.path.exists(path) or not os.path.exists(path + ".sha256"):
+        return None
+    spooled_at = os.path.getmtime(path)
+    if time.time() - spooled_at > HOME_EXPORT_TTL_SECONDS:
+        return None
+    # Every lab of the user mounts this volume read-write
+    written_since = lab_instances.count_documents({
+        "user_email": user_email,
+        "$or": [
+            {"status": {"$in": ["starting", "running"]}},
+            {"stopped_at": {"$gte": datetime.utcfromtimestamp(spooled_at)}},
+        ]
+    }, limit=1)
+    if written_since:
+        return None
+    with open(path + ".sha256") as f:
+        checksum = f.read().strip()
+    return {"path": path, "size": os.path.getsize(path), "sha256": checksum}
+
+
+def discard_export(user_email: str):
+    """Remove a spooled export (e.g. when the user is deleted)"""
+    path = export_path(get_user_volume_name(user_email))
+    for leftover in (path, path + ".sha256"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+async def stream_export(user_email: str) -> AsyncIterator[bytes]:
+    """Tar+gzip the user's volume, yielding chunks while spooling them for resume"""
+    volume_name = get_user_volume_name(user_email)
+    os.makedirs(HOME_EXPORT_DIR, exist_ok=True)
+    final_path = export_path(volume_name)
+    temp_path = f"{final_path}.{uuid.uuid4().hex}.part"
+
+    proc = await asyncio.create_subprocess_exec(
+        cli_binary(), "run", "--rm", "--network", "none",
+        "-v", f"{volume_name}:/data:ro",
+        HOME_ARCHIVE_IMAGE, "tar", "-C", "/data", "-czf", "-", ".",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # Drained alongside stdout so a noisy tar cannot fill the pipe and stall
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    digest = hashlib.sha256()
+    completed = False
+    try:
+        with open(temp_path, "wb") as spool:
+            while True:
+                chunk = await proc.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                spool.write(chunk)
+                yield chunk
+        returncode = await proc.wait()
+        if returncode != 0:
+            stderr = (await stderr_task).decode(errors="replace")
+            logger.error(f"Export of {volume_name} failed: {stderr}")
+            # Headers are already sent: raising aborts the connection, so the
+            # client sees a truncated download instead of a clean EOF
+            raise ArchiveError(f"Export of {volume_name} failed")
+        os.replace(temp_path, final_path)
+        with open(final_path + ".sha256", "w") as f:
+            f.write(digest.hexdigest())
+        completed = True
+        logger.info(f"Exported {volume_name} ({os.path.getsize(final_path)} bytes)")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
+        if not completed and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def parse_range(range_header: str, size: int):
+    """(start, end) inclusive for a single bytes range, None if absent; ValueError if unsatisfiable"""
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        raise ValueError("Unsupported range")
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+async def stream_file(path: str, start: int = 0, end: int = None) -> AsyncIterator[bytes]:
+    """Yield a byte range of a file in fixed-size chunks"""
+    end = os.path.getsize(path) - 1 if end is None else end
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def import_limit_bytes(user_email: str) -> int:
+    """Largest upload accepted for a user: their hard home quota"""
+    user = users.find_one({"email": user_email}, {"volume_soft_quota_mb": 1, "volume_hard_quota_mb": 1}) or {}
+    return effective_quotas(user)[1] * 1024 * 1024
+
+
+async def import_archive(user_email: str, chunks: AsyncIterator[bytes], expected_sha256: str = None) -> dict:
+    """
+    Restore a .tar.gz into the user's volume.
+    The upload is spooled to disk (up to the user's hard quota) and its
+    checksum verified before anything is extracted.
+    """
+    volume_name = get_user_volume_name(user_email)
+    os.makedirs(HOME_EXPORT_DIR, exist_ok=True)
+    max_bytes = await asyncio.to_thread(import_limit_bytes, user_email)
+    digest = hashlib.sha256()
+    size = 0
+
+    with tempfile.NamedTemporaryFile(dir=HOME_EXPORT_DIR, suffix=".upload", delete=False) as spool:
+        spool_path = spool.name
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ArchiveError(f"Archive exceeds the {max_bytes // (1024 * 1024)} MB home quota")
+                digest.update(chunk)
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            os.remove(spool_path)
+            raise
+
+    try:
+        checksum = digest.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != checksum:
+            raise ArchiveError(f"Checksum mismatch: expected {expected_sha256}, got {checksum}")
+
+        proc = await asyncio.create_subprocess_exec(
+            cli_binary(), "run", "--rm", "-i", "--network", "none",
+            "-v", f"{volume_name}:/data",
+            HOME_ARCHIVE_IMAGE, "tar", "-C", "/data", "-xzf", "-",
+            stdin=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stderr_task = asyncio.create_task(proc.stderr.read())
+        try:
+            async for chunk in stream_file(spool_path):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # tar gave up early (e.g. not a gzip stream); its stderr says why
+            pass
+        await proc.wait()
+        stderr = await stderr_task
+        if proc.returncode != 0:
+            raise ArchiveError(f"Extract failed: {stderr.decode(errors='replace').strip() or 'archive rejected'}")
+    finally:
+        os.remove(spool_path)
+
+    # The spooled export no longer matches the volume
+    discard_export(user_email)
+
+    logger.info(f"Imported {size} bytes into {volume_name}")
+    return {"volume": volume_name, "bytes": size, "sha256": checksum}
@@ -4,13 +4,106 @@ Manages persistent Docker volumes for user labs.
 Each user gets ONE volume shared across ALL their labs.
 """
 
-import subprocess
+import threading
 import logging
 from typing import Optional
 
+from app.db import volume_usage
+from app.home_templates import seed_volume, update_volume_from_template, forget_volume
+from app.container_runtime import get_runtime, ContainerRuntimeError
+
 logger = logging.getLogger(__name__)
 
 
+class VolumeRegistry:
+    """
+    In-memory set of Docker volume names.
+
+    Loaded with one volume listing and kept current by following the
+    runtime's volume events, so existence checks need no runtime call.
+    """
+
+    def __init__(self):
+        self._names = set()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._events = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self):
+        """Replace the registry with a fresh bulk listing"""
+        names = get_runtime().list_volumes()
+        with self._lock:
+            self._names = set(names)
+            self._loaded = True
+        logger.info(f"Volume registry loaded with {len(self._names)} volumes")
+
+    def contains(self, volume_name: str) -> bool:
+        with self._lock:
+            return volume_name in self._names
+
+    def add(self, volume_name: str):
+        with self._lock:
+            self._names.add(volume_name)
+
+    def discard(self, volume_name: str):
+        with self._lock:
+            self._names.discard(volume_name)
+
+    def names(self) -> list:
+        with self._lock:
+            return sorted(self._names)
+
+    def watch(self, stop_event: threading.Event):
+        """Follow volume events until stop() is called"""
+        while not stop_event.is_set():
+            try:
+                # Subscribe before listing so nothing created or removed in
+                # between is missed; reload on every (re)connect for the same reason
+                self._events = get_runtime().events("volume")
+                if stop_event.is_set():
+                    break
+                self.load()
+                for event in self._events:
+                    self._apply_event(event)
+            except (OSError, ContainerRuntimeError) as e:
+                # Until the next reload, existence checks go to the runtime
+                self._loaded = False
+                logger.error(f"Volume event watcher failed: {e}")
+            finally:
+                if self._events is not None:
+                    self._events.close()
+            stop_event.wait(5)
+
+    def stop(self, stop_event: threading.Event):
+        """Stop watching: set stop_event and close the open event stream"""
+        stop_event.set()
+        if self._events is not None:
+            self._events.close()
+
+    def _apply_event(self, event: dict):
+        name = event.get("name")
+        if not name:
+            return
+        if event.get("action") == "create":
+            self.add(name)
+        elif event.get("action") == "destroy":
+            self.discard(name)
+
+
+volume_registry = VolumeRegistry()
+
+
+def start_volume_registry() -> threading.Event:
+    """Start the volume event watcher, returns the event that stops it"""
+    stop_event = threading.Event()
+    threading.Thread(target=volume_registry.watch, args=(stop_event,), daemon=True).start()
+    return stop_event
+
+
 def get_username_from_email(user_email: str) -> str:
     """
     Extract clean username from email for use as Linux username.
@@ -61,21 +154,25 @@ def volume_exists(volume_name: str) -> bool:
     Returns:
         True if volume exists, False otherwise
     """
+    if volume_registry.loaded:
+        return volume_registry.contains(volume_name)
+
     try:
-        cmd = ["docker", "volume", "ls", "-q", "-f", f"name=^{volume_name}$"]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return bool(result.stdout.strip())
-    except subprocess.CalledProcessError as e:
+        return get_runtime().inspect_volume(volume_name) is not None
+    except ContainerRuntimeError as e:
         logger.error(f"Error checking volume {volume_name}: {e}")
         return False
 
 
-def create_user_volume_if_not_exists(user_email: str) -> str:
+def create_user_volume_if_not_exists(user_email: str, template: Optional[dict] = None) -> str:
     """
     Create persistent volume for user if it doesn't exist.
+    With a home template, a new volume is seeded from it and an existing
+    one picks up files added by a newer template version.
 
     Args:
         user_email: User's email address
+        template: Home template of the lab being started (its catalog home_template)
 
     Returns:
         Volume name that was created or already exists
@@ -85,19 +182,23 @@ def create_user_volume_if_not_exists(user_email: str) -> str:
     """
     volume_name = get_user_volume_name(user_email)
 
-    # Check if volume already exists
+    # Check if volume already exists (registry hit: no runtime call)
     if volume_exists(volume_name):
         logger.info(f"Volume {volume_name} already exists")
+        if template:
+            update_volume_from_template(volume_name, template)
         return volume_name
 
-    # Create volume
+    # Create volume (volume create is a no-op for an existing volume)
     try:
-        cmd = ["docker", "volume", "create", volume_name]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        get_runtime().create_volume(volume_name)
+        volume_registry.add(volume_name)
         logger.info(f"Created volume: {volume_name}")
+        if template:
+            seed_volume(volume_name, template)
         return volume_name
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Failed to create volume {volume_name}: {e.stderr}"
+    except ContainerRuntimeError as e:
+        error_msg = f"Failed to create volume {volume_name}: {e}"
         logger.error(error_msg)
         raise RuntimeError(error_msg)
 
@@ -122,12 +223,13 @@ def delete_user_volume(user_email: str) -> bool:
 
     # Delete volume
     try:
-        cmd = ["docker", "volume", "rm", volume_name]
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
+        get_runtime().remove_volume(volume_name)
+        volume_registry.discard(volume_name)
+        forget_volume(volume_name)
         logger.info(f"Deleted volume: {volume_name}")
         return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to delete volume {volume_name}: {e.stderr}")
+    except ContainerRuntimeError as e:
+        logger.error(f"Failed to delete volume {volume_name}: {e}")
         return False
 
 
@@ -154,22 +256,8 @@ def get_volume_info(user_email: str) -> Optional[dict]:
         return None
 
     try:
-        cmd = ["docker", "volume", "inspect", volume_name]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-
-        # Parse JSON output
-        import json
-        volume_data = json.loads(result.stdout)
-
-        if volume_data:
-            vol = volume_data[0]
-            return {
-                "name": vol.get("Name"),
-                "driver": vol.get("Driver"),
-                "mountpoint": vol.get("Mountpoint"),
-                "created": vol.get("CreatedAt")
-            }
-    except (subprocess.CalledProcessError, json.JSONDecodeError, IndexError) as e:
+        return get_runtime().inspect_volume(volume_name)
+    except ContainerRuntimeError as e:
         logger.error(f"Failed to get volume info for {volume_name}: {e}")
         return None
 
@@ -182,11 +270,8 @@ def list_all_user_volumes() -> list[dict]:
         List of volume information dictionaries
     """
     try:
-        cmd = ["docker", "volume", "ls", "-f", "name=^user_", "--format", "{{.Name}}"]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-
         volumes = []
-        for volume_name in result.stdout.strip().split('\n'):
+        for volume_name in get_runtime().list_volumes("user_"):
             if volume_name:
                 # Extract email from volume name
                 # user_dharuna457_home -> dharuna457
@@ -197,36 +282,38 @@ def list_all_user_volumes() -> list[dict]:
                 })
 
         return volumes
-    except subprocess.CalledProcessError as e:
+    except ContainerRuntimeError as e:
         logger.error(f"Failed to list user volumes: {e}")
         return []
 
 
+def format_size(num_bytes: int) -> str:
+    """
+    Format a byte count the way docker prints sizes.
+
+    Example:
+        1288490188 -> "1.2GB"
+    """
+    size = float(num_bytes)
+    for unit in ["B", "kB", "MB", "GB"]:
+        if size < 1000:
+            return f"{size:.3g}{unit}"
+        size /= 1000
+    return f"{size:.3g}TB"
+
+
 def get_volume_size(user_email: str) -> Optional[str]:
     """
     Get the size of user's volume (disk usage).
-    Note: This requires docker system df -v command.
+    Note: Reads the size cached by the background usage scanner
+    (app.volume_usage) instead of running docker system df.
 
     Args:
         user_email: User's email address
 
     Returns:
-        Size string (e.g., "1.2GB") or None if unable to determine
+        Size string (e.g., "1.2GB") or None if not scanned yet
     """
     volume_name = get_user_volume_name(user_email)
-
-    try:
-        cmd = ["docker", "system", "df", "-v", "--format", "{{.Name}}\t{{.Size}}"]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-
-        # Parse output to find our volume
-        for line in result.stdout.strip().split('\n'):
-            if '\t' in line:
-                name, size = line.split('\t', 1)
-                if name == volume_name:
-                    return size
-
-        return None
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to get volume size for {volume_name}: {e}")
-        return None
+    usage = volume_usage.find_one({"_id": volume_name})
+    return format_size(usage["bytes"]) if usage else None
@@ -0,0 +1,172 @@
+"""
+Volume Usage Module
+Background scanner that measures user_*_home volumes in bulk and caches
+the sizes in the volume_usage collection, plus per-user soft/hard quotas
+enforced by start_lab.
+"""
+import os
+import threading
+import logging
+from datetime import datetime
+from typing import Optional
+
+from app.db import users, lab_instances, volume_usage
+from app.volume_manager import get_user_volume_name, list_all_user_volumes, volume_exists, format_size
+from app.user_cache import invalidate_user
+from app.coordination import is_leader
+from app.container_runtime import get_runtime, ContainerRuntimeError
+
+logger = logging.getLogger(__name__)
+
+VOLUME_SCAN_INTERVAL_SECONDS = int(os.getenv("VOLUME_SCAN_INTERVAL_SECONDS", "300"))
+VOLUME_FULL_SCAN_EVERY = int(os.getenv("VOLUME_FULL_SCAN_EVERY", "12"))
+VOLUME_SCAN_BATCH_SIZE = int(os.getenv("VOLUME_SCAN_BATCH_SIZE", "50"))
+VOLUME_SCAN_IMAGE = os.getenv("VOLUME_SCAN_IMAGE", "alpine:3.19")
+
+# Defaults; a user document can override with volume_soft_quota_mb / volume_hard_quota_mb
+VOLUME_SOFT_QUOTA_MB = int(os.getenv("VOLUME_SOFT_QUOTA_MB", "4096"))
+VOLUME_HARD_QUOTA_MB = int(os.getenv("VOLUME_HARD_QUOTA_MB", "8192"))
+
+
+def measure_volumes(volume_names: list) -> dict:
+    """Measure many volumes with one helper container per batch; returns {name: bytes}"""
+    sizes = {}
+    for i in range(0, len(volume_names), VOLUME_SCAN_BATCH_SIZE):
+        batch = volume_names[i:i + VOLUME_SCAN_BATCH_SIZE]
+        try:
+            output = get_runtime().run(
+                VOLUME_SCAN_IMAGE, command=["du", "-sk"] + [f"/scan/{name}" for name in batch],
+                network="none", volumes=[f"{name}:/scan/{name}:ro" for name in batch],
+                remove=True, detach=False
+            )
+        except ContainerRuntimeError as e:
+            logger.error(f"Volume scan batch failed: {e}")
+            output = e.output
+
+        # du still reports the volumes it could read when one path fails
+        for line in output.splitlines():
+            if "\t" in line:
+                kilobytes, path = line.split("\t", 1)
+                sizes[path.rsplit("/", 1)[-1]] = int(kilobytes) * 1024
+    return sizes
+
+
+def volumes_touched_since(since: datetime) -> list:
+    """Volumes mounted by labs that ran since the given time"""
+    return lab_instances.distinct("volume", {
+        "volume": {"$exists": True},
+        "$or": [
+            {"status": "running"},
+            {"stopped_at": {"$gte": since}},
+        ]
+    })
+
+
+def scan_volume_usage(full: bool = True, since: datetime = None) -> int:
+    """Measure volumes (all, or only those touched since `since`) and cache the results"""
+    if full or since is None:
+        names = [v["volume_name"] for v in list_all_user_volumes()]
+    else:
+        # Mounting a volume deleted since its lab ran would silently recreate it
+        names = [name for name in volumes_touched_since(since) if volume_exists(name)]
+    if not names:
+        return 0
+
+    scanned_at = datetime.utcnow()
+    sizes = measure_volumes(names)
+    for name, size in sizes.items():
+        volume_usage.update_one(
+            {"_id": name},
+            {"$set": {"bytes": size, "scanned_at": scanned_at}},
+            upsert=True
+        )
+
+    if full:
+        # Forget volumes that no longer exist
+        volume_usage.delete_many({"_id": {"$nin": names}})
+
+    logger.info(f"Scanned {len(sizes)} volumes ({'full' if full else 'incremental'})")
+    return len(sizes)
+
+
+def scanner_loop(stop_event: threading.Event):
+    """Full scan every VOLUME_FULL_SCAN_EVERY cycles, incremental scans in between (leader only)"""
+    cycle = 0
+    last_scan = None
+    while not stop_event.is_set():
+        if is_leader():
+            started = datetime.utcnow()
+            try:
+                # A newly elected leader starts with a full scan
+                scan_volume_usage(full=last_scan is None or cycle % VOLUME_FULL_SCAN_EVERY == 0, since=last_scan)
+                last_scan = started
+            except Exception as e:
+                logger.error(f"Volume usage scan failed: {e}")
+            cycle += 1
+        else:
+            last_scan = None
+        stop_event.wait(VOLUME_SCAN_INTERVAL_SECONDS)
+
+
+def start_volume_scanner() -> threading.Event:
+    """Start the usage scanner thread, returns the event that stops it"""
+    stop_event = threading.Event()
+    threading.Thread(target=scanner_loop, args=(stop_event,), daemon=True).start()
+    return stop_event
+
+
+# ==================== Usage & Quotas ====================
+
+def get_volume_usage(user_email: str, user: dict = None) -> dict:
+    """Cached size of a user's volume together with their quota state"""
+    if user is None:
+        user = users.find_one(
+            {"email": user_email},
+            {"volume_soft_quota_mb": 1, "volume_hard_quota_mb": 1}
+        ) or {}
+
+    volume_name = get_user_volume_name(user_email)
+    usage = volume_usage.find_one({"_id": volume_name})
+    size = usage["bytes"] if usage else None
+    soft_mb, hard_mb = effective_quotas(user)
+
+    return {
+        "volume": volume_name,
+        "bytes": size,
+        "size": format_size(size) if size is not None else None,
+        "scanned_at": usage["scanned_at"] if usage else None,
+        "soft_quota_mb": soft_mb,
+        "hard_quota_mb": hard_mb,
+        "over_soft_quota": size is not None and size > soft_mb * 1024 * 1024,
+        "over_hard_quota": size is not None and size > hard_mb * 1024 * 1024
+    }
+
+
+def list_volume_usage() -> dict:
+    """All cached volume sizes keyed by volume name"""
+    return {doc["_id"]: doc for doc in volume_usage.find()}
+
+
+def effective_quotas(user: dict) -> tuple:
+    """(soft, hard) quota in MB for a user document; an unset (None) override means the default"""
+    soft_mb = user.get("volume_soft_quota_mb")
+    hard_mb = user.get("volume_hard_quota_mb")
+    return (
+        VOLUME_SOFT_QUOTA_MB if soft_mb is None else soft_mb,
+        VOLUME_HARD_QUOTA_MB if hard_mb is None else hard_mb
+    )
+
+
+def set_volume_quota(email: str, soft_mb: Optional[int], hard_mb: Optional[int]) -> bool:
+    """Override a user's quotas; None restores the default. Raises ValueError unless 0 <= soft <= hard"""
+    soft, hard = effective_quotas({"volume_soft_quota_mb": soft_mb, "volume_hard_quota_mb": hard_mb})
+    if soft < 0 or hard < 0:
+        raise ValueError("Quotas cannot be negative")
+    if soft > hard:
+        raise ValueError(f"Soft quota ({soft} MB) cannot exceed hard quota ({hard} MB)")
+    result = users.update_one(
+        {"email": email},
+        {"$set": {"volume_soft_quota_mb": soft_mb, "volume_hard_quota_mb": hard_mb}}
+    )
+    invalidate_user(email)
+    return result.matched_count > 0
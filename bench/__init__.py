@@ -0,0 +1,4 @@
+"""
+Load and benchmark harness for the Selfmade Labs API.
+Run with: python -m bench.run --help
+"""
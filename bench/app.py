@@ -0,0 +1,13 @@
+"""
+Benchmark ASGI Entry
+The real app with the fake Docker runtime installed, for runs with
+several uvicorn worker processes (python -m bench.run --workers N).
+Each worker gets its own fake, configured from BENCH_FAKE_DOCKER.
+"""
+import os
+import json
+
+from app.main import app  # noqa: F401  # served by uvicorn as bench.app:app
+from bench.fake_docker import FakeDocker, install
+
+install(FakeDocker(**json.loads(os.environ.get("BENCH_FAKE_DOCKER", "{}"))))
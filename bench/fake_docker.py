@@ -0,0 +1,88 @@
+"""
+Fake Docker Runtime
+The in-memory container runtime with realistic timing: every operation
+sleeps for a latency drawn from a per-operation lognormal distribution
+(seeded, so two runs with the same seed see the same distribution) and
+can fail at a configured rate, so the API code paths run unchanged.
+"""
+import asyncio
+import importlib
+import math
+import random
+import threading
+import time
+
+from app.container_runtime import MemoryRuntime, ContainerRuntimeError, set_runtime
+from app.metrics import DOCKER_OPERATION_SECONDS, DOCKER_OPERATION_FAILURES, METRICS_ENABLED
+
+# Median latency (ms) and lognormal sigma per runtime operation
+DEFAULT_LATENCIES = {
+    "run": (900, 0.35),
+    "start": (400, 0.3),
+    "stop": (350, 0.3),
+    "rm": (80, 0.3),
+    "exec": (250, 0.4),
+    "inspect": (30, 0.2),
+    "volume_create": (40, 0.3),
+    "volume_rm": (60, 0.3),
+    "volume_ls": (30, 0.2),
+    "volume_inspect": (25, 0.2),
+    "network_inspect": (20, 0.2),
+    "image_inspect": (20, 0.2),
+    "stats": (30, 0.2),
+    # Not a runtime call: time until a started lab answers its readiness probe
+    "ready": (1500, 0.4),
+}
+FALLBACK_LATENCY = (50, 0.3)
+
+
+def parse_latency(spec: str):
+    """'run=900:0.35' -> ('run', (900.0, 0.35))"""
+    operation, values = spec.split("=", 1)
+    median, _, sigma = values.partition(":")
+    return operation, (float(median), float(sigma or 0.3))
+
+
+class FakeDocker(MemoryRuntime):
+    """MemoryRuntime that takes as long as Docker does"""
+
+    name = "fake-docker"
+
+    def __init__(self, seed: int = 1, latencies: dict = None, scale: float = 1.0, failure_rate: float = 0.0):
+        super().__init__()
+        self.latencies = {**DEFAULT_LATENCIES, **(latencies or {})}
+        self.scale = scale
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def sample(self, operation: str):
+        """(seconds the operation takes this time, whether it fails)"""
+        median_ms, sigma = self.latencies.get(operation, FALLBACK_LATENCY)
+        with self._rng_lock:
+            value = self._rng.lognormvariate(math.log(median_ms), sigma) if median_ms > 0 else 0.0
+            failed = self.failure_rate > 0 and self._rng.random() < self.failure_rate
+        return value / 1000 * self.scale, failed
+
+    def _operation(self, operation: str):
+        super()._operation(operation)
+        seconds, failed = self.sample(operation)
+        time.sleep(seconds)
+        if METRICS_ENABLED:
+            DOCKER_OPERATION_SECONDS.labels(operation).observe(seconds)
+        if failed:
+            if METRICS_ENABLED:
+                DOCKER_OPERATION_FAILURES.labels(operation).inc()
+            raise ContainerRuntimeError(f"simulated {operation} failure")
+
+    async def wait_until_ready(self, upstream: str, access_type: str, timeout: float = 60):
+        """Async stand-in for app.readiness.wait_until_ready"""
+        seconds, failed = self.sample("ready")
+        await asyncio.sleep(min(seconds, timeout))
+        return None if failed or seconds > timeout else seconds
+
+
+def install(fake: FakeDocker):
+    """Route every container operation and readiness probe the app makes through the fake"""
+    set_runtime(fake)
+    importlib.import_module("app.lab_controller").wait_until_ready = fake.wait_until_ready
@@ -0,0 +1,41 @@
+"""
+Mock GitHub OAuth Provider
+Answers the token exchange and the /user and /user/emails calls of the
+GitHub login callback after a configurable delay, so the callback can be
+measured without reaching GitHub. The code "bench-<n>" logs in as
+bench<n>@bench.local, the same users the benchmark seeds.
+"""
+import asyncio
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+def create_provider(latency_ms: float = 80) -> Starlette:
+    delay = latency_ms / 1000
+
+    def user_number(request: Request) -> str:
+        # Access tokens are "bench-<n>", handed out for the code "bench-<n>"
+        return request.headers.get("authorization", "").rsplit("-", 1)[-1]
+
+    async def access_token(request: Request):
+        form = await request.form()
+        await asyncio.sleep(delay)
+        return JSONResponse({"access_token": form.get("code", "bench-0"), "token_type": "bearer", "scope": "user:email"})
+
+    async def user(request: Request):
+        await asyncio.sleep(delay)
+        n = user_number(request)
+        return JSONResponse({"id": 100000 + int(n), "login": f"bench{n}", "name": f"Bench User {n}", "avatar_url": ""})
+
+    async def emails(request: Request):
+        await asyncio.sleep(delay)
+        return JSONResponse([{"email": f"bench{user_number(request)}@bench.local", "primary": True, "verified": True}])
+
+    return Starlette(routes=[
+        Route("/login/oauth/access_token", access_token, methods=["POST"]),
+        Route("/user", user),
+        Route("/user/emails", emails),
+    ])
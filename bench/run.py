@@ -0,0 +1,613 @@
+"""
+Benchmark Runner
+Drives the real FastAPI app in-process (httpx ASGI transport, no network
+hop) or as uvicorn worker processes (--workers) against a local MongoDB
+and the fake Docker runtime, with a number of concurrent virtual users
+looping over a scenario. GitHub logins go to a local mock provider and
+lab terminal sessions to a WebSocket echo server behind the lab proxy.
+Reports req/s and p50/p95/p99 latency per endpoint plus CPU, memory,
+thread-pool and event-loop figures, and saves the result as JSON so runs
+from different commits can be compared.
+
+    python -m bench.run --users 50 --duration 30
+    python -m bench.run --scenario labs --compare bench/results/<earlier run>.json
+    python -m bench.run --scenario notifications --seed-notifications 10000
+    python -m bench.run --workers 4 --no-metrics
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+from dotenv import load_dotenv
+
+# Read by the app modules at import time, so set before importing them
+os.environ.setdefault("DATABASE_NAME", "selfmade_labs_bench")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("TRACE_EXPORT_PATH", "")
+# The GitHub client is only registered with credentials; the mock provider accepts any
+os.environ.setdefault("GITHUB_CLIENT_ID", "bench")
+os.environ.setdefault("GITHUB_CLIENT_SECRET", "bench")
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_LAB = "ubuntu-ssh"
+BENCH_SERVICE = "postgresql"
+SEED_NOTIFICATIONS = 30
+SEED_BATCH_SIZE = 1000
+# Typing speed of a terminal user in the proxy scenario
+KEYSTROKE_INTERVAL = 0.05
+WORKER_STARTUP_SECONDS = 60
+
+# Steps each virtual user repeats: (method, path, json body)
+SCENARIOS = {
+    "auth": [
+        ("GET", "/me", None),
+    ],
+    "labs": [
+        ("POST", "/labs/start", {"lab_id": BENCH_LAB}),
+        ("GET", "/labs/status", None),
+        ("POST", "/labs/stop", {"lab_id": BENCH_LAB}),
+    ],
+    "services": [
+        ("POST", "/services/start", {"service_id": BENCH_SERVICE}),
+        ("GET", "/services/status", None),
+        ("POST", "/services/stop", {"service_id": BENCH_SERVICE}),
+    ],
+    "notifications": [
+        ("GET", "/notifications/unread-count", None),
+        ("GET", "/notifications?limit=20", None),
+    ],
+}
+
+
+# ==================== Setup ====================
+
+def reset_database():
+    """Start from an empty benchmark database (before the app creates its indexes)"""
+    from pymongo import MongoClient
+
+    load_dotenv()
+    name = os.environ["DATABASE_NAME"]
+    if name == "selfmade_labs":
+        sys.exit("Refusing to benchmark against the default database; set DATABASE_NAME to a scratch database")
+    MongoClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017/")).drop_database(name)
+
+
+def seed_users(count: int, notifications_per_user: int) -> list:
+    """Create bench users with seeded notifications; returns their bearer tokens"""
+    from app.auth import get_or_create_user, create_access_token
+
+    tokens = []
+    for i in range(count):
+        email = f"bench{i}@bench.local"
+        get_or_create_user(email, f"Bench User {i}", "", "bench", f"bench-{i}")
+        seed_notifications(email, notifications_per_user)
+        tokens.append(create_access_token({"email": email, "role": "user", "provider": "bench"}))
+    return tokens
+
+
+def seed_notifications(email: str, count: int):
+    """Unread notifications spread over the last hour, inserted in bulk with a matching unread counter"""
+    from app.db import notifications, notification_counters
+
+    now = datetime.utcnow()
+    for start in range(0, count, SEED_BATCH_SIZE):
+        notifications.insert_many([
+            {
+                "user_email": email,
+                "type": "system",
+                "title": f"Bench notification {n}",
+                "message": "Seeded by the benchmark",
+                "read": False,
+                "created_at": now - timedelta(seconds=3600 * (count - n) / count),
+                "metadata": {}
+            }
+            for n in range(start, min(start + SEED_BATCH_SIZE, count))
+        ], ordered=False)
+    if count:
+        notification_counters.update_one({"_id": email}, {"$inc": {"unread": count}}, upsert=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve(asgi_app, port: int):
+    """Run an ASGI app on 127.0.0.1:port in this event loop; returns (server, task)"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+            raise RuntimeError(f"Server on port {port} exited during startup")
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def shutdown(server, task):
+    server.should_exit = True
+    await task
+
+
+async def start_echo_server():
+    """WebSocket server that sends every message back, standing in for a lab's ttyd"""
+    import websockets
+
+    async def echo(websocket):
+        async for message in websocket:
+            await websocket.send(message)
+
+    server = await websockets.serve(echo, "127.0.0.1", 0, compression=None)
+    return server, "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+
+
+def spawn_workers(workers: int, port: int, fake_config: dict) -> subprocess.Popen:
+    """Serve bench.app with uvicorn worker processes (leader-only background jobs included)"""
+    env = {**os.environ, "BENCH_FAKE_DOCKER": json.dumps(fake_config)}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "bench.app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env, cwd=REPO_DIR
+    )
+
+
+async def wait_for_workers(proc: subprocess.Popen, base_url: str):
+    import httpx
+
+    deadline = time.monotonic() + WORKER_STARTUP_SECONDS
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                sys.exit(f"uvicorn exited with {proc.returncode} during startup")
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    proc.terminate()
+    sys.exit(f"uvicorn did not answer on {base_url} within {WORKER_STARTUP_SECONDS}s")
+
+
+# ==================== Measurement ====================
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(latencies: list) -> dict:
+    values = sorted(latencies)
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def response_error(resp) -> str:
+    """Error text for a failed request (the API also reports errors as 200 + {"error": ...})"""
+    if resp.status_code >= 400:
+        return f"HTTP {resp.status_code}"
+    if resp.is_redirect:
+        # OAuth callbacks report failures by redirecting to the login page
+        location = resp.headers.get("location", "")
+        return f"redirect to {location}" if "error=" in location else ""
+    try:
+        body = resp.json()
+    except ValueError:
+        return ""
+    return body.get("error", "") if isinstance(body, dict) else ""
+
+
+class ResourceMonitor:
+    """Samples thread counts, thread-pool usage and event-loop lag while a scenario runs"""
+
+    INTERVAL = 0.05
+
+    def __init__(self):
+        self.peak_threads = 0
+        self.peak_threadpool_borrowed = 0
+        self.loop_lag = []
+        self._task = None
+
+    async def _run(self):
+        import anyio.to_thread
+
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.INTERVAL)
+            self.loop_lag.append(max(0.0, time.perf_counter() - started - self.INTERVAL))
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_threadpool_borrowed = max(self.peak_threadpool_borrowed, limiter.borrowed_tokens)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class Target:
+    """Where virtual users send their requests: the in-process app or the uvicorn workers"""
+
+    def __init__(self, client, new_client, ws_url: str = None, echo_upstream: str = None):
+        self.client = client
+        self.new_client = new_client  # a client with its own cookie jar
+        self.ws_url = ws_url
+        self.echo_upstream = echo_upstream
+
+
+async def virtual_user(target: Target, n: int, token: str, steps: list, deadline: float, iterations: int, samples: list):
+    """Loop over the scenario steps; a started iteration always finishes so labs get stopped"""
+    headers = {"Authorization": f"Bearer {token}"}
+    done = 0
+    while time.monotonic() < deadline and (not iterations or done < iterations):
+        for method, path, body in steps:
+            started = time.perf_counter()
+            resp = await target.client.request(method, path, json=body, headers=headers)
+            samples.append((f"{method} {path.split('?')[0]}", time.perf_counter() - started, response_error(resp)))
+        done += 1
+
+
+async def oauth_user(target: Target, n: int, token: str, deadline: float, iterations: int, samples: list):
+    """GitHub logins against the mock provider: /auth/github for the state, then the callback"""
+    async with target.new_client() as client:
+        done = 0
+        while time.monotonic() < deadline and (not iterations or done < iterations):
+            started = time.perf_counter()
+            resp = await client.get("/auth/github")
+            samples.append(("GET /auth/github", time.perf_counter() - started, response_error(resp)))
+            state = parse_qs(urlparse(resp.headers.get("location", "")).query).get("state", [""])[0]
+
+            started = time.perf_counter()
+            resp = await client.get("/auth/github/callback", params={"code": f"bench-{n}", "state": state})
+            samples.append(("GET /auth/github/callback", time.perf_counter() - started, response_error(resp)))
+            done += 1
+
+
+async def proxy_user(target: Target, n: int, token: str, deadline: float, iterations: int, samples: list):
+    """One terminal session through the lab proxy: start a lab, type into its WebSocket, stop it"""
+    import websockets
+    from bson import ObjectId
+    from app.db import lab_instances
+
+    headers = {"Authorization": f"Bearer {token}"}
+    started = time.perf_counter()
+    resp = await target.client.post("/labs/start", json={"lab_id": BENCH_LAB}, headers=headers)
+    error = response_error(resp)
+    samples.append(("POST /labs/start", time.perf_counter() - started, error))
+    if error:
+        return
+    instance_id = resp.json()["instance_id"]
+    # The proxy relays to the echo server where a real lab runs ttyd
+    await asyncio.to_thread(lab_instances.update_one, {"_id": ObjectId(instance_id)}, {"$set": {"upstream": target.echo_upstream}})
+
+    try:
+        started = time.perf_counter()
+        async with websockets.connect(f"{target.ws_url}/lab/{instance_id}/ws?token={token}", compression=None) as ws:
+            samples.append(("WS connect", time.perf_counter() - started, ""))
+            done = 0
+            while time.monotonic() < deadline and (not iterations or done < iterations):
+                started = time.perf_counter()
+                await ws.send("x")
+                await ws.recv()
+                samples.append(("WS keystroke echo", time.perf_counter() - started, ""))
+                done += 1
+                await asyncio.sleep(KEYSTROKE_INTERVAL)
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        samples.append(("WS connect", time.perf_counter() - started, f"{type(e).__name__}: {e}"))
+    finally:
+        started = time.perf_counter()
+        resp = await target.client.post("/labs/stop", json={"lab_id": BENCH_LAB}, headers=headers)
+        samples.append(("POST /labs/stop", time.perf_counter() - started, response_error(resp)))
+
+
+# Scenarios whose users do more than repeat fixed requests
+USER_LOOPS = {
+    "oauth": oauth_user,
+    "proxy": proxy_user,
+}
+ALL_SCENARIOS = [*SCENARIOS, *USER_LOOPS]
+
+
+def process_tree_cpu_seconds(pid: int):
+    """User + system CPU of a process and its direct children, from /proc (None elsewhere)"""
+    if not os.path.isdir("/proc"):
+        return None
+    ticks = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Fields after the command name: state, ppid, ..., utime (12th), stime (13th)
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+async def run_scenario(target: Target, name: str, tokens: list, args, fake, server_pid: int = None) -> dict:
+    samples = []
+    monitor = ResourceMonitor()
+    fake.calls.clear()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    server_cpu_before = process_tree_cpu_seconds(server_pid) if server_pid else None
+    started = time.monotonic()
+    deadline = started + args.duration
+
+    monitor.start()
+    if name in USER_LOOPS:
+        users = [USER_LOOPS[name](target, n, token, deadline, args.iterations, samples) for n, token in enumerate(tokens)]
+    else:
+        users = [virtual_user(target, n, token, SCENARIOS[name], deadline, args.iterations, samples) for n, token in enumerate(tokens)]
+    await asyncio.gather(*users)
+    await monitor.stop()
+
+    elapsed = time.monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    server_resources = {}
+    if server_cpu_before is not None:
+        # With --workers the figures above are the load generator's; these are uvicorn's
+        server_cpu = process_tree_cpu_seconds(server_pid) - server_cpu_before
+        server_resources = {
+            "server_cpu_seconds": round(server_cpu, 2),
+            "server_cpu_percent": round(server_cpu / elapsed * 100, 1) if elapsed else 0.0,
+        }
+
+    endpoints = {}
+    for endpoint, latency, _ in samples:
+        endpoints.setdefault(endpoint, []).append(latency)
+    errors = [error for _, _, error in samples if error]
+
+    return {
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "duration_seconds": round(elapsed, 2),
+        "requests_per_second": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency": summarize([latency for _, latency, _ in samples]),
+        "endpoints": {
+            endpoint: {
+                "requests": len(latencies),
+                "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+                **summarize(latencies)
+            }
+            for endpoint, latencies in sorted(endpoints.items())
+        },
+        "resources": {
+            "cpu_seconds": round(cpu_seconds, 2),
+            "cpu_percent": round(cpu_seconds / elapsed * 100, 1) if elapsed else 0.0,
+            # ru_maxrss is KiB on Linux, bytes on macOS
+            "max_rss_mb": round(usage_after.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+            "peak_threads": monitor.peak_threads,
+            "peak_threadpool_borrowed": monitor.peak_threadpool_borrowed,
+            "loop_lag_p99_ms": round(percentile(sorted(monitor.loop_lag), 99) * 1000, 2),
+            **server_resources,
+        },
+        "docker_calls": dict(sorted(fake.calls.items())),
+    }
+
+
+# ==================== Reporting ====================
+
+def git_revision() -> dict:
+    def git(*cmd):
+        result = subprocess.run(["git", *cmd], capture_output=True, text=True, cwd=os.path.dirname(__file__))
+        return result.stdout.strip() if result.returncode == 0 else ""
+    return {"commit": git("rev-parse", "HEAD") or "unknown", "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def print_report(report: dict):
+    for name, result in report["scenarios"].items():
+        res = result["resources"]
+        print(f"\n== {name}: {result['requests']} requests, {result['errors']} errors, "
+              f"{result['requests_per_second']} req/s over {result['duration_seconds']}s")
+        print(f"   cpu {res['cpu_percent']}%  rss {res['max_rss_mb']} MB  threads {res['peak_threads']}  "
+              f"threadpool {res['peak_threadpool_borrowed']}  loop lag p99 {res['loop_lag_p99_ms']} ms")
+        if "server_cpu_percent" in res:
+            print(f"   uvicorn workers cpu {res['server_cpu_percent']}%")
+        print(f"   {'endpoint':<36}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for endpoint, stats in result["endpoints"].items():
+            print(f"   {endpoint:<36}{stats['requests_per_second']:>9}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+        for error in result["error_samples"]:
+            print(f"   error: {error}")
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> bool:
+    """Print per-endpoint changes against a saved run; True if anything regressed past threshold %"""
+    regressed = False
+    print(f"\n== Compared with {baseline['git']['commit'][:10]} ({baseline['timestamp']})")
+    for name, result in report["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        for endpoint, stats in result["endpoints"].items():
+            old = before["endpoints"].get(endpoint)
+            if not old:
+                continue
+            p95_change = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+            rps_change = (stats["requests_per_second"] - old["requests_per_second"]) / old["requests_per_second"] * 100 if old["requests_per_second"] else 0.0
+            flag = p95_change > threshold or rps_change < -threshold
+            regressed = regressed or flag
+            print(f"   {name:<14}{endpoint:<36}p95 {old['p95_ms']:>9} -> {stats['p95_ms']:<9} ({p95_change:+.1f}%)  "
+                  f"req/s {old['requests_per_second']:>8} -> {stats['requests_per_second']:<8} ({rps_change:+.1f}%)"
+                  f"{'  REGRESSION' if flag else ''}")
+    return regressed
+
+
+# ==================== Main ====================
+
+def configure_environment(args):
+    """Settings the app modules read at import time, so applied before importing them"""
+    args.provider_port = free_port()
+    os.environ["GITHUB_OAUTH_URL"] = os.environ["GITHUB_API_URL"] = f"http://127.0.0.1:{args.provider_port}"
+    if args.no_metrics:
+        os.environ["METRICS_ENABLED"] = "false"
+
+
+async def main_async(args) -> dict:
+    import httpx
+    from bench.fake_docker import FakeDocker, install, parse_latency
+    from bench.mock_provider import create_provider
+
+    reset_database()
+    from app.main import app
+    from app.http_client import start_http_client, close_http_client
+    from app.audit import audit_writer
+    from app.notifications import notification_outbox
+
+    fake_config = {
+        "seed": args.seed,
+        "latencies": dict(parse_latency(spec) for spec in args.latency),
+        "scale": args.latency_scale,
+        "failure_rate": args.failure_rate,
+    }
+    fake = FakeDocker(**fake_config)
+    install(fake)
+    tokens = seed_users(args.users, args.seed_notifications)
+    scenarios = ALL_SCENARIOS if args.scenario == "all" else [args.scenario]
+
+    servers = [await serve(create_provider(args.provider_latency), args.provider_port)]
+    echo_server, echo_upstream = await start_echo_server() if "proxy" in scenarios else (None, None)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    workers = None
+    if args.workers:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        workers = spawn_workers(args.workers, port, fake_config)
+        await wait_for_workers(workers, base_url)
+
+        def new_client():
+            return httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits)
+    else:
+        # Only the pieces the request path needs; leader-only background jobs stay off
+        start_http_client()
+        audit_writer.start()
+        notification_outbox.start()
+        transport = httpx.ASGITransport(app=app)
+        base_url = None
+        if echo_server:
+            # WebSockets need a real socket; HTTP keeps the in-process transport
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            servers.append(await serve(app, port))
+
+        def new_client():
+            return httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None)
+
+    results = {}
+    try:
+        async with new_client() as client:
+            target = Target(client, new_client, base_url and base_url.replace("http://", "ws://"), echo_upstream)
+            for name in scenarios:
+                print(f"Running {name} with {args.users} users{f' on {args.workers} workers' if args.workers else ''}...")
+                results[name] = await run_scenario(target, name, tokens, args, fake, workers.pid if workers else None)
+    finally:
+        if workers:
+            workers.terminate()
+            workers.wait()
+        else:
+            notification_outbox.stop()
+            audit_writer.stop()
+            await close_http_client()
+        for server in servers:
+            await shutdown(*server)
+        if echo_server:
+            echo_server.close()
+            await echo_server.wait_closed()
+
+    return {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "duration": args.duration,
+            "iterations": args.iterations,
+            "workers": args.workers,
+            "metrics": not args.no_metrics,
+            "seed_notifications": args.seed_notifications,
+            "provider_latency_ms": args.provider_latency,
+            "seed": args.seed,
+            "latency_scale": args.latency_scale,
+            "failure_rate": args.failure_rate,
+            "latencies": fake.latencies,
+        },
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark against the API with a simulated Docker runtime")
+    parser.add_argument("--scenario", choices=["all", *ALL_SCENARIOS], default="all")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--iterations", type=int, default=0,
+                        help="stop each user after N loops, or N keystrokes in the proxy scenario (0 = duration only)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve the app with N uvicorn worker processes (0 = in-process, no network hop)")
+    parser.add_argument("--no-metrics", action="store_true", help="turn off HTTP and MongoDB instrumentation")
+    parser.add_argument("--seed-notifications", type=int, default=SEED_NOTIFICATIONS,
+                        help="unread notifications seeded per user (e.g. 10000 for a heavy inbox)")
+    parser.add_argument("--provider-latency", type=float, default=80,
+                        help="mock GitHub response time in ms for the oauth scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", action="append", default=[], metavar="OP=MEDIAN_MS[:SIGMA]",
+                        help="override a fake Docker latency, e.g. run=2000:0.5 or ready=0")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiply all fake latencies (0 measures pure API overhead)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of Docker calls that fail")
+    parser.add_argument("--output", help="result file (default bench/results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args()
+    configure_environment(args)
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.utcnow():%Y%m%d-%H%M%S}-{report['git']['commit'][:8]}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(report, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,35 @@
 @echo off
 REM Build script for Selfmade Labs Docker images
-REM This script builds all lab images with ttyd web terminals
+REM Builds every labs\* image in parallel (shared stages such as labs\_ttyd first)
+REM and skips images whose build context has not changed since the last build.
+REM Usage: build-labs.bat [--force] [lab ...]
+REM Without the Python dependencies installed it falls back to a plain docker build
+REM of every image (shared stages first); arguments are then ignored.
 
 echo ========================================
 echo Building Selfmade Labs Docker Images
 echo ========================================
 echo.
 
-REM Build Ubuntu SSH Lab
-echo [1/2] Building Ubuntu SSH Lab...
-cd labs\ubuntu-ssh
-docker build -t selfmade/ubuntu-ssh:latest .
-if %ERRORLEVEL% NEQ 0 (
-    echo ERROR: Failed to build Ubuntu SSH Lab
-    exit /b 1
-)
-cd ..\..
-echo ✓ Ubuntu SSH Lab built successfully
-echo.
+python -c "import app.image_builder" >nul 2>&1
+if %ERRORLEVEL% NEQ 0 goto plain_build
 
-REM Build Kali Linux Lab
-echo [2/2] Building Kali Linux Lab...
-cd labs\kali-linux
-docker build -t selfmade/kali-linux:latest .
+python -m app.image_builder %*
 if %ERRORLEVEL% NEQ 0 (
-    echo ERROR: Failed to build Kali Linux Lab
+    echo ERROR: Failed to build lab images
     exit /b 1
 )
-cd ..\..
-echo ✓ Kali Linux Lab built successfully
-echo.
+goto built
+
+:plain_build
+echo Python dependencies not installed (pip install -r requirements.txt); using docker build
+REM BuildKit is needed for the apt cache mounts in the Dockerfiles
+set DOCKER_BUILDKIT=1
+for /d %%D in (labs\_*) do if exist "%%D\Dockerfile" call :build_image %%~nxD || goto build_failed
+for /d %%D in (labs\*) do if exist "%%D\Dockerfile" call :build_lab %%~nxD || goto build_failed
+
+:built
 
-echo ========================================
-echo All lab images built successfully!
-echo ========================================
 echo.
 echo Available images:
 docker images | findstr selfmade
@@ -41,3 +37,20 @@ echo.
 echo To start the platform, run:
 echo   uvicorn app.main:app --reload --port 8000
 echo.
+exit /b 0
+
+:build_failed
+echo ERROR: Failed to build lab images
+exit /b 1
+
+REM Shared stages (labs\_*) were built by the first loop
+:build_lab
+set "name=%~1"
+if "%name:~0,1%"=="_" exit /b 0
+
+:build_image
+set "name=%~1"
+if "%name:~0,1%"=="_" set "name=%name:~1%"
+echo Building selfmade/%name%:latest
+docker build -t selfmade/%name%:latest labs\%~1
+exit /b %ERRORLEVEL%
@@ -1,6 +1,10 @@
 #!/bin/bash
 # Build script for Selfmade Labs Docker images
-# This script builds all lab images with ttyd web terminals
+# Builds every labs/* image in parallel (shared stages such as labs/_ttyd first)
+# and skips images whose build context has not changed since the last build.
+# Usage: ./build-labs.sh [--force] [lab ...]
+# Without the Python dependencies installed it falls back to a plain docker build
+# of every image (shared stages first); arguments are then ignored.
 
 set -e  # Exit on error
 
@@ -9,25 +13,20 @@ echo "Building Selfmade Labs Docker Images"
 echo "========================================"
 echo ""
 
-# Build Ubuntu SSH Lab
-echo "[1/2] Building Ubuntu SSH Lab..."
-cd labs/ubuntu-ssh
-docker build -t selfmade/ubuntu-ssh:latest .
-cd ../..
-echo "✓ Ubuntu SSH Lab built successfully"
-echo ""
-
-# Build Kali Linux Lab
-echo "[2/2] Building Kali Linux Lab..."
-cd labs/kali-linux
-docker build -t selfmade/kali-linux:latest .
-cd ../..
-echo "✓ Kali Linux Lab built successfully"
-echo ""
+if python -c "import app.image_builder" 2>/dev/null; then
+    python -m app.image_builder "$@"
+else
+    echo "Python dependencies not installed (pip install -r requirements.txt); using docker build"
+    # BuildKit is needed for the apt cache mounts in the Dockerfiles
+    export DOCKER_BUILDKIT=1
+    for dir in labs/_*/ labs/[!_]*/; do
+        [ -f "${dir}Dockerfile" ] || continue
+        name=$(basename "$dir")
+        echo "Building selfmade/${name#_}:latest"
+        docker build -t "selfmade/${name#_}:latest" "$dir"
+    done
+fi
 
-echo "========================================"
-echo "All lab images built successfully!"
-echo "========================================"
 echo ""
 echo "Available images:"
 docker images | grep selfmade
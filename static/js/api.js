@@ -112,16 +112,33 @@ class APIClient {
      * @param {Object} data - Request body
      * @returns {Promise} Response data
      */
-    async post(endpoint, data = {}) {
+    async post(endpoint, data = {}, extraHeaders = {}) {
         const response = await fetch(`${this.baseURL}${endpoint}`, {
             method: 'POST',
-            headers: this.getHeaders(),
+            headers: { ...this.getHeaders(), ...extraHeaders },
             body: JSON.stringify(data)
         });
 
         return this.handleResponse(response);
     }
 
+    /**
+     * POST with an Idempotency-Key, retried once on network failure with the same key
+     * so the server replays the first result instead of repeating the work
+     * @param {string} endpoint - API endpoint
+     * @param {Object} data - Request body
+     * @returns {Promise} Response data
+     */
+    async postIdempotent(endpoint, data = {}) {
+        const headers = { 'Idempotency-Key': crypto.randomUUID() };
+        try {
+            return await this.post(endpoint, data, headers);
+        } catch (error) {
+            if (!(error instanceof TypeError)) throw error;
+            return this.post(endpoint, data, headers);
+        }
+    }
+
     /**
      * Make HTTP PUT request
      * @param {string} endpoint - API endpoint
@@ -189,6 +206,31 @@ class APIClient {
         window.location.href = '/ui/login.html';
     }
 
+    /**
+     * Get everything the dashboard shows in one request.
+     * Sends the last ETag and reuses the cached snapshot on 304 Not Modified.
+     * @returns {Promise} Snapshot {profile, stats, labs, services, lab_status, service_status, notifications, unread_count, version}
+     */
+    async getDashboardSnapshot() {
+        const headers = this.getHeaders();
+        if (this.snapshotETag && this.snapshot) {
+            headers['If-None-Match'] = this.snapshotETag;
+        }
+
+        const response = await fetch(`${this.baseURL}/dashboard/snapshot`, {
+            method: 'GET',
+            headers
+        });
+
+        if (response.status === 304) {
+            return this.snapshot;
+        }
+
+        this.snapshot = await this.handleResponse(response);
+        this.snapshotETag = response.headers.get('ETag');
+        return this.snapshot;
+    }
+
     // ==================== Labs ====================
 
     /**
@@ -205,7 +247,7 @@ class APIClient {
      * @returns {Promise} Lab start result with port and access info
      */
     async startLab(labId) {
-        return this.post('/labs/start', { lab_id: labId });
+        return this.postIdempotent('/labs/start', { lab_id: labId });
     }
 
     /**
@@ -214,7 +256,7 @@ class APIClient {
      * @returns {Promise} Lab stop result
      */
     async stopLab(labId) {
-        return this.post('/labs/stop', { lab_id: labId });
+        return this.postIdempotent('/labs/stop', { lab_id: labId });
     }
 
     /**
@@ -241,7 +283,7 @@ class APIClient {
      * @returns {Promise} Service start result with credentials
      */
     async startService(serviceId) {
-        return this.post('/services/start', { service_id: serviceId });
+        return this.postIdempotent('/services/start', { service_id: serviceId });
     }
 
     /**
@@ -250,7 +292,7 @@ class APIClient {
      * @returns {Promise} Service stop result
      */
     async stopService(serviceId) {
-        return this.post('/services/stop', { service_id: serviceId });
+        return this.postIdempotent('/services/stop', { service_id: serviceId });
     }
 
     /**
@@ -275,11 +317,15 @@ class APIClient {
     /**
      * Get user notifications
      * @param {boolean} unreadOnly - Fetch only unread notifications
-     * @returns {Promise} Array of notifications
+     * @param {string|null} cursor - next_cursor from the previous page
+     * @returns {Promise} Page of notifications {notifications, next_cursor}
      */
-    async getNotifications(unreadOnly = false) {
-        const params = unreadOnly ? '?unread_only=true' : '';
-        return this.get(`/notifications${params}`);
+    async getNotifications(unreadOnly = false, cursor = null) {
+        const params = new URLSearchParams();
+        if (unreadOnly) params.set('unread_only', 'true');
+        if (cursor) params.set('cursor', cursor);
+        const query = params.toString();
+        return this.get(`/notifications${query ? '?' + query : ''}`);
     }
 
     /**
@@ -316,6 +362,17 @@ class APIClient {
         return this.delete(`/notifications/${notificationId}`);
     }
 
+    /**
+     * Open the server-sent event stream (lab, service, notification events)
+     * @returns {EventSource|null} Event source or null if unsupported
+     */
+    openEventStream() {
+        if (!window.EventSource || !this.getToken()) {
+            return null;
+        }
+        return new EventSource(`${this.baseURL}/events/stream?token=${encodeURIComponent(this.getToken())}`);
+    }
+
     // ==================== Admin ====================
 
     /**
@@ -357,10 +414,17 @@ class APIClient {
     /**
      * Get audit logs (admin only)
      * @param {number} limit - Max number of logs
-     * @returns {Promise} Array of audit logs
-     */
-    async adminGetAuditLogs(limit = 100) {
-        return this.get(`/admin/audit-logs?limit=${limit}`);
+     * @param {string|null} cursor - next_cursor from the previous page
+     * @param {Object} filters - Optional {action, user_email, target, since, until}
+     * @returns {Promise} Page of audit logs {logs, next_cursor}
+     */
+    async adminGetAuditLogs(limit = 100, cursor = null, filters = {}) {
+        const params = new URLSearchParams({ limit });
+        if (cursor) params.set('cursor', cursor);
+        Object.entries(filters).forEach(([key, value]) => {
+            if (value) params.set(key, value);
+        });
+        return this.get(`/admin/audit-logs?${params}`);
     }
 
     /**
@@ -0,0 +1,26 @@
+"""
+Shared fixtures. App modules are imported inside the fixtures: they touch
+MongoDB at import time, which test modules only allow after require_mongo().
+"""
+import pytest
+
+from scratch import drop_scratch_database
+
+
+@pytest.fixture(scope="session", autouse=True)
+def scratch_database():
+    yield
+    drop_scratch_database()
+
+
+@pytest.fixture
+def runtime():
+    """A fresh in-memory container runtime, with no lab or service instances recorded"""
+    from app.container_runtime import MemoryRuntime, set_runtime
+    from app.db import lab_instances, service_instances
+
+    lab_instances.delete_many({})
+    service_instances.delete_many({})
+    runtime = MemoryRuntime()
+    set_runtime(runtime)
+    return runtime
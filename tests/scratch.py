@@ -0,0 +1,46 @@
+"""
+Scratch MongoDB for the tests.
+The claims rely on unique partial indexes, which mongomock does not
+enforce, so the tests need a MongoDB (MONGODB_URL, default localhost).
+The scratch database (selfmade_labs_test unless DATABASE_NAME is set) is
+emptied before the first app module is imported and dropped after the
+run. Test modules call require_mongo() before importing from app.
+"""
+import os
+
+import pytest
+
+# Read by the app modules at import time, so set before importing them
+os.environ.setdefault("DATABASE_NAME", "selfmade_labs_test")
+os.environ.setdefault("TRACE_EXPORT_PATH", "")
+
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
+
+_client = None
+
+
+def require_mongo():
+    """Skip the calling module unless MongoDB is reachable; returns a client for the scratch database"""
+    global _client
+    pymongo = pytest.importorskip("pymongo")
+    if os.environ["DATABASE_NAME"] == "selfmade_labs":
+        pytest.exit("Refusing to test against the default database; set DATABASE_NAME to a scratch database")
+    if _client is None:
+        client = pymongo.MongoClient(MONGODB_URL, serverSelectionTimeoutMS=1000)
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError:
+            client.close()
+            pytest.skip(f"MongoDB is not reachable at {MONGODB_URL}", allow_module_level=True)
+        # Empty before app.db creates its indexes and seeds the catalog
+        client.drop_database(os.environ["DATABASE_NAME"])
+        _client = client
+    return _client
+
+
+def drop_scratch_database():
+    global _client
+    if _client is not None:
+        _client.drop_database(os.environ["DATABASE_NAME"])
+        _client.close()
+        _client = None
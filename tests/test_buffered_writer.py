@@ -0,0 +1,173 @@
+"""
+BufferedWriter: flushing, the JSONL spill on shutdown and its replay,
+retry caps and the buffer bound. Needs a MongoDB, see scratch.py.
+"""
+import os
+
+import pytest
+
+from scratch import require_mongo
+
+require_mongo()
+
+from bson import ObjectId, json_util  # noqa: E402
+from pymongo.errors import ServerSelectionTimeoutError  # noqa: E402
+
+from app.db import db  # noqa: E402
+from app.buffered_writer import BufferedWriter  # noqa: E402
+
+
+class UnreachableCollection:
+    """Stands in for a collection while MongoDB is down"""
+
+    name = "unreachable"
+
+    def insert_many(self, docs, ordered=True):
+        raise ServerSelectionTimeoutError("simulated outage")
+
+
+class RecordingWriter(BufferedWriter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flushed = []
+        self.duplicates = set()
+
+    def on_flushed(self, docs, duplicate_ids):
+        self.flushed.extend(doc["_id"] for doc in docs)
+        self.duplicates |= duplicate_ids
+
+
+@pytest.fixture
+def collection():
+    db.drop_collection("buffered_writer_test")
+    # Documents without an integer n are rejected with a validation error (not a duplicate)
+    db.create_collection("buffered_writer_test", validator={
+        "$jsonSchema": {"required": ["n"], "properties": {"n": {"bsonType": "int"}}}
+    })
+    yield db["buffered_writer_test"]
+    db.drop_collection("buffered_writer_test")
+
+
+@pytest.fixture
+def fallback_path(tmp_path):
+    return str(tmp_path / "fallback.jsonl")
+
+
+@pytest.fixture
+def start_writer():
+    """Start writers whose flusher stays idle, so the tests flush by hand; stopped afterwards"""
+    started = []
+
+    def start(collection, fallback_path, **kwargs):
+        writer = RecordingWriter(collection, fallback_path, flush_interval=60, **kwargs)
+        writer.start()
+        started.append(writer)
+        return writer
+
+    yield start
+    for writer in started:
+        writer.stop()
+
+
+def _docs(count: int) -> list:
+    return [{"_id": ObjectId(), "n": n} for n in range(count)]
+
+
+def _read_jsonl(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json_util.loads(line) for line in f if line.strip()]
+
+
+def test_flush_writes_buffer_and_runs_hook(collection, fallback_path, start_writer):
+    writer = start_writer(collection, fallback_path)
+    docs = _docs(3)
+    for doc in docs:
+        writer.write(doc)
+    assert collection.count_documents({}) == 0
+    assert len(writer.pending()) == 3
+
+    assert writer.flush() == 3
+    assert collection.count_documents({}) == 3
+    assert writer.flushed == [doc["_id"] for doc in docs]
+    assert writer.pending() == []
+
+
+def test_stop_spills_and_next_start_replays(collection, fallback_path, start_writer):
+    down = start_writer(UnreachableCollection(), fallback_path)
+    docs = _docs(4)
+    for doc in docs:
+        down.write(doc)
+    down.stop()
+    assert [doc["_id"] for doc in _read_jsonl(fallback_path)] == [doc["_id"] for doc in docs]
+
+    writer = start_writer(collection, fallback_path)
+    assert not os.path.exists(fallback_path)
+    assert collection.count_documents({}) == 4
+    assert set(writer.flushed) == {doc["_id"] for doc in docs}
+
+
+def test_replay_keeps_file_while_mongo_is_down(collection, fallback_path):
+    docs = _docs(2)
+    BufferedWriter(UnreachableCollection(), fallback_path).spill_to_fallback(docs)
+
+    down = BufferedWriter(UnreachableCollection(), fallback_path)
+    assert down.replay_fallback() == 0
+    assert os.path.exists(fallback_path)
+    assert down._replay_pending
+
+    # Back up: the flusher's next pass replays it
+    writer = BufferedWriter(collection, fallback_path)
+    assert writer.replay_fallback() == 2
+    assert not os.path.exists(fallback_path)
+    assert not writer._replay_pending
+    assert collection.count_documents({}) == 2
+
+
+def test_replay_skips_documents_already_written(collection, fallback_path):
+    docs = _docs(3)
+    collection.insert_one(dict(docs[0]))
+    BufferedWriter(UnreachableCollection(), fallback_path).spill_to_fallback(docs)
+
+    writer = RecordingWriter(collection, fallback_path)
+    writer.replay_fallback()
+    assert collection.count_documents({}) == 3
+    assert writer.duplicates == {docs[0]["_id"]}
+    # Duplicates count as written, nothing is queued for another try
+    assert writer.pending() == []
+
+
+def test_rejected_documents_are_dead_lettered_after_max_attempts(collection, fallback_path, start_writer):
+    writer = start_writer(collection, fallback_path, max_attempts=3)
+    good, bad = _docs(1)[0], {"_id": ObjectId(), "n": "not a number"}
+    writer.write(good)
+    writer.write(bad)
+
+    writer.flush()
+    assert collection.count_documents({}) == 1
+    assert writer.pending() == [bad]
+    writer.flush()
+    assert writer.pending() == [bad]
+
+    writer.flush()
+    assert writer.pending() == []
+    assert [doc["_id"] for doc in _read_jsonl(writer.dead_letter_path)] == [bad["_id"]]
+    assert writer.flushed == [good["_id"]]
+
+
+def test_outage_does_not_count_against_attempts(fallback_path, start_writer):
+    writer = start_writer(UnreachableCollection(), fallback_path, max_attempts=1)
+    writer.write(_docs(1)[0])
+    for _ in range(3):
+        writer.flush()
+    assert len(writer.pending()) == 1
+    assert not os.path.exists(writer.dead_letter_path)
+
+
+def test_full_buffer_spills_oldest_documents(fallback_path, start_writer):
+    writer = start_writer(UnreachableCollection(), fallback_path, max_buffer=3)
+    docs = _docs(5)
+    for doc in docs:
+        writer.write(doc)
+    assert [doc["_id"] for doc in writer.pending()] == [doc["_id"] for doc in docs[2:]]
+    assert [doc["_id"] for doc in _read_jsonl(fallback_path)] == [doc["_id"] for doc in docs[:2]]
+    assert writer._replay_pending
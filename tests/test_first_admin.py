@@ -0,0 +1,51 @@
+"""
+First-admin claim: the first account created becomes admin, exactly once,
+even when several sign up at the same moment. Needs a MongoDB, see scratch.py.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from scratch import require_mongo
+
+require_mongo()
+
+from app import auth  # noqa: E402
+from app.db import users, system_flags  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_deployment():
+    users.delete_many({})
+    system_flags.delete_one({"_id": "first_admin"})
+    auth._first_admin_claimed.clear()
+    yield
+    users.delete_many({})
+
+
+def _sign_up(n: int) -> dict:
+    return auth.get_or_create_user(f"user{n}@test.local", f"User {n}", "", "github", str(n))
+
+
+def test_first_user_becomes_admin():
+    assert _sign_up(0)["role"] == "admin"
+    assert _sign_up(1)["role"] == "user"
+    # Logging in again does not touch the role
+    assert _sign_up(0)["role"] == "admin"
+    assert users.count_documents({"role": "admin"}) == 1
+
+
+def test_concurrent_signups_elect_one_admin():
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        created = list(pool.map(_sign_up, range(16)))
+    assert [user["role"] for user in created].count("admin") == 1
+    assert users.count_documents({"role": "admin"}) == 1
+    assert system_flags.find_one({"_id": "first_admin"})["email"] in {user["email"] for user in created}
+
+
+def test_claim_is_shared_across_workers():
+    assert auth.claim_first_admin("first@test.local")
+    # Another worker has not seen the claim yet: the Mongo flag still refuses it
+    auth._first_admin_claimed.clear()
+    assert not auth.claim_first_admin("second@test.local")
+    assert system_flags.find_one({"_id": "first_admin"})["email"] == "first@test.local"
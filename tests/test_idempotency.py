@@ -0,0 +1,101 @@
+"""
+Idempotency: concurrent duplicates share one execution and an
+Idempotency-Key replays the stored result. Needs a MongoDB, see scratch.py.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from scratch import require_mongo
+
+require_mongo()
+
+from app.db import idempotency_keys, leases  # noqa: E402
+from app.idempotency import run_once  # noqa: E402
+
+EMAIL = "student@test.local"
+
+
+@pytest.fixture(autouse=True)
+def empty_collections():
+    idempotency_keys.delete_many({})
+    leases.delete_many({"_id": {"$regex": "^inflight:"}})
+
+
+def _in(seconds: int) -> datetime:
+    return datetime.utcnow() + timedelta(seconds=seconds)
+
+
+class CountingWork:
+    """A start that takes a moment and reports how often it actually ran"""
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.runs = 0
+
+    async def __call__(self) -> dict:
+        self.runs += 1
+        await asyncio.sleep(self.delay)
+        return {"status": "started", "run": self.runs}
+
+
+def test_concurrent_duplicates_share_one_run():
+    work = CountingWork()
+
+    async def scenario():
+        return await asyncio.gather(*(run_once("start_lab", EMAIL, "ubuntu-ssh", work) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert work.runs == 1
+    assert results == [{"status": "started", "run": 1}] * 5
+    assert not leases.find_one({"_id": f"inflight:start_lab:{EMAIL}:ubuntu-ssh"})
+
+
+def test_idempotency_key_replays_result():
+    work = CountingWork(delay=0)
+    first = asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", work, "retry-1"))
+    # A later retry with the same key replays; without one the work runs again
+    assert asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", work, "retry-1")) == first
+    assert work.runs == 1
+    assert asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", work)) == {"status": "started", "run": 2}
+
+
+def test_idempotency_key_is_scoped_to_operation_and_resource():
+    work = CountingWork(delay=0)
+    asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", work, "retry-1"))
+    asyncio.run(run_once("stop_lab", EMAIL, "ubuntu-ssh", work, "retry-1"))
+    asyncio.run(run_once("start_lab", EMAIL, "kali-linux", work, "retry-1"))
+    assert work.runs == 3
+
+
+def test_failed_run_is_not_stored_and_can_be_retried():
+    async def failing() -> dict:
+        raise RuntimeError("docker is down")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", failing, "retry-1"))
+    assert idempotency_keys.count_documents({}) == 0
+
+    work = CountingWork(delay=0)
+    assert asyncio.run(run_once("start_lab", EMAIL, "ubuntu-ssh", work, "retry-1"))["run"] == 1
+
+
+def test_waits_for_a_start_running_on_another_worker():
+    lease = f"inflight:start_lab:{EMAIL}:ubuntu-ssh"
+    leases.insert_one({"_id": lease, "owner": "other-worker", "expires_at": _in(60)})
+    work = CountingWork(delay=0)
+
+    async def scenario():
+        waiting = asyncio.create_task(run_once("start_lab", EMAIL, "ubuntu-ssh", work))
+        await asyncio.sleep(0.1)
+        # The other worker finishes: it stores its result and releases the lease
+        idempotency_keys.insert_one({
+            "_id": f"start_lab:{EMAIL}:ubuntu-ssh", "result": {"status": "started", "run": "other"},
+            "completed_at": datetime.utcnow(), "expires_at": _in(30)
+        })
+        leases.delete_one({"_id": lease})
+        return await waiting
+
+    assert asyncio.run(scenario()) == {"status": "started", "run": "other"}
+    assert work.runs == 0
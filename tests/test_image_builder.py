@@ -0,0 +1,166 @@
+"""
+Image builder: build waves, content-hash skipping and failure propagation,
+against a fake `docker build` and the in-memory runtime. Runs without
+MongoDB (record=False keeps results and home templates out of it).
+"""
+import os
+import threading
+import subprocess
+
+import pytest
+
+for module in ("pymongo", "httpx", "prometheus_client", "dotenv"):
+    pytest.importorskip(module)
+
+from app import image_builder  # noqa: E402
+from app.container_runtime import MemoryRuntime, set_runtime  # noqa: E402
+from app.image_builder import CONTEXT_HASH_LABEL, build_lab_images, build_order, context_hash, discover_contexts  # noqa: E402
+
+DOCKERFILES = {
+    "_ttyd": "FROM alpine:3.19\nRUN build-ttyd\n",
+    "ubuntu-ssh": "FROM ubuntu:22.04\nCOPY --from=selfmade/ttyd:latest /ttyd /usr/bin/ttyd\n",
+    "kali-linux": "FROM kalilinux/kali-rolling\nCOPY --from=selfmade/ttyd /ttyd /usr/bin/ttyd\n",
+    "n8n": "FROM n8nio/n8n\n",
+}
+
+
+class LabelledRuntime(MemoryRuntime):
+    """Memory runtime that keeps the labels images were built with"""
+
+    def __init__(self):
+        super().__init__()
+        self.labels = {}
+
+    def image_info(self, image):
+        info = super().image_info(image)
+        if info:
+            info["labels"] = dict(self.labels.get(image, {}))
+        return info
+
+
+class FakeDocker:
+    """Stands in for run_docker: `docker build` tags the image, or fails for the given contexts"""
+
+    def __init__(self, runtime: LabelledRuntime):
+        self.runtime = runtime
+        self.failing = set()
+        self.events = []  # ("start" | "end", context name) in the order they happened
+        self._lock = threading.Lock()
+
+    def built(self) -> list:
+        return sorted(name for event, name in self.events if event == "end")
+
+    def __call__(self, cmd, **kwargs):
+        image = cmd[cmd.index("-t") + 1]
+        label = cmd[cmd.index("--label") + 1]
+        name = os.path.basename(cmd[-1])
+        with self._lock:
+            self.events.append(("start", name))
+        if name in self.failing:
+            return subprocess.CompletedProcess(cmd, 1, "", "RUN build-ttyd: exit code 2")
+        key, value = label.split("=", 1)
+        self.runtime.images[image] = "sha256:" + os.urandom(32).hex()
+        self.runtime.labels[image] = {key: value}
+        with self._lock:
+            self.events.append(("end", name))
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+
+
+@pytest.fixture
+def labs_dir(tmp_path, monkeypatch):
+    for name, dockerfile in DOCKERFILES.items():
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "Dockerfile").write_text(dockerfile)
+    monkeypatch.setattr(image_builder, "discover_contexts", lambda: discover_contexts(str(tmp_path)))
+    return tmp_path
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    runtime = LabelledRuntime()
+    set_runtime(runtime)
+    docker = FakeDocker(runtime)
+    monkeypatch.setattr(image_builder, "run_docker", docker)
+    return docker
+
+
+def _statuses(results: dict) -> dict:
+    return {name: result["status"] for name, result in results.items()}
+
+
+def test_shared_stages_come_first(labs_dir):
+    contexts = discover_contexts(str(labs_dir))
+    assert contexts["ubuntu-ssh"]["deps"] == ["_ttyd"]
+    assert contexts["kali-linux"]["deps"] == ["_ttyd"]
+    assert contexts["n8n"]["deps"] == []
+    assert build_order(contexts) == [["_ttyd", "n8n"], ["kali-linux", "ubuntu-ssh"]]
+
+
+def test_circular_dependencies_are_rejected():
+    contexts = {"a": {"deps": ["b"]}, "b": {"deps": ["a"]}, "c": {"deps": []}}
+    with pytest.raises(ValueError):
+        build_order(contexts)
+
+
+def test_context_hash_follows_content_and_dependencies(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM alpine\n")
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+    original = context_hash(str(tmp_path), [])
+
+    (tmp_path / ".git" / "HEAD").write_text("ref: refs/heads/other\n")
+    assert context_hash(str(tmp_path), []) == original
+    assert context_hash(str(tmp_path), ["dep"]) != original
+    (tmp_path / "Dockerfile").write_text("FROM alpine:3.19\n")
+    assert context_hash(str(tmp_path), []) != original
+
+
+def test_dependents_are_built_after_what_they_use(labs_dir, docker):
+    results = build_lab_images(record=False)
+    assert set(_statuses(results).values()) == {"built"}
+    position = {event: index for index, event in enumerate(docker.events)}
+    for name in ("ubuntu-ssh", "kali-linux"):
+        assert position[("end", "_ttyd")] < position[("start", name)]
+    assert results["ubuntu-ssh"]["image"] == "selfmade/ubuntu-ssh:latest"
+    assert docker.runtime.labels["selfmade/ttyd:latest"][CONTEXT_HASH_LABEL] == results["_ttyd"]["context_hash"]
+
+
+def test_unchanged_contexts_are_skipped(labs_dir, docker):
+    build_lab_images(record=False)
+    docker.events.clear()
+
+    assert set(_statuses(build_lab_images(record=False)).values()) == {"skipped"}
+    assert docker.events == []
+
+
+def test_changed_shared_stage_rebuilds_its_dependents(labs_dir, docker):
+    build_lab_images(record=False)
+    docker.events.clear()
+
+    (labs_dir / "_ttyd" / "Dockerfile").write_text(DOCKERFILES["_ttyd"] + "RUN strip ttyd\n")
+    assert _statuses(build_lab_images(record=False)) == {
+        "_ttyd": "built", "n8n": "skipped", "kali-linux": "built", "ubuntu-ssh": "built"
+    }
+
+
+def test_force_rebuilds_unchanged_contexts(labs_dir, docker):
+    build_lab_images(record=False)
+    docker.events.clear()
+
+    build_lab_images(force=True, only=["n8n"], record=False)
+    assert docker.built() == ["n8n"]
+
+
+def test_failed_shared_stage_fails_its_dependents_without_building_them(labs_dir, docker):
+    docker.failing.add("_ttyd")
+    results = build_lab_images(record=False)
+    assert _statuses(results) == {"_ttyd": "failed", "n8n": "built", "kali-linux": "failed", "ubuntu-ssh": "failed"}
+    assert "exit code 2" in results["_ttyd"]["error"]
+    assert results["ubuntu-ssh"]["error"] == "Dependency _ttyd failed"
+    assert docker.built() == ["n8n"]
+
+
+def test_only_builds_the_requested_labs_and_what_they_use(labs_dir, docker):
+    assert set(build_lab_images(only=["ubuntu-ssh"], record=False)) == {"_ttyd", "ubuntu-ssh"}
+    with pytest.raises(ValueError):
+        build_lab_images(only=["no-such-lab"], record=False)
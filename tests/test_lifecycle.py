@@ -0,0 +1,179 @@
+"""
+Lab and service start/stop against the in-memory container runtime.
+Needs a MongoDB, see scratch.py.
+
+    python -m pytest tests
+"""
+from scratch import require_mongo
+
+require_mongo()
+
+import asyncio  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+from bson import ObjectId  # noqa: E402
+
+from app import lab_controller  # noqa: E402
+from app.db import lab_instances, service_instances  # noqa: E402
+from app.container_runtime import MemoryRuntime, ContainerRuntimeError, set_runtime  # noqa: E402
+from app.lab_controller import start_lab, stop_lab, wait_for_lab_ready  # noqa: E402
+from app.service_controller import (  # noqa: E402
+    start_service, stop_service, ensure_shared_container_running, SERVICE_CONFIGS, SHARED_CONTAINERS
+)
+
+EMAIL = "student@test.local"
+OTHER_EMAIL = "other@test.local"
+LAB = "ubuntu-ssh"
+
+
+class FailingRunRuntime(MemoryRuntime):
+    """Memory runtime whose docker run always fails"""
+
+    def _operation(self, operation: str):
+        super()._operation(operation)
+        if operation == "run":
+            raise ContainerRuntimeError("simulated run failure")
+
+
+def _with_shared_container(runtime: MemoryRuntime, service_id: str):
+    # Already running, so start_service skips the warm-up wait for a new container
+    runtime.run(SERVICE_CONFIGS[service_id]["image"], SHARED_CONTAINERS[service_id])
+
+
+def test_start_and_stop_lab(runtime):
+    result = start_lab(EMAIL, LAB)
+    assert result["status"] == "starting"
+    assert runtime.containers[result["container"]]["state"] == "running"
+    assert result["volume"] in runtime.volumes
+    instance = lab_instances.find_one({"_id": ObjectId(result["instance_id"])})
+    assert instance["active"] is True
+    assert instance["upstream"].endswith(":7681")
+
+    # The active claim turns a second start into an error, not a second container
+    assert "error" in start_lab(EMAIL, LAB)
+    assert len(runtime.containers) == 1
+
+    assert stop_lab(EMAIL, LAB)["stopped"] == [LAB]
+    assert result["container"] not in runtime.containers
+    instance = lab_instances.find_one({"_id": ObjectId(result["instance_id"])})
+    assert instance["status"] == "stopped"
+    assert "active" not in instance
+
+    assert start_lab(EMAIL, LAB)["status"] == "starting"
+
+
+def test_failed_lab_start_releases_claim(runtime):
+    set_runtime(FailingRunRuntime())
+    assert "error" in start_lab(EMAIL, LAB)
+    assert lab_instances.count_documents({"user_email": EMAIL}) == 0
+
+    set_runtime(runtime)
+    assert start_lab(EMAIL, LAB)["status"] == "starting"
+
+
+def _probe_answering_after(seconds, before_answer=None):
+    """Stand-in for wait_until_ready: the lab answers after seconds (None: never)"""
+    async def probe(upstream, access_type):
+        if before_answer:
+            before_answer()
+        return seconds
+    return probe
+
+
+def test_lab_is_running_once_ready(runtime, monkeypatch):
+    monkeypatch.setattr(lab_controller, "wait_until_ready", _probe_answering_after(0.25))
+    result = start_lab(EMAIL, LAB)
+    ready = asyncio.run(wait_for_lab_ready(EMAIL, result))
+    assert ready["status"] == "started"
+    assert ready["time_to_ready"] == 0.25
+    instance = lab_instances.find_one({"_id": ObjectId(result["instance_id"])})
+    assert instance["status"] == "running"
+    assert instance["active"] is True
+
+
+def test_lab_that_never_answers_is_failed_and_released(runtime, monkeypatch):
+    monkeypatch.setattr(lab_controller, "wait_until_ready", _probe_answering_after(None))
+    result = start_lab(EMAIL, LAB)
+    assert "error" in asyncio.run(wait_for_lab_ready(EMAIL, result))
+    assert result["container"] not in runtime.containers
+    instance = lab_instances.find_one({"_id": ObjectId(result["instance_id"])})
+    assert instance["status"] == "failed"
+    assert "active" not in instance
+
+    assert start_lab(EMAIL, LAB)["status"] == "starting"
+
+
+def test_lab_stopped_while_probing_is_not_promoted(runtime, monkeypatch):
+    monkeypatch.setattr(lab_controller, "wait_until_ready", _probe_answering_after(1.0, lambda: stop_lab(EMAIL, LAB)))
+    result = start_lab(EMAIL, LAB)
+    assert "error" in asyncio.run(wait_for_lab_ready(EMAIL, result))
+    assert lab_instances.find_one({"_id": ObjectId(result["instance_id"])})["status"] == "stopped"
+
+
+def test_start_and_stop_service(runtime):
+    _with_shared_container(runtime, "postgresql")
+
+    result = start_service(EMAIL, "postgresql")
+    assert result["status"] == "running"
+    assert result["credentials"]["database"].startswith("user_")
+    # CREATE DATABASE, CREATE USER, GRANT
+    assert runtime.calls["exec"] == 3
+    assert "error" in start_service(EMAIL, "postgresql")
+
+    assert "message" in stop_service(EMAIL, "postgresql")
+    stopped = service_instances.find_one({"_id": ObjectId(result["_id"])})
+    assert stopped["status"] == "stopped"
+    assert "active" not in stopped
+
+    assert start_service(EMAIL, "postgresql")["status"] == "running"
+
+
+def test_redis_tenants_get_distinct_databases(runtime):
+    _with_shared_container(runtime, "redis")
+
+    first = start_service(EMAIL, "redis")
+    second = start_service(OTHER_EMAIL, "redis")
+    assert {first["credentials"]["database"], second["credentials"]["database"]} == {0, 1}
+
+    stop_service(EMAIL, "redis")
+    # The released number is handed out again
+    assert start_service(EMAIL, "redis")["credentials"]["database"] == 0
+
+
+# ==================== Concurrent starts ====================
+
+def _at_once(work, args) -> list:
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        return list(pool.map(work, args))
+
+
+def test_concurrent_lab_starts_claim_one_instance(runtime):
+    results = _at_once(lambda _: start_lab(EMAIL, LAB), range(8))
+    assert [result.get("status") for result in results].count("starting") == 1
+    assert sum("error" in result for result in results) == 7
+    assert len(runtime.containers) == 1
+    assert lab_instances.count_documents({"user_email": EMAIL, "active": True}) == 1
+
+
+def test_concurrent_service_starts_claim_one_instance(runtime):
+    _with_shared_container(runtime, "postgresql")
+
+    results = _at_once(lambda _: start_service(EMAIL, "postgresql"), range(8))
+    assert [result.get("status") for result in results].count("running") == 1
+    assert service_instances.count_documents({"user_email": EMAIL, "active": True}) == 1
+    # Only the winner provisioned a database
+    assert runtime.calls["exec"] == 3
+
+
+def test_concurrent_redis_tenants_never_share_a_database(runtime):
+    _with_shared_container(runtime, "redis")
+
+    emails = [f"user{n}@test.local" for n in range(8)]
+    results = _at_once(lambda email: start_service(email, "redis"), emails)
+    assert sorted(result["credentials"]["database"] for result in results) == list(range(8))
+
+
+def test_concurrent_first_starts_create_the_shared_container_once(runtime):
+    assert all(_at_once(lambda _: ensure_shared_container_running("redis"), range(4)))
+    assert runtime.calls["run"] == 1
+    assert runtime.containers[SHARED_CONTAINERS["redis"]]["state"] == "running"
@@ -0,0 +1,215 @@
+"""
+Notifications: the denormalized unread counter, the outbox, broadcasts and
+keyset pagination. Needs a MongoDB, see scratch.py.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from scratch import require_mongo
+
+require_mongo()
+
+from app import notifications as notif  # noqa: E402
+from app.db import notifications, notification_counters, broadcasts  # noqa: E402
+from app.pagination import encode_cursor, decode_cursor  # noqa: E402
+
+EMAIL = "student@test.local"
+
+
+@pytest.fixture(autouse=True)
+def empty_collections():
+    notifications.delete_many({})
+    notification_counters.delete_many({})
+    broadcasts.delete_many({})
+    notif._broadcast_cache["loaded_at"] = 0.0
+    notif.notification_outbox._recent.clear()
+
+
+def _notify(n: int, email: str = EMAIL) -> str:
+    # Distinct messages, so nothing is coalesced
+    return notif.create_notification(email, "lab_started", "Lab Started", f"Lab {n} is running")
+
+
+def _counter(email: str = EMAIL) -> int:
+    return notification_counters.find_one({"_id": email})["unread"]
+
+
+# ==================== Unread counter ====================
+
+def test_counter_follows_creates_reads_and_deletes():
+    ids = [_notify(n) for n in range(3)]
+    assert _counter() == 3
+    assert notif.get_unread_count(EMAIL) == 3
+
+    assert notif.mark_as_read(ids[0], EMAIL)
+    # Reading twice must not decrement twice
+    assert not notif.mark_as_read(ids[0], EMAIL)
+    assert _counter() == 2
+
+    assert notif.delete_notification(ids[1], EMAIL)
+    assert _counter() == 1
+    # Deleting a read notification leaves the counter alone
+    assert notif.delete_notification(ids[0], EMAIL)
+    assert _counter() == 1
+
+    assert notif.mark_all_as_read(EMAIL) == 1
+    assert notif.get_unread_count(EMAIL) == 0
+
+
+def test_repair_fixes_drifted_counters():
+    _notify(0)
+    _notify(1)
+    # Settled: older than the repair window
+    notifications.update_many({}, {"$set": {"created_at": datetime.utcnow() - timedelta(hours=1)}})
+    notification_counters.update_one({"_id": EMAIL}, {"$set": {"unread": 7}})
+    notification_counters.insert_one({"_id": "gone@test.local", "unread": 2})
+
+    assert notif.repair_unread_counters() == 2
+    assert _counter() == 2
+    assert _counter("gone@test.local") == 0
+
+
+def test_repair_skips_users_with_recent_notifications():
+    _notify(0)
+    notification_counters.update_one({"_id": EMAIL}, {"$set": {"unread": 5}})
+    assert notif.repair_unread_counters() == 0
+    assert _counter() == 5
+
+
+# ==================== Outbox ====================
+
+@pytest.fixture
+def outbox():
+    """The notification outbox with an idle flusher, so tests decide when it flushes"""
+    outbox = notif.notification_outbox
+    interval, outbox.flush_interval = outbox.flush_interval, 60
+    outbox.start()
+    yield outbox
+    outbox.stop()
+    outbox.flush_interval = interval
+
+
+def test_identical_notifications_are_coalesced(outbox):
+    first = notif.create_notification(EMAIL, "lab_stopped", "Lab Stopped", "Your lab has been stopped")
+    second = notif.create_notification(EMAIL, "lab_stopped", "Lab Stopped", "Your lab has been stopped")
+    assert first == second
+    # Another user's identical notification is their own
+    assert notif.create_notification("other@test.local", "lab_stopped", "Lab Stopped", "Your lab has been stopped") != first
+
+    outbox.flush()
+    assert notifications.count_documents({"user_email": EMAIL}) == 1
+    assert _counter() == 1
+
+
+def test_queued_notifications_are_visible_before_the_flush(outbox):
+    ids = [_notify(n) for n in range(2)]
+    assert notifications.count_documents({}) == 0
+    assert [n["_id"] for n in notif.get_user_notifications(EMAIL)["notifications"]] == ids[::-1]
+    assert notif.get_unread_count(EMAIL) == 2
+
+    assert outbox.flush() == 2
+    assert notifications.count_documents({"user_email": EMAIL}) == 2
+    assert _counter() == 2
+    assert notif.get_unread_count(EMAIL) == 2
+
+
+def test_reads_and_deletes_of_queued_notifications_apply_on_flush(outbox):
+    read_id, deleted_id, kept_id = [_notify(n) for n in range(3)]
+    assert notif.mark_as_read(read_id, EMAIL)
+    assert notif.delete_notification(deleted_id, EMAIL)
+    assert notif.get_unread_count(EMAIL) == 1
+
+    outbox.flush()
+    stored = {str(doc["_id"]): doc for doc in notifications.find({"user_email": EMAIL})}
+    assert set(stored) == {read_id, kept_id}
+    assert stored[read_id]["read"] and "read_at" in stored[read_id]
+    # Only the notification still unread when it landed is counted
+    assert _counter() == 1
+
+
+# ==================== Broadcasts ====================
+
+def test_broadcast_is_one_document_read_per_user():
+    broadcast_id = notif.create_broadcast("Maintenance", "Tonight at 22:00", "admin@test.local")
+    assert broadcasts.count_documents({}) == 1
+    assert notifications.count_documents({}) == 0
+    assert notif.get_unread_count(EMAIL) == 1
+    assert notif.get_unread_count("other@test.local") == 1
+
+    assert notif.mark_as_read(broadcast_id, EMAIL)
+    assert notif.get_unread_count(EMAIL) == 0
+    assert notif.get_unread_count("other@test.local") == 1
+    listed = notif.get_user_notifications(EMAIL)["notifications"]
+    assert [(n["_id"], n["read"]) for n in listed] == [(broadcast_id, True)]
+
+
+def test_read_watermark_leaves_newer_broadcasts_unread():
+    older = notif.create_broadcast("First", "one", "admin@test.local")
+    notif.mark_as_read(older, EMAIL)
+    # Mongo keeps milliseconds; make sure the second one is strictly newer
+    time.sleep(0.01)
+    notif.create_broadcast("Second", "two", "admin@test.local")
+    assert notif.get_unread_count(EMAIL) == 1
+
+    assert notif.mark_all_as_read(EMAIL) == 1
+    assert notif.get_unread_count(EMAIL) == 0
+
+
+def test_dismissed_broadcast_is_hidden_for_that_user_only():
+    broadcast_id = notif.create_broadcast("Maintenance", "Tonight at 22:00", "admin@test.local")
+    assert notif.delete_notification(broadcast_id, EMAIL)
+    assert notif.get_user_notifications(EMAIL)["notifications"] == []
+    assert notif.get_unread_count(EMAIL) == 0
+    assert len(notif.get_user_notifications("other@test.local")["notifications"]) == 1
+
+
+# ==================== Pagination and retention ====================
+
+def _all_pages(limit: int, **kwargs) -> list:
+    seen, cursor = [], None
+    while True:
+        page = notif.get_user_notifications(EMAIL, limit=limit, cursor=cursor, **kwargs)
+        seen += [n["_id"] for n in page["notifications"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return seen
+
+
+def test_keyset_pages_cover_personal_and_broadcast_notifications_once():
+    ids = [_notify(n) for n in range(3)]
+    ids.append(notif.create_broadcast("Maintenance", "Tonight at 22:00", "admin@test.local"))
+    ids += [_notify(n) for n in range(3, 5)]
+
+    newest_first = ids[::-1]
+    assert _all_pages(2) == newest_first
+    assert _all_pages(4) == newest_first
+    assert _all_pages(10) == newest_first
+
+
+def test_timezone_aware_cursor_pages_like_naive_utc():
+    for n in range(4):
+        _notify(n)
+    cursor = notif.get_user_notifications(EMAIL, limit=2)["next_cursor"]
+    created_at, object_id = decode_cursor(cursor)
+    aware = encode_cursor(created_at.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=2))), object_id)
+
+    expected = notif.get_user_notifications(EMAIL, limit=2, cursor=cursor)
+    assert notif.get_user_notifications(EMAIL, limit=2, cursor=aware) == expected
+
+
+def test_malformed_cursor_is_a_value_error():
+    with pytest.raises(ValueError):
+        notif.get_user_notifications(EMAIL, cursor="not-a-cursor")
+
+
+def test_read_retention_counts_from_read_at():
+    notification_id = _notify(0)
+    notif.mark_as_read(notification_id, EMAIL)
+    stored = notifications.find_one({})
+    assert stored["read_at"] >= stored["created_at"]
+
+    ttl = notifications.index_information()["read_at_ttl"]
+    assert ttl["key"] == [("read_at", 1)]
+    assert ttl["expireAfterSeconds"] == notif.NOTIFICATION_READ_RETENTION_DAYS * 86400
@@ -0,0 +1,175 @@
+"""
+Rate limiting: token buckets, the identity requests are counted against and
+the Docker concurrency cap, driven through the ASGI middleware directly.
+app.rate_limit reads the JWT secret from app.auth, so this needs a MongoDB
+too, see scratch.py.
+"""
+import time
+import asyncio
+
+import pytest
+
+from scratch import require_mongo
+
+require_mongo()
+
+from app import rate_limit  # noqa: E402
+from app.auth import create_access_token  # noqa: E402
+from app.rate_limit import MemoryBuckets, RateLimitMiddleware, release_concurrency_slot  # noqa: E402
+
+EMAIL = "student@test.local"
+
+
+def _scope(method: str = "POST", path: str = "/labs/start", headers: list = (), client: str = "10.0.0.1") -> dict:
+    return {"type": "http", "method": method, "path": path, "headers": list(headers), "client": (client, 50000)}
+
+
+def _bearer(email: str) -> tuple:
+    return (b"authorization", f"Bearer {create_access_token({'email': email})}".encode())
+
+
+def _forwarded_for(value: str) -> tuple:
+    return (b"x-forwarded-for", value.encode())
+
+
+class Recorder:
+    """Inner ASGI app: answers 200, optionally after handing its slot back or waiting"""
+
+    def __init__(self, delay: float = 0, release_early: bool = False):
+        self.delay = delay
+        self.release_early = release_early
+        self.calls = 0
+        self.slots_seen = []
+
+    async def __call__(self, scope, receive, send):
+        self.calls += 1
+        if self.release_early:
+            await release_concurrency_slot(type("Request", (), {"scope": scope})())
+        self.slots_seen.append(rate_limit.docker_slots_in_use())
+        await asyncio.sleep(self.delay)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def _request(middleware, scope) -> tuple:
+    """(status, headers) of one request through the middleware"""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, receive, send)
+    start = sent[0]
+    return start["status"], dict(start["headers"])
+
+
+@pytest.fixture
+def docker_limits(monkeypatch):
+    """A docker class of 2 requests per 10 seconds and one concurrency slot"""
+    monkeypatch.setitem(rate_limit.ENDPOINT_CLASSES, "docker", {"rate": (2.0, 0.2), "pool": "docker"})
+    monkeypatch.setitem(rate_limit.SLOT_POOLS, "docker", 1)
+    monkeypatch.setattr(rate_limit, "DOCKER_QUEUE_SECONDS", 0.1)
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+
+
+# ==================== Buckets ====================
+
+def test_bucket_allows_capacity_then_refills():
+    buckets = MemoryBuckets()
+    assert asyncio.run(buckets.take("docker:a", 2, 10)) == 0
+    assert asyncio.run(buckets.take("docker:a", 2, 10)) == 0
+    wait = asyncio.run(buckets.take("docker:a", 2, 10))
+    assert 0 < wait <= 0.1
+    # Other keys have their own bucket
+    assert asyncio.run(buckets.take("docker:b", 2, 10)) == 0
+
+    time.sleep(wait + 0.02)
+    assert asyncio.run(buckets.take("docker:a", 2, 10)) == 0
+
+
+def test_parse_rate():
+    assert rate_limit.parse_rate("10/60") == (10.0, 10 / 60)
+
+
+# ==================== Identity ====================
+
+def test_identity_is_the_token_email():
+    assert rate_limit._identity(_scope(headers=[_bearer(EMAIL)])) == EMAIL
+    # An invalid token counts against the client address
+    assert rate_limit._identity(_scope(headers=[(b"authorization", b"Bearer nonsense")])) == "10.0.0.1"
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 0)
+    assert rate_limit._client_address(_scope(headers=[_forwarded_for("203.0.113.7")])) == "10.0.0.1"
+
+
+def test_forwarded_for_takes_the_entry_our_proxies_appended(monkeypatch):
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 1)
+    # The client may send any X-Forwarded-For; only the last entry comes from our balancer
+    spoofed = _scope(headers=[_forwarded_for("1.2.3.4, 203.0.113.7")])
+    assert rate_limit._client_address(spoofed) == "203.0.113.7"
+
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 2)
+    assert rate_limit._client_address(_scope(headers=[_forwarded_for("1.2.3.4, 203.0.113.7, 10.0.0.9")])) == "203.0.113.7"
+    # Fewer entries than trusted hops: fall back to the socket peer
+    assert rate_limit._client_address(_scope(headers=[_forwarded_for("203.0.113.7")])) == "10.0.0.1"
+
+
+# ==================== Middleware ====================
+
+def test_empty_bucket_is_429_with_retry_after(docker_limits):
+    app = Recorder()
+    middleware = RateLimitMiddleware(app)
+    scope = lambda: _scope(headers=[_bearer(EMAIL)])  # noqa: E731
+
+    async def scenario():
+        return [await _request(middleware, scope()) for _ in range(3)]
+
+    statuses = asyncio.run(scenario())
+    assert [status for status, _ in statuses] == [200, 200, 429]
+    assert int(statuses[2][1][b"retry-after"]) >= 1
+    assert app.calls == 2
+
+
+def test_unlimited_routes_pass_through(docker_limits):
+    app = Recorder()
+    middleware = RateLimitMiddleware(app)
+
+    async def scenario():
+        return [await _request(middleware, _scope("GET", "/labs")) for _ in range(5)]
+
+    assert [status for status, _ in asyncio.run(scenario())] == [200] * 5
+
+
+def test_concurrency_cap_rejects_while_the_slot_is_held(docker_limits):
+    app = Recorder(delay=0.3)
+    middleware = RateLimitMiddleware(app)
+
+    async def scenario():
+        return await asyncio.gather(
+            _request(middleware, _scope(headers=[_bearer(EMAIL)])),
+            _request(middleware, _scope(headers=[_bearer("other@test.local")]))
+        )
+
+    assert sorted(status for status, _ in asyncio.run(scenario())) == [200, 429]
+    assert rate_limit.docker_slots_in_use() == 0
+
+
+def test_slot_handed_back_early_lets_the_next_request_in(docker_limits):
+    app = Recorder(delay=0.3, release_early=True)
+    middleware = RateLimitMiddleware(app)
+
+    async def scenario():
+        return await asyncio.gather(
+            _request(middleware, _scope(headers=[_bearer(EMAIL)])),
+            _request(middleware, _scope(headers=[_bearer("other@test.local")]))
+        )
+
+    assert [status for status, _ in asyncio.run(scenario())] == [200, 200]
+    assert app.slots_seen == [0, 0]
+    # Released once, not again when the request finishes
+    assert rate_limit.docker_slots_in_use() == 0